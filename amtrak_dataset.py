@@ -1,62 +1,1453 @@
 from zipfile import ZipFile
 import os.path
-from io import BytesIO
+from io import StringIO, BytesIO
+from contextlib import contextmanager, redirect_stdout, nullcontext
+from tempfile import SpooledTemporaryFile
+import shutil
+import sys
 import datetime
 import csv
 import re
 import traceback
-import pytz
+import json
+import math
+import time
+import struct
+import mmap
+import zlib
+from bisect import bisect_left, bisect_right
+from array import array
+from operator import itemgetter, attrgetter
+from functools import lru_cache
+from collections import deque
+try:
+    import resource
+except ImportError: #not available on windows
+    resource=None
+#pytz, asyncio and the process pools are imported where they are used, a short-lived job that
+#converts a few files with a timezone cache never loads them
+
+COPY_CHUNK_SIZE=1024*1024
+#archive members the reader stage of convert_pipelined inflates per thread switch
+READ_BATCH_SIZE=16
+
+V_LINE_EXPECTED="V V    V  V     V  V     V     V     V"
+V_LINE_RE=re.compile(r"^[ V]+$")
+STATION_CODE_RE=re.compile(r"[A-Z]{3}")
+#one "Arrived: 5 minutes late." clause of a comment, scanned from a position on
+COMMENT_RE=re.compile(r"[^A-Za-z]*(Arrived|Departed):? ([^|]*?)([oO]n time|late|early)")
+COMMENT_DELAY_RE=re.compile(r"\D*((\d+) [hH]our)?\D*((\d+) [mM]in)?\D*$")
+#position of the fields in a tokenized station line
+STATION_COLUMNS={"station_code":1,"scheduled_arrival_day":2,"scheduled_arrival_time":3,
+    "scheduled_departure_day":4,"scheduled_departure_time":5,"actual_arrival_time":6,
+    "actual_departure_time":7,"comment":8}
+
+class StationLineTokenizer:
+    #Splits the fixed-width station lines of a status file into their fields. The column
+    #layout is compiled once from the 'V-line' into slices, a whole station block is then
+    #split with one itemgetter call per line.
+    _layouts={}
+
+    def __init__(self,v_line):
+        indices=[]
+        last=0
+        while True:
+            last=v_line.find("V",last+1)
+            if last>=0:
+                indices+=[last]
+            else:
+                break
+        starts=[0]+indices
+        self.slices=[slice(a,b) for a,b in zip(starts,indices)]+[slice(starts[-1],None)]
+        if len(self.slices)>1:
+            self._getter=itemgetter(*self.slices)
+        else:
+            self._getter=lambda line,s=self.slices[0]:(line[s],)
+
+    @classmethod
+    def from_v_line(cls,v_line):
+        #almost every file uses the same layout, so the compiled tokenizers are shared
+        tokenizer=cls._layouts.get(v_line)
+        if tokenizer is None:
+            tokenizer=cls._layouts[v_line]=cls(v_line)
+        return tokenizer
+
+    def split(self,line):
+        return list(map(str.strip,self._getter(line)))
+
+    def split_block(self,lines):
+        getter=self._getter
+        strip=str.strip
+        return [(line,list(map(strip,getter(line)))) for line in lines if strip(line)!="CD"]
+
+TIMEZONE_NAMES={"EST":"America/New_York","CST":"America/Chicago","MST":"America/Denver",
+    "PST":"America/Los_Angeles","MST/Arizona":"America/Phoenix"}
+
+class ZoneOffsets:
+    #UTC offsets of one timezone for every day in a range of years. Plain days map directly to
+    #a fixed offset tzinfo, days with a DST transition keep the local time at which the offset
+    #changes. Like pytz localize (is_dst=False) times in the spring-forward gap and in the
+    #repeated hour of fall-back get the standard time offset. Days outside of the range, or
+    #transitions that do not fit this scheme, go through pytz.
+    _tzinfos={}
+
+    def __init__(self,name,first_ordinal,offsets,transitions):
+        self.name=name
+        self.first_ordinal=first_ordinal
+        self.offsets=offsets
+        self.transitions=transitions
+        #None marks a day that has to be looked up in transitions
+        tzinfos={offset:self._tzinfo(offset) for offset in set(offsets) if offset is not None}
+        self.days=[tzinfos.get(offset) for offset in offsets]
+        self._pytz=None
+
+    @classmethod
+    def _tzinfo(cls,seconds):
+        tzinfo=cls._tzinfos.get(seconds)
+        if tzinfo is None:
+            tzinfo=cls._tzinfos[seconds]=datetime.timezone(datetime.timedelta(seconds=seconds))
+        return tzinfo
+
+    @classmethod
+    def from_pytz(cls,name,first_ordinal,last_ordinal):
+        import pytz
+        tz=pytz.timezone(name)
+        seconds=lambda delta:int(delta.total_seconds())
+        info=getattr(tz,"_transition_info",[])
+        transitions={}
+        for idx,utc_time in enumerate(getattr(tz,"_utc_transition_times",[])[1:],1):
+            #the first local time with the new offset, earlier times of the day (including
+            #the gap or the overlap) are standard time with is_dst=False
+            after=info[idx][0]
+            boundary=utc_time+after
+            ordinal=boundary.toordinal()
+            if first_ordinal<=ordinal<=last_ordinal:
+                transitions[ordinal]=(boundary.hour*3600+boundary.minute*60+boundary.second,
+                    seconds(info[idx-1][0]),seconds(after))
+        offsets=[]
+        current=seconds(tz.localize(datetime.datetime.fromordinal(first_ordinal)).utcoffset())
+        for ordinal in sorted(transitions):
+            offsets+=[current]*(ordinal-first_ordinal-len(offsets))
+            boundary,before,after=transitions[ordinal]
+            midnight=datetime.datetime.fromordinal(ordinal)
+            probes=[(midnight,before),(midnight+datetime.timedelta(seconds=boundary-1),before),
+                (midnight+datetime.timedelta(seconds=boundary),after),
+                (midnight+datetime.timedelta(seconds=86399),after)]
+            if boundary==0 or any(seconds(tz.localize(naive).utcoffset())!=offset for naive,offset in probes):
+                del transitions[ordinal] #left to pytz
+            offsets+=[None]
+            current=seconds(tz.localize(midnight+datetime.timedelta(seconds=86399)).utcoffset())
+        offsets+=[current]*(last_ordinal+1-first_ordinal-len(offsets))
+        return cls(name,first_ordinal,offsets,transitions)
+
+    def localize(self,naive):
+        day=naive.toordinal()-self.first_ordinal
+        if 0<=day<len(self.days):
+            tzinfo=self.days[day]
+            if tzinfo is not None:
+                return naive.replace(tzinfo=tzinfo)
+            transition=self.transitions.get(day+self.first_ordinal)
+            if transition is not None:
+                boundary,before,after=transition
+                offset=after if naive.hour*3600+naive.minute*60+naive.second>=boundary else before
+                return naive.replace(tzinfo=self._tzinfo(offset))
+        if self._pytz is None:
+            import pytz
+            self._pytz=pytz.timezone(self.name)
+        return self._pytz.localize(naive)
+
+class TimezoneIndex:
+    #Maps station codes to the ZoneOffsets of their timezone (from stations_timezone.csv),
+    #precomputed for first_year up to the current year. The index can be stored in a binary
+    #cache file that is used as long as the csv file and the covered years do not change.
+    MAGIC=b"AMTZ"
+    VERSION=1
+    #offsets are stored as int32, this marks a transition day
+    TRANSITION=-2**31
+    _built={}
+
+    def __init__(self,codes,zones,source=(0,0)):
+        self.codes=codes
+        self.zones=zones
+        #(size, mtime_ns) of the csv file the index was built from
+        self.source=source
+
+    def __contains__(self,code):
+        return code in self.codes
+
+    def get(self,code,default=None):
+        return self.codes.get(code,default)
+
+    @staticmethod
+    def _source(csv_code_timezone):
+        stat=os.stat(csv_code_timezone)
+        return (stat.st_size,stat.st_mtime_ns)
+
+    @classmethod
+    def from_csv(cls,csv_code_timezone,first_year=2007,last_year=None):
+        if last_year is None:
+            last_year=datetime.date.today().year
+        source=cls._source(csv_code_timezone)
+        #indexes are shared by all writers of a process, building one needs a few pytz calls
+        #per DST transition
+        key=(os.path.abspath(csv_code_timezone),source,first_year,last_year)
+        if key in cls._built:
+            return cls._built[key]
+        first_ordinal=datetime.date(first_year,1,1).toordinal()
+        last_ordinal=datetime.date(last_year,12,31).toordinal()
+        zones={}
+        codes={}
+        with open(csv_code_timezone) as csv_code_tz:
+            for row in csv.DictReader(csv_code_tz):
+                name=TIMEZONE_NAMES.get(row["timezone"])
+                if name is not None:
+                    if name not in zones:
+                        zones[name]=ZoneOffsets.from_pytz(name,first_ordinal,last_ordinal)
+                    codes[row["code"]]=zones[name]
+        index=cls._built[key]=cls(codes,zones,source)
+        return index
+
+    @classmethod
+    def cached(cls,csv_code_timezone,cache_path,first_year=2007):
+        #loads the cache file, rebuilds (and rewrites) it if it is missing or outdated
+        try:
+            index=cls.load(cache_path)
+            zone=next(iter(index.zones.values()),None)
+            if (index.source==cls._source(csv_code_timezone) and zone is not None and
+                    zone.first_ordinal<=datetime.date(first_year,1,1).toordinal() and
+                    zone.first_ordinal+len(zone.days)>datetime.date.today().toordinal()):
+                return index
+        except (OSError,ValueError,struct.error):
+            pass
+        index=cls.from_csv(csv_code_timezone,first_year)
+        index.save(cache_path)
+        return index
+
+    def save(self,path):
+        names=list(self.zones)
+        zone_idx={id(self.zones[name]):idx for idx,name in enumerate(names)}
+        first_ordinal,nr_days=0,0
+        if names:
+            first_ordinal,nr_days=self.zones[names[0]].first_ordinal,len(self.zones[names[0]].days)
+        parts=[self.MAGIC,struct.pack("<HQqIIH",self.VERSION,self.source[0],self.source[1],
+            first_ordinal,nr_days,len(names))]
+        for name in names:
+            zone=self.zones[name]
+            encoded=name.encode()
+            offsets=array("i",[self.TRANSITION if offset is None else offset for offset in zone.offsets])
+            parts+=[struct.pack("<B",len(encoded)),encoded,struct.pack("<%di"%nr_days,*offsets),
+                struct.pack("<H",len(zone.transitions))]
+            parts+=[struct.pack("<Iiii",ordinal,*transition)
+                for ordinal,transition in sorted(zone.transitions.items())]
+        parts+=[struct.pack("<I",len(self.codes))]
+        for code,zone in self.codes.items():
+            encoded=code.encode()
+            parts+=[struct.pack("<B",len(encoded)),encoded,struct.pack("<H",zone_idx[id(zone)])]
+        with open(path+".tmp","wb") as cache_file:
+            cache_file.write(b"".join(parts))
+        os.replace(path+".tmp",path)
+
+    @classmethod
+    def load(cls,path):
+        with open(path,"rb") as cache_file:
+            data=cache_file.read()
+        if data[:4]!=cls.MAGIC:
+            raise ValueError("'{}' is not a timezone index".format(path))
+        pos=4
+        def unpack(fmt):
+            nonlocal pos
+            values=struct.unpack_from(fmt,data,pos)
+            pos+=struct.calcsize(fmt)
+            return values
+        version,size,mtime,first_ordinal,nr_days,nr_zones=unpack("<HQqIIH")
+        if version!=cls.VERSION:
+            raise ValueError("Unsupported timezone index version {}".format(version))
+        zones=[]
+        for __ in range(nr_zones):
+            name=data[pos+1:pos+1+data[pos]].decode()
+            pos+=1+data[pos]
+            offsets=[None if offset==cls.TRANSITION else offset for offset in unpack("<%di"%nr_days)]
+            transitions={}
+            for __ in range(unpack("<H")[0]):
+                ordinal,*transition=unpack("<Iiii")
+                transitions[ordinal]=tuple(transition)
+            zones+=[ZoneOffsets(name,first_ordinal,offsets,transitions)]
+        codes={}
+        for __ in range(unpack("<I")[0]):
+            code=data[pos+1:pos+1+data[pos]].decode()
+            pos+=1+data[pos]
+            codes[code]=zones[unpack("<H")[0]]
+        return cls(codes,{zone.name:zone for zone in zones},(size,mtime))
+
+class TimeParser:
+    #Parses the 'hmmA'/'hmmP' times of the status files. All valid times are looked up in a
+    #table of minute offsets instead of going through strptime, anything not in the table
+    #still goes through strptime so the results (and None for invalid input) are the same.
+    #Localized datetimes reuse the tzinfo of the day, only days with a DST transition
+    #need the full pytz localize. ZoneOffsets of a TimezoneIndex localize on their own.
+    _minutes=None
+    max_cache_size=4096
+
+    def __init__(self):
+        self._unusual={}
+        self._day_tzinfo={}
+
+    @classmethod
+    def _build_table(cls):
+        table={}
+        for hour in range(1,13):
+            for minute in range(60):
+                for suffix,pm in (("A",0),("P",12)):
+                    value=(hour%12+pm)*60+minute
+                    table["%d%02d%s"%(hour,minute,suffix)]=value
+                    table["%02d%02d%s"%(hour,minute,suffix)]=value
+        cls._minutes=table
+
+    def _strptime_minutes(self,time_str):
+        try:
+            time1=datetime.datetime.strptime((time_str+"M").rjust(6,"0"),"%I%M%p")
+            return time1.hour*60+time1.minute
+        except ValueError:
+            return None
+
+    def minutes(self,time_str):
+        if TimeParser._minutes is None:
+            self._build_table()
+        value=TimeParser._minutes.get(time_str)
+        if value is None:
+            if time_str in self._unusual:
+                return self._unusual[time_str]
+            value=self._strptime_minutes(time_str)
+            if len(self._unusual)>=self.max_cache_size:
+                self._unusual.clear()
+            self._unusual[time_str]=value
+        return value
+
+    def localize(self,timezone,naive):
+        if type(timezone) is ZoneOffsets:
+            return timezone.localize(naive)
+        key=(timezone,naive.toordinal())
+        tzinfo=self._day_tzinfo.get(key,False)
+        if tzinfo is False:
+            midnight=datetime.datetime.combine(naive.date(),datetime.time())
+            first=timezone.localize(midnight).tzinfo
+            last=timezone.localize(midnight+datetime.timedelta(days=1,microseconds=-1)).tzinfo
+            tzinfo=self._day_tzinfo[key]=first if first is last else None
+        if tzinfo is None:
+            return timezone.localize(naive)
+        return naive.replace(tzinfo=tzinfo)
+
+    def parse(self,start_date,time_str,day_offset,timezone=None):
+        minutes=self.minutes(time_str)
+        if minutes is None:
+            return None
+        naive=start_date+datetime.timedelta(days=day_offset-1,minutes=minutes)
+        if timezone is not None:
+            return self.localize(timezone,naive)
+        return naive
+
+STATION_FIELDNAMES=["train_id","station_code","station_nr","nr_of_stations",
+    "scheduled_arrival","actual_arrival","scheduled_departure",
+    "actual_departure","arrival_delay","departure_delay","delay"]
+TRAIN_FIELDNAMES=["train_id","nr_of_stations","origin_station_code",
+    "scheduled_departure","actual_departure",
+    "destination_station_code","scheduled_arrival",
+    "actual_arrival","delay"]
+TIMESTAMP_FIELDS={"scheduled_arrival","actual_arrival","scheduled_departure","actual_departure"}
+INT16_FIELDS={"station_nr","nr_of_stations","arrival_delay","departure_delay","delay"}
+CATEGORY_FIELDS={"train_id","station_code","origin_station_code","destination_station_code"}
+
+class _Record:
+    #Base of the compact record types. Records also behave like a read-only mapping
+    #(keys/get/[]), so they can be passed to csv.DictWriter like the dicts they replace.
+    __slots__=()
+
+    def keys(self):
+        return self._keys
+
+    def get(self,key,default=None):
+        return getattr(self,key,default) if key in self._keys else default
+
+    def __getitem__(self,key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self,key)
+
+    def values(self):
+        return [getattr(self,name) for name in self.__slots__]
+
+    def as_dict(self):
+        return dict(zip(self.__slots__,self.values()))
+
+    def __eq__(self,other):
+        return type(self) is type(other) and self.values()==other.values()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__,
+            ", ".join("{}={!r}".format(name,value) for name,value in self.as_dict().items()))
+
+class StationRecord(_Record):
+    #One stop of a train, the columns of stations.csv. Times are datetimes (localized if the
+    #timezone of any station of the train is known), delays are in minutes.
+    __slots__=tuple(STATION_FIELDNAMES)
+    _keys=dict.fromkeys(STATION_FIELDNAMES).keys()
+
+    def __init__(self,train_id:str,station_code:str=None,station_nr:int=None,
+            nr_of_stations:int=None,scheduled_arrival:datetime.datetime=None,
+            actual_arrival:datetime.datetime=None,scheduled_departure:datetime.datetime=None,
+            actual_departure:datetime.datetime=None,arrival_delay:int=None,
+            departure_delay:int=None,delay:int=None):
+        self.train_id=train_id
+        self.station_code=station_code
+        self.station_nr=station_nr
+        self.nr_of_stations=nr_of_stations
+        self.scheduled_arrival=scheduled_arrival
+        self.actual_arrival=actual_arrival
+        self.scheduled_departure=scheduled_departure
+        self.actual_departure=actual_departure
+        self.arrival_delay=arrival_delay
+        self.departure_delay=departure_delay
+        self.delay=delay
+
+class TrainRecord(_Record):
+    #Summary of one run of a train, the columns of trains.csv
+    __slots__=tuple(TRAIN_FIELDNAMES)
+    _keys=dict.fromkeys(TRAIN_FIELDNAMES).keys()
+
+    def __init__(self,train_id:str,nr_of_stations:int=None,origin_station_code:str=None,
+            scheduled_departure:datetime.datetime=None,actual_departure:datetime.datetime=None,
+            destination_station_code:str=None,scheduled_arrival:datetime.datetime=None,
+            actual_arrival:datetime.datetime=None,delay:int=None):
+        self.train_id=train_id
+        self.nr_of_stations=nr_of_stations
+        self.origin_station_code=origin_station_code
+        self.scheduled_departure=scheduled_departure
+        self.actual_departure=actual_departure
+        self.destination_station_code=destination_station_code
+        self.scheduled_arrival=scheduled_arrival
+        self.actual_arrival=actual_arrival
+        self.delay=delay
+
+class DatetimeFormatter:
+    #Formats datetimes exactly like str() does for the csv files. Calling str() on a pytz
+    #datetime goes through the python utcoffset of the tzinfo, here the date and offset
+    #part is cached per (tzinfo, day) and the time of day comes from a table.
+    max_cache_size=100000
+    _times=["%02d:%02d:00"%divmod(minute,60) for minute in range(24*60)]
+
+    def __init__(self):
+        self._days={}
+
+    def format(self,dt):
+        if dt.second or dt.microsecond:
+            return str(dt)
+        key=(dt.tzinfo,dt.toordinal())
+        parts=self._days.get(key)
+        if parts is None:
+            if len(self._days)>=self.max_cache_size:
+                self._days.clear()
+            text=str(dt)
+            parts=self._days[key]=(text[:11],text[19:])
+        return parts[0]+self._times[dt.hour*60+dt.minute]+parts[1]
+
+class BufferedCsvWriter:
+    #Drop-in for csv.DictWriter with the same output. Rows are collected as lists with
+    #preformatted timestamps and handed to the csv module in writerows batches.
+    
+    def __init__(self,f,fieldnames,buffer_size=10000,formatter=None):
+        #without f it only formats rows (see format_row)
+        self.writer=None if f is None else csv.writer(f)
+        self.fieldnames=fieldnames
+        self.buffer_size=buffer_size
+        self.formatter=formatter or DatetimeFormatter()
+        self._getter=itemgetter(*fieldnames)
+        self._attrgetter=attrgetter(*fieldnames)
+        self._timestamp_idx=[i for i,name in enumerate(fieldnames) if name in TIMESTAMP_FIELDS]
+        self.rows=[]
+
+    def writeheader(self):
+        self.flush()
+        self.writer.writerow(self.fieldnames)
+
+    def format_row(self,row):
+        #the values of a row as they are handed to the csv module
+        try:
+            if isinstance(row,_Record):
+                values=list(self._attrgetter(row))
+            else:
+                values=list(self._getter(row))
+        except (KeyError,AttributeError):
+            values=[row.get(name,"") for name in self.fieldnames]
+        format_datetime=self.formatter.format
+        for i in self._timestamp_idx:
+            value=values[i]
+            if value is not None and value!="":
+                values[i]=format_datetime(value)
+        return values
+
+    def writerow(self,row):
+        self.rows+=[self.format_row(row)]
+        if len(self.rows)>=self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.writerows(self.rows)
+            self.rows=[]
+
+class ParquetTableWriter:
+    #Drop-in for csv.DictWriter that writes typed columns to parquet. Rows are buffered
+    #column-wise and flushed as one row group every row_group_size rows, so memory stays
+    #bounded. The path is a directory, every conversion run adds a 'part-N.parquet' file
+    #to it (parquet files cannot be appended to), pandas/pyarrow read the directory as
+    #one dataset.
+    #Timestamps are stored as UTC. Trains without any station of known timezone only have
+    #naive times, those are stored as if they were UTC and flagged with localized=False.
+    
+    def __init__(self,path,fieldnames,initial=False,row_group_size=100000):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa=pyarrow
+        self.fieldnames=fieldnames
+        self.row_group_size=row_group_size
+        fields=[]
+        for name in fieldnames:
+            if name in TIMESTAMP_FIELDS:
+                fields+=[pyarrow.field(name,pyarrow.timestamp("s",tz="UTC"))]
+            elif name in INT16_FIELDS:
+                fields+=[pyarrow.field(name,pyarrow.int16())]
+            elif name in CATEGORY_FIELDS:
+                fields+=[pyarrow.field(name,pyarrow.dictionary(pyarrow.int32(),pyarrow.string()))]
+            else:
+                fields+=[pyarrow.field(name,pyarrow.string())]
+        fields+=[pyarrow.field("localized",pyarrow.bool_())]
+        self.schema=pyarrow.schema(fields)
+        os.makedirs(path,exist_ok=True)
+        parts=sorted(fn for fn in os.listdir(path) if fn.startswith("part-") and fn.endswith(".parquet"))
+        if initial:
+            for fn in parts:
+                os.remove(os.path.join(path,fn))
+            parts=[]
+        part_nr=int(parts[-1][5:-8])+1 if parts else 0
+        self.writer=pyarrow.parquet.ParquetWriter(os.path.join(path,"part-{:05d}.parquet".format(part_nr)),
+            self.schema)
+        self._reset_columns()
+
+    def _reset_columns(self):
+        self.columns={name:[] for name in self.fieldnames}
+        self.localized=[]
+
+    def writeheader(self):
+        pass
+
+    def writerow(self,row):
+        localized=True
+        for name,column in self.columns.items():
+            value=row.get(name)
+            if value is not None:
+                if name in TIMESTAMP_FIELDS:
+                    if value.tzinfo is None:
+                        localized=False
+                        value=value.replace(tzinfo=datetime.timezone.utc)
+                    value=int(value.timestamp())
+                elif name in INT16_FIELDS:
+                    if not -32768<=value<=32767:
+                        value=None #garbage from broken files, does not fit the column
+                elif name not in CATEGORY_FIELDS:
+                    value=str(value)
+            column+=[value]
+        self.localized+=[localized]
+        if len(self.localized)>=self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.localized)==0:
+            return
+        pa=self.pa
+        arrays=[]
+        for field in self.schema:
+            if field.name=="localized":
+                arrays+=[pa.array(self.localized,pa.bool_())]
+            elif pa.types.is_dictionary(field.type):
+                arrays+=[pa.array(self.columns[field.name],pa.string()).dictionary_encode()]
+            elif pa.types.is_timestamp(field.type):
+                arrays+=[pa.array(self.columns[field.name],pa.int64()).cast(field.type)]
+            else:
+                arrays+=[pa.array(self.columns[field.name],field.type)]
+        self.writer.write_table(pa.Table.from_arrays(arrays,schema=self.schema))
+        self._reset_columns()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+#the day of a record in RecordStore is the local date of the first of these that is known
+DAY_FIELDS=["scheduled_departure","scheduled_arrival","actual_departure","actual_arrival"]
+
+def _store_format(fieldnames):
+    #struct format of a RecordStore record: the fields followed by 'localized' and 'day'
+    codes=[]
+    for name in fieldnames:
+        if name in TIMESTAMP_FIELDS:
+            codes+=["q"] #seconds since the epoch (UTC), RecordStore.NULL_TIMESTAMP if unknown
+        elif name in INT16_FIELDS:
+            codes+=["h"] #RecordStore.NULL_INT16 if unknown
+        elif name in CATEGORY_FIELDS:
+            codes+=["I"] #id in the string dictionary, RecordStore.NULL_ID if unknown
+        else:
+            raise ValueError("No binary column type for '{}'".format(name))
+    return "<"+"".join(codes)+"Bi"
+
+def _group(keys,order,nr_keys):
+    #stable counting sort of the positions in order by keys[position], returns the offsets
+    #of every key and the grouped positions
+    offsets=[0]*(nr_keys+1)
+    for key in keys:
+        offsets[key+1]+=1
+    for key in range(nr_keys):
+        offsets[key+1]+=offsets[key]
+    fill=offsets[:-1]
+    positions=array("I",bytes(4*len(keys)))
+    for position in order:
+        key=keys[position]
+        positions[fill[key]]=position
+        fill[key]+=1
+    return array("Q",offsets),positions
+
+def _merge_runs(old_positions,old_days,new_positions,new_days,first):
+    #Pieces (positions, days) of a group of an index merged with the positions of appended
+    #records (relative to first, in order of their day). The appended records are behind all
+    #others, so they go behind the old ones of the same day, like in a full rebuild. Runs of
+    #old positions are handed out as slices, only the appended ones are looked at one by one.
+    lo=0
+    positions=array("I")
+    days=array("i")
+    for position in new_positions:
+        day=new_days[position]
+        hi=bisect_right(old_days,day,lo)
+        if hi>lo:
+            if positions:
+                yield positions,days
+                positions=array("I")
+                days=array("i")
+            yield old_positions[lo:hi],old_days[lo:hi]
+            lo=hi
+        positions.append(first+position)
+        days.append(day)
+    if positions:
+        yield positions,days
+    if lo<len(old_positions):
+        yield old_positions[lo:],old_days[lo:]
+
+def _write_merged(index_file,merged_offsets,ranges,old_positions,old_days,offsets,positions,days,first):
+    #positions and days of every group of an index, see _merge_runs
+    start=index_file.tell()
+    total=first+len(days)
+    for group,(lo,hi) in enumerate(ranges):
+        cursor=merged_offsets[group]
+        for piece_positions,piece_days in _merge_runs(old_positions[lo:hi],old_days[lo:hi],
+                positions[offsets[group]:offsets[group+1]],days,first):
+            index_file.seek(start+4*cursor)
+            index_file.write(piece_positions)
+            index_file.seek(start+4*(total+cursor))
+            index_file.write(piece_days)
+            cursor+=len(piece_positions)
+    index_file.truncate(start+8*total)
+
+class RecordStoreWriter:
+    #Drop-in for csv.DictWriter that appends fixed-width binary records (see _store_format)
+    #to <path>/records.bin. Strings are stored as ids of a dictionary that is kept in
+    #<path>/meta.json together with the layout. On close, the records appended since the last
+    #close are merged into the indexes by every category field and by day: the positions of
+    #all records grouped by key and sorted by day within each key, so RecordStore answers
+    #"train 90 in 2016" with a slice. Only the appended records are read, the old indexes are
+    #copied from a memory map. Timestamps are handled like in ParquetTableWriter.
+
+    def __init__(self,path,fieldnames,initial=False):
+        self.path=path
+        self.fieldnames=fieldnames
+        self.format=_store_format(fieldnames)
+        self.strings=[]
+        #(records, strings) covered by the indexes on disk
+        self.indexed=(0,0)
+        os.makedirs(path,exist_ok=True)
+        meta_path=os.path.join(path,"meta.json")
+        if not initial and os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta=json.load(meta_file)
+            if meta["fieldnames"]!=fieldnames:
+                raise ValueError("'{}' holds records with other fields".format(path))
+            self.strings=meta["strings"]
+            self.indexed=(meta["count"],len(self.strings))
+        self.string_ids={string:idx for idx,string in enumerate(self.strings)}
+        self.records=open(os.path.join(path,"records.bin"),"wb" if initial else "ab")
+        #the number of records is derived from the file, so a crash cannot get them out of step
+        self.records.seek(0,os.SEEK_END)
+        self._pack=struct.Struct(self.format).pack
+        self._kinds=[(name,"t" if name in TIMESTAMP_FIELDS else "c" if name in CATEGORY_FIELDS else "i")
+            for name in fieldnames]
+        self.rows=[]
+
+    def writeheader(self):
+        pass
+
+    def writerow(self,row):
+        localized=True
+        values=[]
+        for name,kind in self._kinds:
+            value=row.get(name)
+            if kind=="t":
+                if value is None:
+                    value=RecordStore.NULL_TIMESTAMP
+                else:
+                    if value.tzinfo is None:
+                        localized=False
+                        value=value.replace(tzinfo=datetime.timezone.utc)
+                    value=int(value.timestamp())
+            elif kind=="c":
+                if value is None:
+                    value=RecordStore.NULL_ID
+                else:
+                    idx=self.string_ids.get(value)
+                    if idx is None:
+                        idx=self.string_ids[value]=len(self.strings)
+                        self.strings+=[value]
+                    value=idx
+            elif value is None or not -32767<=value<=32767:
+                value=RecordStore.NULL_INT16
+            values+=[value]
+        day=0
+        for name in DAY_FIELDS:
+            value=row.get(name)
+            if value is not None:
+                day=value.toordinal()
+                break
+        self.rows+=[self._pack(*values,localized,day)]
+        if len(self.rows)>=10000:
+            self.flush()
+
+    def flush(self):
+        self.records.write(b"".join(self.rows))
+        self.rows=[]
+
+    def close(self):
+        self.flush()
+        self.records.close()
+        record_size=struct.calcsize(self.format)
+        count=os.path.getsize(os.path.join(self.path,"records.bin"))//record_size
+        fields=[(name,idx) for idx,name in enumerate(self.fieldnames) if name in CATEGORY_FIELDS]
+        names=["day"]+[name for name,__ in fields]
+        first,nr_strings=self.indexed
+        if not all(self._index_count(name)==first for name in names):
+            #no (or an interrupted) earlier close, the indexes are built from scratch
+            first,nr_strings=0,0
+        with open(os.path.join(self.path,"records.bin"),"rb") as records:
+            records.seek(first*record_size)
+            data=records.read((count-first)*record_size)
+        keys={name:array("I") for name,__ in fields}
+        days=array("i")
+        day_idx=len(self.fieldnames)+1
+        for values in struct.iter_unpack(self.format,data):
+            days.append(values[day_idx])
+            for name,idx in fields:
+                keys[name].append(values[idx])
+        del data
+        first_day=min(days,default=0)
+        __,by_day=_group(array("I",(day-first_day for day in days)),range(len(days)),
+            max(days,default=0)-first_day+1)
+        self._merge_index("day",array("Q",[0,len(days)]),by_day,days,first,lambda group:0)
+        nr_keys=len(self.strings)
+        #old groups of the new ones: strings added since keep their id, the unknown values
+        #(NULL_ID) are one more group behind the last string
+        old_group=lambda group:(group if group<nr_strings else nr_strings if group==nr_keys else None)
+        for name,__ in fields:
+            field_keys=array("I",(min(key,nr_keys) for key in keys[name]))
+            offsets,positions=_group(field_keys,by_day,nr_keys+1)
+            self._merge_index(name,offsets,positions,days,first,old_group)
+        meta={"version":1,"fieldnames":self.fieldnames,"format":self.format,"count":count,
+            "strings":self.strings,"indexes":names}
+        with open(os.path.join(self.path,"meta.json.tmp"),"w") as meta_file:
+            json.dump(meta,meta_file)
+        os.replace(os.path.join(self.path,"meta.json.tmp"),os.path.join(self.path,"meta.json"))
+        self.indexed=(count,len(self.strings))
+
+    def _index_count(self,name):
+        #number of positions in index-<name>.bin, None if there is none
+        try:
+            with open(os.path.join(self.path,"index-{}.bin".format(name)),"rb") as index_file:
+                nr_offsets=struct.unpack("<Q",index_file.read(8))[0]
+                index_file.seek(8*nr_offsets)
+                return struct.unpack("<Q",index_file.read(8))[0]
+        except (OSError,struct.error):
+            return None
+
+    def _merge_index(self,name,offsets,positions,days,first,old_group):
+        #index-<name>.bin: the number of offsets, the offsets, the positions and their days.
+        #offsets and positions group the records from first on, they are merged into the
+        #groups of the first records already in the file (old_group maps a group to its old
+        #one, None for new groups). The file is replaced once complete, readers that have the
+        #old one mapped keep it.
+        path=os.path.join(self.path,"index-{}.bin".format(name))
+        old=[array("Q",[0,0]),memoryview(array("I")),memoryview(array("i"))]
+        mapped=None
+        if first:
+            with open(path,"rb") as index_file:
+                mapped=mmap.mmap(index_file.fileno(),0,access=mmap.ACCESS_READ)
+            view=memoryview(mapped)
+            nr_offsets=struct.unpack_from("<Q",view)[0]
+            start=8+8*nr_offsets
+            old=[view[8:start].cast("Q"),view[start:start+4*first].cast("I"),
+                view[start+4*first:start+8*first].cast("i")]
+        old_offsets,old_positions,old_days=old
+        ranges=[]
+        merged_offsets=array("Q",[0])
+        for group in range(len(offsets)-1):
+            old_idx=old_group(group) if first else None
+            lo,hi=(0,0) if old_idx is None else (old_offsets[old_idx],old_offsets[old_idx+1])
+            ranges+=[(lo,hi)]
+            merged_offsets.append(merged_offsets[-1]+hi-lo+offsets[group+1]-offsets[group])
+        try:
+            with open(path+".tmp","wb") as index_file:
+                index_file.write(struct.pack("<Q",len(merged_offsets)))
+                index_file.write(merged_offsets.tobytes())
+                _write_merged(index_file,merged_offsets,ranges,old_positions,old_days,offsets,
+                    positions,days,first)
+        finally:
+            if mapped is not None:
+                for old_view in old+[view]:
+                    old_view.release()
+                mapped.close()
+        os.replace(path+".tmp",path)
+
+class RecordStore:
+    #Read access to a directory written by RecordStoreWriter (output_format="store"). The
+    #records and indexes are memory-mapped, select() returns the positions of the matching
+    #records as a memoryview into an index (no copy, no scan) when at most one key is given.
+    #   store=RecordStore("stations")
+    #   rows=[store[position] for position in store.select(train_id="90",start=date(2016,1,1),
+    #       end=date(2017,1,1))]
+    NULL_TIMESTAMP=-2**63
+    NULL_INT16=-2**15
+    NULL_ID=2**32-1
+
+    def __init__(self,path):
+        with open(os.path.join(path,"meta.json")) as meta_file:
+            meta=json.load(meta_file)
+        self.path=path
+        self.fieldnames=meta["fieldnames"]
+        self.strings=meta["strings"]
+        self.string_ids={string:idx for idx,string in enumerate(self.strings)}
+        self._struct=struct.Struct(meta["format"])
+        self.count=meta["count"]
+        self._maps=[]
+        self.records=self._map("records.bin")[:self.count*self._struct.size]
+        self.indexes={name:self._load_index(name) for name in meta["indexes"]}
+
+    def _map(self,name):
+        with open(os.path.join(self.path,name),"rb") as f:
+            if os.fstat(f.fileno()).st_size==0:
+                return memoryview(b"")
+            mapped=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        view=memoryview(mapped)
+        self._maps+=[(mapped,view)]
+        return view
+
+    def _load_index(self,name):
+        data=self._map("index-{}.bin".format(name))
+        nr_offsets=struct.unpack_from("<Q",data)[0]
+        start=8+8*nr_offsets
+        offsets=data[8:start].cast("Q")
+        positions=data[start:start+4*self.count].cast("I")
+        days=data[start+4*self.count:start+8*self.count].cast("i")
+        return offsets,positions,days
+
+    def close(self):
+        for view in [self.records]+[view for index in self.indexes.values() for view in index]:
+            view.release()
+        for mapped,view in self._maps:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                pass #positions returned by select are still in use, unmapped once they are gone
+        self._maps=[]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def raw(self,position):
+        #the undecoded values of a record: ids, epoch seconds and null markers as stored
+        return self._struct.unpack_from(self.records,position*self._struct.size)
+
+    def __getitem__(self,position):
+        if not 0<=position<self.count:
+            raise IndexError(position)
+        values=self.raw(position)
+        localized=values[-2]
+        row={}
+        for name,value in zip(self.fieldnames,values):
+            if name in TIMESTAMP_FIELDS:
+                if value==self.NULL_TIMESTAMP:
+                    value=None
+                elif localized:
+                    value=datetime.datetime.fromtimestamp(value,datetime.timezone.utc)
+                else:
+                    value=datetime.datetime(1970,1,1)+datetime.timedelta(seconds=value)
+            elif name in CATEGORY_FIELDS:
+                value=None if value==self.NULL_ID else self.strings[value]
+            elif value==self.NULL_INT16:
+                value=None
+            row[name]=value
+        row["localized"]=bool(localized)
+        return row
+
+    def _days(self,days,start,end):
+        #the slice of an ascending days view between the dates start (inclusive) and end
+        lo=0 if start is None else bisect_left(days,start.toordinal())
+        hi=len(days) if end is None else bisect_left(days,end.toordinal())
+        return lo,max(lo,hi)
+
+    def select(self,start=None,end=None,**keys):
+        #positions of the records whose fields have the given values (e.g. train_id="90") and
+        #whose day is in [start, end), in order of their day
+        selected=[]
+        for name,value in keys.items():
+            if name not in self.indexes:
+                raise KeyError("'{}' is not indexed".format(name))
+            offsets,positions,days=self.indexes[name]
+            idx=self.string_ids.get(value)
+            if idx is None:
+                return memoryview(array("I"))
+            positions=positions[offsets[idx]:offsets[idx+1]]
+            days=days[offsets[idx]:offsets[idx+1]]
+            lo,hi=self._days(days,start,end)
+            selected+=[positions[lo:hi]]
+        if not selected:
+            __,positions,days=self.indexes["day"]
+            lo,hi=self._days(days,start,end)
+            return positions[lo:hi]
+        selected.sort(key=len)
+        if len(selected)==1:
+            return selected[0]
+        others=[set(positions) for positions in selected[1:]]
+        return memoryview(array("I",(position for position in selected[0]
+            if all(position in other for other in others))))
+
+    def rows(self,positions):
+        for position in positions:
+            yield self[position]
+
+    def counts(self,name):
+        #number of records per value of an indexed field, straight from the index offsets
+        offsets=self.indexes[name][0]
+        return {string:offsets[idx+1]-offsets[idx] for idx,string in enumerate(self.strings)
+            if offsets[idx+1]>offsets[idx]}
+
+    def as_numpy(self):
+        #all records as a numpy structured array on top of the mapped file (needs numpy)
+        import numpy
+        dtype=[]
+        for name,code in zip(self.fieldnames+["localized","day"],self._struct.format[1:]):
+            dtype+=[(name,"<"+{"q":"i8","h":"i2","I":"u4","B":"u1","i":"i4"}[code])]
+        return numpy.frombuffer(self.records,dtype=numpy.dtype(dtype),count=self.count)
+
+def _partition(row):
+    #year=YYYY/month=MM of the local date of a row (see DAY_FIELDS)
+    for name in DAY_FIELDS:
+        value=row.get(name)
+        if value is not None:
+            return "year={:04d}/month={:02d}".format(value.year,value.month)
+    return "year=unknown/month=unknown"
+
+def _shard(train_id,shards):
+    return zlib.crc32(train_id.encode())%shards
+
+class PartitionedCsvWriter:
+    #Drop-in for csv.DictWriter that spreads the rows over csv files
+    #<path>/year=YYYY/month=MM/part-N.csv: the month of the local date of the row (see
+    #DAY_FIELDS) and N the crc32 of the train_id modulo shards, so all rows of a train and
+    #month are in one file. <path>/_partitions.json has the number of rows and the first and
+    #last timestamp (seconds since the epoch, naive times taken as UTC) of every file,
+    #read_partitioned uses it to skip files. Rows are buffered and appended to their files in
+    #batches, so the number of partitions does not matter for open file handles.
+    METADATA="_partitions.json"
+
+    def __init__(self,path,fieldnames,initial=False,shards=4,buffer_size=10000,formatter=None):
+        self.path=path
+        self.fieldnames=fieldnames
+        self.shards=shards
+        self.buffer_size=buffer_size
+        self.row_formatter=BufferedCsvWriter(None,fieldnames,formatter=formatter)
+        self._timestamps=[name for name in fieldnames if name in TIMESTAMP_FIELDS]
+        self.files={}
+        os.makedirs(path,exist_ok=True)
+        metadata=read_partition_metadata(path)
+        if metadata is not None:
+            if initial:
+                #only what an earlier run wrote is removed
+                for relative in metadata["files"]:
+                    if os.path.exists(os.path.join(path,relative)):
+                        os.remove(os.path.join(path,relative))
+            elif metadata["fieldnames"]!=fieldnames or metadata["shards"]!=shards:
+                raise ValueError("'{}' holds other fields or shards".format(path))
+            else:
+                self.files=metadata["files"]
+        self.buffers={}
+        self.buffered=0
+
+    def writeheader(self):
+        pass
+
+    def writerow(self,row):
+        relative="{}/part-{:03d}.csv".format(_partition(row),_shard(row.get("train_id") or "",self.shards))
+        info=self.files.get(relative)
+        if info is None:
+            info=self.files[relative]={"rows":0,"min_timestamp":None,"max_timestamp":None}
+        info["rows"]+=1
+        for name in self._timestamps:
+            value=row.get(name)
+            if value is not None:
+                if value.tzinfo is None:
+                    value=value.replace(tzinfo=datetime.timezone.utc)
+                value=int(value.timestamp())
+                if info["min_timestamp"] is None or value<info["min_timestamp"]:
+                    info["min_timestamp"]=value
+                if info["max_timestamp"] is None or value>info["max_timestamp"]:
+                    info["max_timestamp"]=value
+        self.buffers.setdefault(relative,[]).append(self.row_formatter.format_row(row))
+        self.buffered+=1
+        if self.buffered>=self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for relative,rows in self.buffers.items():
+            filename=os.path.join(self.path,relative)
+            new=not os.path.exists(filename)
+            if new:
+                os.makedirs(os.path.dirname(filename),exist_ok=True)
+            with open(filename,"a") as f:
+                writer=csv.writer(f)
+                if new:
+                    writer.writerow(self.fieldnames)
+                writer.writerows(rows)
+        self.buffers={}
+        self.buffered=0
+        metadata={"version":1,"fieldnames":self.fieldnames,"shards":self.shards,"files":self.files}
+        metadata_path=os.path.join(self.path,self.METADATA)
+        with open(metadata_path+".tmp","w") as metadata_file:
+            json.dump(metadata,metadata_file,indent=1,sort_keys=True)
+        os.replace(metadata_path+".tmp",metadata_path)
+
+    def close(self):
+        self.flush()
+
+def read_partition_metadata(path):
+    metadata_path=os.path.join(path,PartitionedCsvWriter.METADATA)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path) as metadata_file:
+        return json.load(metadata_file)
+
+def read_partitioned(path,start=None,end=None,train_ids=None,workers=None):
+    #Rows of a directory written with output_format="partitioned" whose local date is in
+    #[start, end) (datetime.date) and, if given, whose train_id is in train_ids, as a list of
+    #dicts with string values like csv.DictReader. Months and shards that cannot hold such
+    #rows are not read at all, the others are read by a pool of worker processes.
+    __,tasks=_partition_tasks(path,start,end,train_ids)
+    return [row for part in _read_parts(_read_part,tasks,workers) for row in part]
+
+def read_partitioned_frame(path,start=None,end=None,train_ids=None,workers=None):
+    #read_partitioned as a pandas DataFrame, timestamps are left as strings like in the csv
+    #files
+    import pandas
+    metadata,tasks=_partition_tasks(path,start,end,train_ids)
+    parts=_read_parts(_read_part_frame,tasks,workers)
+    if not parts:
+        return pandas.DataFrame(columns=metadata["fieldnames"])
+    return pandas.concat(parts,ignore_index=True)
+
+def _partition_tasks(path,start,end,train_ids):
+    #the metadata of the directory and a task per file that can hold rows of the selection
+    metadata=read_partition_metadata(path)
+    if metadata is None:
+        raise ValueError("'{}' is not a partitioned output directory".format(path))
+    shards=None
+    if train_ids is not None:
+        train_ids=set(train_ids)
+        shards={_shard(train_id,metadata["shards"]) for train_id in train_ids}
+    first=None if start is None else "year={:04d}/month={:02d}".format(start.year,start.month)
+    #end itself is exclusive
+    last_day=None if end is None else end-datetime.timedelta(days=1)
+    last=None if end is None else "year={:04d}/month={:02d}".format(last_day.year,last_day.month)
+    tasks=[]
+    for relative,info in sorted(metadata["files"].items()):
+        partition=os.path.dirname(relative)
+        if info["rows"]==0:
+            continue
+        if partition.startswith("year=unknown"):
+            if start is not None or end is not None:
+                continue
+        elif (first is not None and partition<first) or (last is not None and partition>last):
+            continue
+        if shards is not None and int(os.path.basename(relative)[5:-4]) not in shards:
+            continue
+        tasks+=[(os.path.join(path,relative),None if start is None else start.isoformat(),
+            None if end is None else end.isoformat(),train_ids,metadata["fieldnames"])]
+    return metadata,tasks
+
+def _read_parts(read,tasks,workers):
+    if workers==1 or len(tasks)<=1:
+        return [read(task) for task in tasks]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(read,tasks))
+
+def _read_part(task):
+    #one file for read_partitioned, rows are filtered by the date of the local time (the
+    #first 10 characters of the timestamp) and the train_id
+    filename,start,end,train_ids,fieldnames=task
+    day_fields=[name for name in DAY_FIELDS if name in fieldnames]
+    rows=[]
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            if train_ids is not None and row["train_id"] not in train_ids:
+                continue
+            if start is not None or end is not None:
+                day=next((row[name][:10] for name in day_fields if row[name]),None)
+                if day is None or (start is not None and day<start) or (end is not None and day>=end):
+                    continue
+            rows+=[row]
+    return rows
+
+def _read_part_frame(task):
+    #_read_part for read_partitioned_frame
+    import pandas
+    filename,start,end,train_ids,fieldnames=task
+    day_fields=[name for name in DAY_FIELDS if name in fieldnames]
+    frame=pandas.read_csv(filename,dtype={name:str for name in fieldnames if name in CATEGORY_FIELDS})
+    keep=pandas.Series(True,index=frame.index)
+    if train_ids is not None:
+        keep&=frame["train_id"].isin(train_ids)
+    if start is not None or end is not None:
+        day=pandas.Series(None,index=frame.index,dtype=object)
+        for name in reversed(day_fields):
+            day=frame[name].where(frame[name].notna(),day)
+        day=day.str[:10]
+        if start is not None:
+            keep&=(day>=start).fillna(False)
+        if end is not None:
+            keep&=(day<end).fillna(False)
+    return frame[keep]
+
+def _scan_comment(comment):
+    #returns the (Arrived|Departed, minutes) clauses of a comment and the rest of the comment
+    #for every clause whose delay could not be read
+    ret=[]
+    unparsable=[]
+    pos=0
+    while pos<len(comment):
+        m=COMMENT_RE.match(comment,pos)
+        if m is None:
+            break
+        if m.group(3)=="on time":
+            ret+=[(m.group(1),0)]
+        else:
+            time_m=COMMENT_DELAY_RE.match(m.group(2))
+            sign=1 if m.group(3)=="late" else -1
+            if time_m is not None:
+                hour=int(time_m.group(2) or 0)
+                minute=int(time_m.group(4) or 0)
+                ret+=[(m.group(1),sign*(hour*60+minute))]
+            else:
+                unparsable+=[comment[pos:]]
+        pos=m.end()
+    return tuple(ret),tuple(unparsable)
+
+class DelayAggregates:
+    #Mergeable delay statistics of the trains per train_id, destination_station_code and
+    #calendar dimensions of the scheduled departure (local time) and arrival, kept up to date
+    #during the conversion. Every cell is [trains, trains with delay, sum, sum of squares,
+    #30min, 1h, 3h, 6h, cancelled] with the buckets of the notebook: 30<=delay<60, 60<=delay<180,
+    #180<=delay<360, delay>=360 and no delay known (cancelled).
+    DIMENSIONS=["train_id","destination_station_code","weekday","arrival_weekday","month","week",
+        "day_of_year","year"]
+    BUCKETS=["30min","1h","3h","6h","cancelled"]
+    #dimensions with integer keys
+    CALENDAR=DIMENSIONS[2:]
+
+    def __init__(self):
+        self.cells={dimension:{} for dimension in self.DIMENSIONS}
+
+    def _add(self,dimension,key,delay):
+        cell=self.cells[dimension].get(key)
+        if cell is None:
+            cell=self.cells[dimension][key]=[0]*9
+        cell[0]+=1
+        if delay is None:
+            cell[8]+=1
+            return
+        cell[1]+=1
+        cell[2]+=delay
+        cell[3]+=delay*delay
+        if delay>=30:
+            cell[4 if delay<60 else 5 if delay<180 else 6 if delay<360 else 7]+=1
+
+    def add(self,train):
+        delay=train.get("delay")
+        for dimension in ["train_id","destination_station_code"]:
+            key=train.get(dimension)
+            if key is not None:
+                self._add(dimension,key,delay)
+        departure=train.get("scheduled_departure")
+        if departure is not None:
+            self._add("weekday",departure.weekday(),delay)
+            self._add("month",departure.month,delay)
+            self._add("week",departure.isocalendar()[1],delay)
+            self._add("day_of_year",departure.timetuple().tm_yday,delay)
+            self._add("year",departure.year,delay)
+        arrival=train.get("scheduled_arrival")
+        if arrival is not None:
+            self._add("arrival_weekday",arrival.weekday(),delay)
+
+    def merge(self,other):
+        for dimension,cells in other.cells.items():
+            for key,values in cells.items():
+                cell=self.cells[dimension].setdefault(key,[0]*9)
+                for idx,value in enumerate(values):
+                    cell[idx]+=value
+
+    def count(self,dimension):
+        return {key:cell[0] for key,cell in self.cells[dimension].items()}
+
+    def mean(self,dimension):
+        return {key:cell[2]/cell[1] for key,cell in self.cells[dimension].items() if cell[1]}
+
+    def std(self,dimension):
+        #sample standard deviation like pandas, for keys with at least two delays
+        ret={}
+        for key,(__,n,total,squares,*__) in self.cells[dimension].items():
+            if n>1:
+                ret[key]=math.sqrt(max(0,squares-total*total/n)/(n-1))
+        return ret
+
+    def bucket_rates(self,dimension):
+        #share of the trains in every bucket, plus long_delay_or_cancelled (delay>=30 or none)
+        ret={}
+        for key,cell in self.cells[dimension].items():
+            rates=dict(zip(self.BUCKETS,(value/cell[0] for value in cell[4:])))
+            rates["long_delay_or_cancelled"]=sum(cell[4:])/cell[0]
+            ret[key]=rates
+        return ret
+
+    def as_dict(self):
+        return {"version":1,"cells":{dimension:{str(key):cell for key,cell in cells.items()}
+            for dimension,cells in self.cells.items()}}
+
+    @classmethod
+    def from_dict(cls,data):
+        aggregates=cls()
+        for dimension,cells in data["cells"].items():
+            convert=int if dimension in cls.CALENDAR else str
+            aggregates.cells[dimension]={convert(key):list(cell) for key,cell in cells.items()}
+        return aggregates
+
+    @classmethod
+    def load(cls,path):
+        with open(path) as aggregates_file:
+            return cls.from_dict(json.load(aggregates_file))
+
+    def save(self,path):
+        with open(path+".tmp","w") as aggregates_file:
+            json.dump(self.as_dict(),aggregates_file)
+        os.replace(path+".tmp",path)
+
+class ConversionStats:
+    #Counters per anomaly kind ("double-file", "missing-v-line", ...), per stage timers
+    #(only collected when timing is on) and the throughput of every converted archive
+    def __init__(self,timing=False):
+        self.timing=timing
+        self.anomalies={}
+        self.timers={}
+        self.archives=[]
+        #name -> [hits, misses]
+        self.caches={}
+
+    def count(self,kind,n=1):
+        self.anomalies[kind]=self.anomalies.get(kind,0)+n
+
+    def add_time(self,stage,seconds):
+        self.timers[stage]=self.timers.get(stage,0.0)+seconds
+
+    def add_cache(self,name,hits,misses):
+        counts=self.caches.setdefault(name,[0,0])
+        counts[0]+=hits
+        counts[1]+=misses
+
+    def hit_rate(self,name):
+        hits,misses=self.caches.get(name,(0,0))
+        return hits/(hits+misses) if hits+misses else 0.0
+
+    def add_archive(self,filename,files,stations,seconds):
+        self.archives+=[{"archive":filename,"files":files,"stations":stations,
+            "seconds":seconds,"files_per_second":files/seconds if seconds>0 else 0.0}]
+
+    def merge(self,other):
+        #other is the as_dict() of another instance, e.g. sent back by a worker process
+        for kind,n in other["anomalies"].items():
+            self.count(kind,n)
+        for stage,seconds in other["timers"].items():
+            self.add_time(stage,seconds)
+        self.archives+=other["archives"]
+        for name,(hits,misses) in other["caches"].items():
+            self.add_cache(name,hits,misses)
+
+    def as_dict(self):
+        return {"anomalies":dict(self.anomalies),"timers":dict(self.timers),
+            "archives":list(self.archives),
+            "caches":{name:list(counts) for name,counts in self.caches.items()}}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(),indent=2,sort_keys=True)
+
+    def to_prometheus(self,prefix="amtrak_converter"):
+        #plain text exposition format, ready for the node exporter textfile collector
+        lines=["# TYPE {}_anomalies_total counter".format(prefix)]
+        for kind,n in sorted(self.anomalies.items()):
+            lines+=['{}_anomalies_total{{kind="{}"}} {}'.format(prefix,kind,n)]
+        lines+=["# TYPE {}_stage_seconds_total counter".format(prefix)]
+        for stage,seconds in sorted(self.timers.items()):
+            lines+=['{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix,stage,seconds)]
+        lines+=["# TYPE {}_cache_hits_total counter".format(prefix),
+            "# TYPE {}_cache_misses_total counter".format(prefix)]
+        for name,(hits,misses) in sorted(self.caches.items()):
+            lines+=['{}_cache_hits_total{{cache="{}"}} {}'.format(prefix,name,hits),
+                '{}_cache_misses_total{{cache="{}"}} {}'.format(prefix,name,misses)]
+        lines+=["# TYPE {}_archive_files gauge".format(prefix),
+            "# TYPE {}_archive_seconds gauge".format(prefix)]
+        for archive in self.archives:
+            label=archive["archive"].replace("\\","\\\\").replace('"','\\"')
+            lines+=['{}_archive_files{{archive="{}"}} {}'.format(prefix,label,archive["files"]),
+                '{}_archive_seconds{{archive="{}"}} {}'.format(prefix,label,archive["seconds"])]
+        return "\n".join(lines)+"\n"
+
+class _RowCollector:
+    #stands in for the output writers in worker processes, the rows are written by the parent
+    def __init__(self):
+        self.rows=[]
+
+    def writerow(self,row):
+        self.rows+=[row]
 
 class DatasetWriter:
     
-    def __init__(self,csv_train,csv_station,csv_code_timezone="stations_timezone.csv"):
+    def __init__(self,csv_train,csv_station,csv_code_timezone="stations_timezone.csv",
+            max_memory=64*1024*1024,manifest=None,output_format="csv",row_group_size=100000,
+            buffer_size=10000,quiet=False,timing=False,profiler=None,timezone_cache=None,
+            deduplicate=True,comment_cache_size=4096,aggregates=None,shards=4,timezones=None,
+            max_file_size=None):
         self.csv_train=csv_train
         self.csv_train_writer=None
         self.csv_station=csv_station
         self.csv_station_writer=None
+        self.csv_code_timezone=csv_code_timezone
+        #nested archives larger than this are spilled to a temporary file instead of
+        #being kept in memory
+        self.max_memory=max_memory
+        #train files larger than this many bytes are skipped, None converts all of them
+        self.max_file_size=max_file_size
+        #incremental mode: path of a json file that maps every converted archive member
+        #to its [size,crc], members that did not change since the last run are skipped
+        self.manifest_path=manifest
+        #"csv" writes csv_train/csv_station as csv files, "parquet" uses them as directories
+        #of typed parquet files (see ParquetTableWriter), "store" as directories of memory-mapped
+        #binary records with indexes (see RecordStoreWriter and RecordStore)
+        #"partitioned" writes directories of csv files by month and train_id shard (see
+        #PartitionedCsvWriter and read_partitioned)
+        if output_format not in ("csv","parquet","store","partitioned"):
+            raise ValueError("Unknown output format '{}'".format(output_format))
+        self.output_format=output_format
+        self.row_group_size=row_group_size
+        self.shards=shards
+        #number of csv rows that are collected before they are written in one batch
+        self.buffer_size=buffer_size
+        self.datetime_formatter=DatetimeFormatter()
+        #quiet: anomalies are only counted in self.stats, not printed
+        #timing: the read/parse/write stages are timed, off by default to keep the hot path lean
+        #profiler: True for a cProfile.Profile or any object with enable()/disable() (e.g. a
+        #sampling profiler), it is only active while a train file is handled
+        self.quiet=quiet
+        self.stats=ConversionStats(timing)
+        if profiler is True:
+            import cProfile
+            profiler=cProfile.Profile()
+        self.profiler=profiler
+        #the manifest maps the path of every converted archive to {member:[size,crc]}, members
+        #are looked up in previous_manifest (as loaded, without the entries of this run) and
+        #recorded in manifest. archive_* are the parts of the archive being converted.
+        self.manifest=None
+        self.previous_manifest=None
+        self.archive_manifest=None
+        self.archive_previous=None
+        self.manifest_added=[]
+        #path of a json file with the DelayAggregates of all trains in the output, updated
+        #(or started again for initial conversions) by every conversion
+        self.aggregates_path=aggregates
+        self.aggregates=None
+        self.last_train=None
+        #overlapping yearly archives contain the same train/date files, only the first one
+        #is converted. seen_files maps the base name of every converted file to its crc.
+        self.deduplicate=deduplicate
+        self.seen_files={}
+        #worker processes leave deduplication to the parent and record for every train file
+        #the rows and counters it produced, see _drop_duplicates
+        self.file_spans=None
+        self.rows_written=[0,0]
+        #the same few comments ("Departed:  On time.") make up most of the stations
+        self._scan_comment=lru_cache(maxsize=comment_cache_size)(_scan_comment)
+        self._comment_cache_counts=(0,0)
         self.current_fn=None
         self.success_train=0
         self.number_train=0
         self.success_station=0
         self.number_station=0
+        self.skipped=0
         
-        self.station_writer_fieldnames=["train_id","station_code","station_nr","nr_of_stations",
-                    "scheduled_arrival","actual_arrival","scheduled_departure",
-                    "actual_departure","arrival_delay","departure_delay","delay"]
-                    
-        self.train_writer_fieldnames=["train_id","nr_of_stations","origin_station_code",
-                    "scheduled_departure","actual_departure",
-                    "destination_station_code","scheduled_arrival",
-                    "actual_arrival","delay"]
+        self.station_writer_fieldnames=list(STATION_FIELDNAMES)
+        self.train_writer_fieldnames=list(TRAIN_FIELDNAMES)
         
-        self.code_to_timezone={}
-        timezones={
-        "EST": pytz.timezone("America/New_York"),
-        "CST": pytz.timezone("America/Chicago"),
-        "MST": pytz.timezone("America/Denver"),
-        "PST": pytz.timezone("America/Los_Angeles"),
-        "MST/Arizona": pytz.timezone("America/Phoenix"),
-        }
-        with open(csv_code_timezone) as csv_code_tz:
-            code_reader=csv.DictReader(csv_code_tz)
-            for row in code_reader:
-                tz=row["timezone"]
-                if tz in timezones:
-                    self.code_to_timezone[row["code"]]=timezones[tz]
-        #print(self.code_to_timezone)
+        self.time_parser=TimeParser()
+        #station code -> ZoneOffsets, optionally kept in a binary cache file next to the csv.
+        #It is loaded when the first train is parsed, so writers that never parse one do not
+        #need the csv. timezones is a prebuilt TimezoneIndex, or a mapping of station code to
+        #ZoneOffsets or pytz timezone, that is used instead.
+        self.timezone_cache=timezone_cache
+        if timezones is not None and not isinstance(timezones,TimezoneIndex):
+            timezones=TimezoneIndex(dict(timezones),{zone.name:zone for zone in timezones.values()
+                if type(zone) is ZoneOffsets})
+        self.timezones=timezones
+        self._timezone_index=timezones
+
+    @property
+    def timezone_index(self):
+        if self._timezone_index is None:
+            if self.timezone_cache is None:
+                self._timezone_index=TimezoneIndex.from_csv(self.csv_code_timezone)
+            else:
+                self._timezone_index=TimezoneIndex.cached(self.csv_code_timezone,self.timezone_cache)
+        return self._timezone_index
 
+    @property
+    def code_to_timezone(self):
+        return self.timezone_index.codes
         
     def _parse_time(self,start_date,time_str,day_offset,timezone=None):
-        try:
-            time1=datetime.datetime.strptime((time_str+"M").rjust(6,"0"),"%I%M%p")
-            diff=time1-datetime.datetime(1900,1,1)
-            if timezone is not None:
-                return timezone.localize(start_date+diff+datetime.timedelta(days=day_offset-1))
-            return (start_date+diff+datetime.timedelta(days=day_offset-1))
-        except ValueError as ve:
-            #print(self.current_fn)
-            #print(ve)
-            return None
+        return self.time_parser.parse(start_date,time_str,day_offset,timezone)
         
     def _delay_based_adj(self,delay_seconds):
         if delay_seconds<-4*3600:
@@ -69,44 +1460,34 @@ class DatasetWriter:
         return datetime.timedelta()
         
     def _parse_comment(self,comment):
-        ret=[]
-        while len(comment)>0:
-            m=re.match(r"[^A-Za-z]*(Arrived|Departed):? ([^|]*?)([oO]n time|late|early)(.*)$",comment)
-            if m is not None:
-                if m.group(3)=="on time":
-                    ret+=[(m.group(1),0)]
-                else:
-                    #print(m.group(2))
-                    time_m=re.match(r"\D*((\d+) [hH]our)?\D*((\d+) [mM]in)?\D*$",m.group(2))
-                    #print(time_m.groups())
-                    sign=1 if m.group(3)=="late" else -1
-                    if time_m is not None:
-                        hour=int(time_m.group(2) or 0)
-                        minute=int(time_m.group(4) or 0)
-                        ret+=[(m.group(1),sign*(hour*60+minute))]
-                    else:
-                        print("Cannot parse '{}'".format(comment))
-                comment=m.group(4)
-            else:
-                break
-        return ret
-    
-    def _handle_txt_file(self,txt_file,file_name):
+        ret,unparsable=self._scan_comment(comment)
+        for rest in unparsable:
+            self._report("unparsable-comment","Cannot parse '{}'".format(rest))
+        return list(ret)
 
+    def _record_cache_stats(self):
+        info=self._scan_comment.cache_info()
+        hits,misses=self._comment_cache_counts
+        self.stats.add_cache("comment",info.hits-hits,info.misses-misses)
+        self._comment_cache_counts=(info.hits,info.misses)
+    
+    def _parse_txt_file(self,txt_file,file_name):
+        #returns (TrainRecord,[StationRecord]) or None if the file could not be used
+        #(outside of the try, a missing timezone csv is not a problem of this file)
+        code_to_timezone=self.code_to_timezone
         try:
             self.number_train+=1
             #print(file_name)
             self.current_fn=file_name
             text=txt_file.read().decode()
             if len(text)==0:
-                print("empty file")
-                print(file_name)
+                self._report("empty-file","empty file",file_name)
                 return
-            if text[:len(text)//4].strip()==text[len(text)//2:][:len(text)//4].strip():
+            quarter=len(text)//4
+            if text[:quarter].strip()==text[len(text)//2:len(text)//2+quarter].strip():
                 #in rare occasions the file is containing an additional copy of the data
                 text=text[:len(text)//2]
-                print("double-file")
-                print(file_name)
+                self._report("double-file","double-file",file_name)
             text=text.strip()
             base_name,__=os.path.splitext(os.path.basename(file_name))
             train_id,date=base_name.split("_")
@@ -117,15 +1498,23 @@ class DatasetWriter:
 
             lines=text.split("\n")
             first=lines.pop(0)
+            #index of the second occurrence of every line, a header line that occurs again
+            #means the block is repeating from there on
+            seen_lines=set()
+            repeats={}
+            for idx,line in enumerate(lines):
+                if line in seen_lines:
+                    repeats.setdefault(line,idx)
+                else:
+                    seen_lines.add(line)
             #if first in lines:
                 
             #train_name=first.replace("*","").strip()  #this is unreliable
             
-            train_data={"train_id":train_id}#,"train_name":train_name}
-            station_data={"train_id":train_id,}
+            train_data=TrainRecord(train_id)#,train_name=train_name)
             #station_set=set()
             #print(train_data)
-            indices=None
+            tokenizer=None
             start_idx=0
             ignore_lines=True
             repeat_idx=0
@@ -142,200 +1531,165 @@ class DatasetWriter:
                     continue
                 if idx>=repeat_idx>0:
                     break
-                if indices is None:
-                    if repeat_idx==0 and len(line)>3 and line in lines[idx+1:]:
-                        repeat_idx=lines[idx+1:].index(line)+idx+1
-                        lines=lines[:repeat_idx]
-                        print("repeating at line %d"%repeat_idx)
-                        print(file_name)
-                    if "+" in line:
-                        ignore_lines=False
-                        continue
-                    if ignore_lines:
-                        continue
-                    indices=[]
-                    last=0
+                if repeat_idx==0 and len(line)>3 and line in repeats:
+                    repeat_idx=repeats[line]
+                    lines=lines[:repeat_idx]
+                    self._report("repeating-block","repeating at line %d"%repeat_idx,file_name)
+                if "+" in line:
+                    ignore_lines=False
+                    continue
+                if ignore_lines:
+                    continue
+                
+                v_line=line.replace("*","V").strip()
+                start_idx=idx+1
+                if v_line!=V_LINE_EXPECTED:
+                    #unexpected 'V-line', we only accept it if it is just 'V' and ' '
+                    if V_LINE_RE.match(v_line) is None:
+                        self._report("missing-v-line","missing 'V-line', add one")
+                        #print(line)
+                        #print(v_line)
+                        v_line=V_LINE_EXPECTED
+                        start_idx=idx #this is so we start parsing this line as the first station
+                tokenizer=StationLineTokenizer.from_v_line(v_line)
+                break
+            
+            header=STATION_COLUMNS
+            rows=tokenizer.split_block(lines[start_idx:]) if tokenizer is not None else []
+            for line,collect in rows:
+                try:
+                    for i in [header["scheduled_arrival_day"],header["scheduled_departure_day"]]:
+                        collect[i]=collect[i].replace("-","")
+                    #print(sched_arr_str)
                     
-                    v_line_expected="V V    V  V     V  V     V     V     V"
-                    v_line=line.replace("*","V").strip()
-                    start_idx=idx+1
-                    if v_line!=v_line_expected:
-                        #unexpected 'V-line', we only accept it if it is just 'V' and ' '
-                        m=re.match(r"^[ V]+$",v_line)
-                        if m is None:
-                            print("missing 'V-line', add one")
-                            #print(line)
-                            #print(v_line)
-                            v_line=v_line_expected
-                            start_idx=idx #this is so we start parsing this line as the first station
+                    station_code=collect[header["station_code"]]
+                    #if station_code in station_set:
+                    #    print("station already added.")
+                    #    print(line)
+                    #    print(file_name)
+                    #    return
+                        
+                    if (len(station_code)!=3) or (STATION_CODE_RE.match(station_code) is None):
+                        #cannot identify a station code, means most likely a bad line (often a comment or an empty line)
+                        #print(station_code)
+                        continue
+                        
+                    scheduled_arrival=None
+                    scheduled_departure=None
+                    actual_arrival=None
+                    actual_departure=None
+                    arr_delay_min=None
+                    dep_delay_min=None
                     
-                    #if (not "V" in line) or (len(set(line))>4):
-                    #    print("No 'V'-line, add one")
-                    #    v_line=
-                    #    start_idx=idx
-                    #else:    
-                    #    start_idx=idx+1
-                    #    v_line=line.replace("*","V")
-                    #nr_stations=len(lines)-start_idx
-                    while True:
-                        last=v_line.find("V",last+1)
-                        if last>=0:
-                            indices+=[last]
-                        else:
-                            break
-                    indices+=[-1]
-                if indices is not None and idx>=start_idx:
+                    if station_code in code_to_timezone:
+                        tz=code_to_timezone[station_code]
+                        if last_valid_timezone is None:
+                            # this is the first time we have a timezone
+                            # use it for all prior entries
+                            # 
+                            localize_or_none=lambda d:self.time_parser.localize(tz,d) if d is not None else None
+                            for s in all_station_data:
+                                for e in ["scheduled_arrival","actual_arrival","scheduled_departure","actual_departure"]:
+                                    setattr(s,e,localize_or_none(getattr(s,e)))
+                        last_valid_timezone=tz
+                    self.number_station+=1
+
+                    station_count+=1
                     
+                    sched_dep_day=0
+                    sched_arr_day=0
                     try:
-                        last=0
-                        collect=[]
-                        for i in indices:
-                            if i>=0:
-                                collect+=[line[last:i].strip()]
-                            else:
-                                collect+=[line[last:].strip()]
-                            last=i
-                        #print(collect)
-                        header={"station_code":1,"scheduled_arrival_day":2,"scheduled_arrival_time":3,
-                            "scheduled_departure_day":4,"scheduled_departure_time":5,"actual_arrival_time":6,
-                            "actual_departure_time":7,"comment":8}
-                        scheduled_arrival=None
-                        scheduled_departure=None
-                        actual_arrival=None
-                        actual_departure=None
-                        arr_delay_min=None
-                        dep_delay_min=None
-                        
-                        for i in [header["scheduled_arrival_day"],header["scheduled_departure_day"]]:
-                            collect[i]=collect[i].replace("-","")
-                        #print(sched_arr_str)
-                        
-                        station_code=collect[header["station_code"]]
-                        #if station_code in station_set:
-                        #    print("station already added.")
-                        #    print(line)
-                        #    print(file_name)
-                        #    return
-                            
-                        if (len(station_code)!=3) or (re.match(r"[A-Z]{3}",station_code) is None):
-                            #cannot identify a station code, means most likely a bad line (often a comment or an empty line)
-                            #print(station_code)
-                            continue
-                            
-                        if station_code in self.code_to_timezone:
-                            tz=self.code_to_timezone[station_code]
-                            if last_valid_timezone is None:
-                                # this is the first time we have a timezone
-                                # use it for all prior entries
-                                # 
-                                localize_or_none=lambda d:tz.localize(d) if d is not None else None
-                                for s in all_station_data:
-                                    for e in ["scheduled_arrival","actual_arrival","scheduled_departure","actual_departure"]:
-                                        s[e]=localize_or_none(s[e])
-                            last_valid_timezone=tz
-                        self.number_station+=1
-
-                        station_count+=1
-                        
-                        sched_dep_day=0
-                        sched_arr_day=0
-                        try:
-                            sched_arr_day=int(collect[header["scheduled_arrival_day"]])
-                        except ValueError:
-                            pass
-                        try:
-                            sched_dep_day=int(collect[header["scheduled_departure_day"]])
-                        except ValueError:
-                            pass
-                        
-                        sched_arr_str=collect[header["scheduled_arrival_time"]]
-                        if sched_arr_str!="*":
-                            scheduled_arrival=self._parse_time(start_date,sched_arr_str,
-                                sched_arr_day,last_valid_timezone)
-                        sched_dep_str=collect[header["scheduled_departure_time"]]
-                        if sched_dep_str!="*":
-                            scheduled_departure=self._parse_time(start_date,sched_dep_str,
-                                sched_dep_day,last_valid_timezone)
-                        act_arr_str=collect[header["actual_arrival_time"]]
-                        if len(act_arr_str)>1:
-                            actual_arrival=self._parse_time(start_date,act_arr_str,sched_arr_day or sched_dep_day,last_valid_timezone)
-                            if scheduled_arrival is not None and actual_arrival is not None:
-                                #arr_delay=(actual_arrival-scheduled_arrival).total_seconds()
-                                actual_arrival+=self._delay_based_adj((actual_arrival-scheduled_arrival).total_seconds())
-                                arr_delay_min=int((actual_arrival-scheduled_arrival).total_seconds())//60
-                                    
-                        act_dep_str=collect[header["actual_departure_time"]]
-                        #print(act_dep_str)
-                        if len(act_dep_str)>1:
-                            actual_departure=self._parse_time(start_date,act_dep_str,sched_dep_day or sched_arr_day,last_valid_timezone)
-                            if scheduled_departure is not None and actual_departure is not None:
-                                actual_departure+=self._delay_based_adj((actual_departure-scheduled_departure).total_seconds())
-                                dep_delay_min=int((actual_departure-scheduled_departure).total_seconds())//60
-                        
-                        station_data["station_code"]=station_code
-                        station_data["scheduled_arrival"]=scheduled_arrival
-                        station_data["actual_arrival"]=actual_arrival
-                        station_data["scheduled_departure"]=scheduled_departure
-                        station_data["actual_departure"]=actual_departure
-                        #station_data["nr_of_stations"]=nr_stations
-                        station_data["station_nr"]=station_count
-                        station_data["departure_delay"]=None
-                        station_data["arrival_delay"]=None
-                        
-                        #print(station_data)
-                        comment_data=self._parse_comment(collect[header["comment"]])
-                        for aod,delay in comment_data:
-                            if aod[0]=="D":
-                                station_data["departure_delay"]=delay
-                                d=dep_delay_min
-                            elif aod[0]=="A":
-                                station_data["arrival_delay"]=delay
-                                d=arr_delay_min
-                            if d is not None and abs(d-delay)==24*60:
-                                sign=(d-delay)//abs(d-delay)
-                                #one full day off, adjust accordingly
-                                if aod[0]=="A" and station_data["actual_arrival"] is not None:
-                                   station_data["actual_arrival"]+=datetime.timedelta(days=-sign)
-                                   arr_delay_min=int((station_data["actual_arrival"]-scheduled_arrival).total_seconds())//60
-                                if aod[0]=="D" and station_data["actual_departure"] is not None:
-                                   station_data["actual_departure"]+=datetime.timedelta(days=-sign)
-                                   dep_delay_min=int((station_data["actual_departure"]-scheduled_departure).total_seconds())//60
-                        if station_data["arrival_delay"] is None:
-                            station_data["arrival_delay"]=arr_delay_min
-                        if station_data["departure_delay"] is None:
-                            station_data["departure_delay"]=dep_delay_min
-                        station_data["delay"]=station_data["arrival_delay"]
-                        if station_data["delay"] is None:
-                            station_data["delay"]=station_data["departure_delay"]
-
-                        #if first_station_entry:
-                        ##    train_data["origin_station_code"]=station_data["station_code"]
-                        #    train_data["scheduled_departure"]=station_data["scheduled_departure"]
-                        #    train_data["actual_departure"]=station_data["actual_departure"]
-                        #    first_station_entry=False
-                        #elif idx+1==len(lines):
-                        #    train_data["destination_station_code"]=station_data["station_code"]
-                        #    train_data["scheduled_arrival"]=station_data["scheduled_arrival"]
-                        #    train_data["actual_arrival"]=station_data["actual_arrival"]
-                        #    train_data["delay"]=station_data["delay"]
-                        #self.csv_station_writer.writerow(station_data)
-                        all_station_data+=[dict(station_data)]
-                        self.success_station+=1
-                    except ValueError as ve:
-                        print(file_name)
-                        print(line)
-                        print(ve)
-                        print(traceback.format_exc())
-                        print(collect)
-                    except KeyboardInterrupt as ki:
-                        #print(file_name)
-                        #print(self.delay_off)
-                        raise ki
-                    except:
-                        print(file_name)
-                        print(line)
-                        print(traceback.format_exc())
-                    #print(collect)
+                        sched_arr_day=int(collect[header["scheduled_arrival_day"]])
+                    except ValueError:
+                        pass
+                    try:
+                        sched_dep_day=int(collect[header["scheduled_departure_day"]])
+                    except ValueError:
+                        pass
+                    
+                    sched_arr_str=collect[header["scheduled_arrival_time"]]
+                    if sched_arr_str!="*":
+                        scheduled_arrival=self._parse_time(start_date,sched_arr_str,
+                            sched_arr_day,last_valid_timezone)
+                    sched_dep_str=collect[header["scheduled_departure_time"]]
+                    if sched_dep_str!="*":
+                        scheduled_departure=self._parse_time(start_date,sched_dep_str,
+                            sched_dep_day,last_valid_timezone)
+                    act_arr_str=collect[header["actual_arrival_time"]]
+                    if len(act_arr_str)>1:
+                        actual_arrival=self._parse_time(start_date,act_arr_str,sched_arr_day or sched_dep_day,last_valid_timezone)
+                        if scheduled_arrival is not None and actual_arrival is not None:
+                            #arr_delay=(actual_arrival-scheduled_arrival).total_seconds()
+                            actual_arrival+=self._delay_based_adj((actual_arrival-scheduled_arrival).total_seconds())
+                            arr_delay_min=int((actual_arrival-scheduled_arrival).total_seconds())//60
+                                
+                    act_dep_str=collect[header["actual_departure_time"]]
+                    #print(act_dep_str)
+                    if len(act_dep_str)>1:
+                        actual_departure=self._parse_time(start_date,act_dep_str,sched_dep_day or sched_arr_day,last_valid_timezone)
+                        if scheduled_departure is not None and actual_departure is not None:
+                            actual_departure+=self._delay_based_adj((actual_departure-scheduled_departure).total_seconds())
+                            dep_delay_min=int((actual_departure-scheduled_departure).total_seconds())//60
+                    
+                    station_data=StationRecord(train_id)
+                    station_data.station_code=station_code
+                    station_data.scheduled_arrival=scheduled_arrival
+                    station_data.actual_arrival=actual_arrival
+                    station_data.scheduled_departure=scheduled_departure
+                    station_data.actual_departure=actual_departure
+                    #station_data.nr_of_stations=nr_stations
+                    station_data.station_nr=station_count
+                    station_data.departure_delay=None
+                    station_data.arrival_delay=None
+                    
+                    #print(station_data)
+                    comment_data=self._parse_comment(collect[header["comment"]])
+                    for aod,delay in comment_data:
+                        if aod[0]=="D":
+                            station_data.departure_delay=delay
+                            d=dep_delay_min
+                        elif aod[0]=="A":
+                            station_data.arrival_delay=delay
+                            d=arr_delay_min
+                        if d is not None and abs(d-delay)==24*60:
+                            sign=(d-delay)//abs(d-delay)
+                            #one full day off, adjust accordingly
+                            if aod[0]=="A" and station_data.actual_arrival is not None:
+                               station_data.actual_arrival+=datetime.timedelta(days=-sign)
+                               arr_delay_min=int((station_data.actual_arrival-scheduled_arrival).total_seconds())//60
+                            if aod[0]=="D" and station_data.actual_departure is not None:
+                               station_data.actual_departure+=datetime.timedelta(days=-sign)
+                               dep_delay_min=int((station_data.actual_departure-scheduled_departure).total_seconds())//60
+                    if station_data.arrival_delay is None:
+                        station_data.arrival_delay=arr_delay_min
+                    if station_data.departure_delay is None:
+                        station_data.departure_delay=dep_delay_min
+                    station_data.delay=station_data.arrival_delay
+                    if station_data.delay is None:
+                        station_data.delay=station_data.departure_delay
+
+                    #if first_station_entry:
+                    ##    train_data.origin_station_code=station_data.station_code
+                    #    train_data.scheduled_departure=station_data.scheduled_departure
+                    #    train_data.actual_departure=station_data.actual_departure
+                    #    first_station_entry=False
+                    #elif idx+1==len(lines):
+                    #    train_data.destination_station_code=station_data.station_code
+                    #    train_data.scheduled_arrival=station_data.scheduled_arrival
+                    #    train_data.actual_arrival=station_data.actual_arrival
+                    #    train_data.delay=station_data.delay
+                    #self.csv_station_writer.writerow(station_data)
+                    all_station_data+=[station_data]
+                    self.success_station+=1
+                except ValueError as ve:
+                    self._report("bad-station-line",file_name,line,ve,traceback.format_exc(),collect)
+                except KeyboardInterrupt as ki:
+                    #print(file_name)
+                    #print(self.delay_off)
+                    raise ki
+                except:
+                    self._report("bad-station-line",file_name,line,traceback.format_exc())
+                #print(collect)
             
             #done with this train, write data
             
@@ -343,80 +1697,707 @@ class DatasetWriter:
             #print(all_station_data)
             self.success_train+=1
             for station_data in all_station_data:
-                station_data["nr_of_stations"]=station_count #now we know exactly how many stations
-                self.csv_station_writer.writerow(station_data)
+                station_data.nr_of_stations=station_count #now we know exactly how many stations
                 
             #Gather the most relevant station information for the train entry
             first_station_data=all_station_data[0]
             last_station_data=all_station_data[-1]
-            train_data["origin_station_code"]=first_station_data["station_code"]
-            train_data["scheduled_departure"]=first_station_data["scheduled_departure"]
-            train_data["actual_departure"]=first_station_data["actual_departure"]
-            train_data["destination_station_code"]=last_station_data["station_code"]
-            train_data["scheduled_arrival"]=last_station_data["scheduled_arrival"]
-            train_data["actual_arrival"]=last_station_data["actual_arrival"]
-            train_data["delay"]=last_station_data["delay"]
-            train_data["nr_of_stations"]=station_count
-            self.csv_train_writer.writerow(train_data)
+            train_data.origin_station_code=first_station_data.station_code
+            train_data.scheduled_departure=first_station_data.scheduled_departure
+            train_data.actual_departure=first_station_data.actual_departure
+            train_data.destination_station_code=last_station_data.station_code
+            train_data.scheduled_arrival=last_station_data.scheduled_arrival
+            train_data.actual_arrival=last_station_data.actual_arrival
+            train_data.delay=last_station_data.delay
+            train_data.nr_of_stations=station_count
+            return train_data,all_station_data
             
         except ValueError as ve:
-            print(file_name)
-            print(line)
-            print(ve)
-            print(traceback.format_exc())
+            self._report("bad-file",file_name,line,ve,traceback.format_exc())
         except KeyboardInterrupt:
             print(file_name)
             #print(self.delay_off)
             exit()
         except:
-            print(file_name)
-            print(traceback.format_exc())
+            self._report("bad-file",file_name,traceback.format_exc())
         #return (train_success,count_success/count_station)
         
+    def _report(self,kind,*lines):
+        self.stats.count(kind)
+        if not self.quiet:
+            for line in lines:
+                print(line)
 
-    def _handle_zip(self,filename):
+    def _timed_parse(self,txt_file,file_name):
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            if not self.stats.timing:
+                return self._parse_txt_file(txt_file,file_name)
+            #reading is timed on its own by handing the parser an in-memory copy
+            start=time.perf_counter()
+            data=txt_file.read()
+            read=time.perf_counter()
+            result=self._parse_txt_file(BytesIO(data),file_name)
+            self.stats.add_time("read",read-start)
+            self.stats.add_time("parse",time.perf_counter()-read)
+            return result
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+
+    def _handle_txt_file(self,txt_file,file_name):
+        result=self._timed_parse(txt_file,file_name)
+        if result is not None:
+            start=time.perf_counter() if self.stats.timing else None
+            train_data,all_station_data=result
+            for station_data in all_station_data:
+                self.csv_station_writer.writerow(station_data)
+            self.csv_train_writer.writerow(train_data)
+            self.last_train=train_data
+            if self.aggregates is not None:
+                self.aggregates.add(train_data)
+            self.rows_written[0]+=1
+            self.rows_written[1]+=len(all_station_data)
+            if start is not None:
+                self.stats.add_time("write",time.perf_counter()-start)
+
+    def _iter_member(self,zip_file,fn,use_manifest=True):
+        #yields (name,file) for every train file in or below this archive member, without
+        #use_manifest the members converted before are not skipped and nothing is recorded
+        use_manifest=use_manifest and self.manifest is not None
+        if os.path.basename(fn)!="":
+            __,ext=os.path.splitext(fn)
+            if use_manifest and ext in (".zip",".txt"):
+                info=zip_file.getinfo(fn)
+                key=[info.file_size,info.CRC]
+                known=self.archive_previous.get(fn)
+                if known==key:
+                    self.skipped+=1
+                    return
+                if known is not None and ext==".txt":
+                    #like a conflicting file the version converted first stays, its rows are
+                    #in the output and the aggregates already. A changed nested archive is
+                    #gone through for its new members.
+                    self._report("changed-member","changed since last conversion, the converted "
+                        "version stays, skipping",fn)
+                    self.archive_manifest[fn]=key
+                    self.manifest_added+=[(fn,key)]
+                    return
+            if ext==".zip":
+                #ZipFile needs a seekable file, so the inner archive is inflated in chunks
+                #into a buffer that moves to disk once it grows beyond max_memory
+                with SpooledTemporaryFile(max_size=self.max_memory) as zfiledata:
+                    with zip_file.open(fn) as inner_zip:
+                        shutil.copyfileobj(inner_zip,zfiledata,COPY_CHUNK_SIZE)
+                    zfiledata.seek(0)
+                    yield from self._iter_zip(zfiledata,use_manifest)
+            elif ext==".txt":
+                info=zip_file.getinfo(fn)
+                if self.max_file_size is not None and info.file_size>self.max_file_size:
+                    self.number_train+=1
+                    self._report("file-too-large","file too large, skipping",fn)
+                    return
+                if not (self.deduplicate and self._is_duplicate(fn,info.CRC)):
+                    with zip_file.open(fn) as inner_txt:
+                        if self.file_spans is None:
+                            yield fn,inner_txt
+                        else:
+                            yield from self._record_span(fn,info.CRC,inner_txt)
+            elif ext==".log":
+                return
+            else:
+                self._report("unknown-extension","Cannot handle extension of '{}'!".format(fn))
+                return
+            if use_manifest:
+                #nested archives are only recorded once all of their members are done
+                self.archive_manifest[fn]=key
+                self.manifest_added+=[(fn,key)]
+
+    def _is_duplicate(self,fn,crc):
+        name=os.path.basename(fn)
+        known=self.seen_files.get(name)
+        if known is None:
+            self.seen_files[name]=crc
+            return False
+        if known==crc:
+            self._report("duplicate-file","already converted from another archive, skipping",fn)
+        else:
+            #the first version wins, the rows of the train and day are in the output already
+            self._report("conflicting-file","differs from an already converted file of the same "
+                "train and day, skipping",fn)
+        return True
+
+    def _record_span(self,fn,crc,txt_file):
+        rows=tuple(self.rows_written)
+        counters=self._counters()[:4]
+        yield fn,txt_file
+        train=self.last_train if self.rows_written[0]>rows[0] else None
+        self.file_spans+=[(fn,crc,self.rows_written[0]-rows[0],self.rows_written[1]-rows[1],
+            tuple(now-before for now,before in zip(self._counters(),counters)),train)]
+
+    def _merge_files(self,files,train_rows,station_rows,counters):
+        #takes over the train files converted by a worker: drops the rows of duplicates and
+        #adds the trains to the aggregates
+        keep=[not (self.deduplicate and self._is_duplicate(fn,crc)) for fn,crc,*__ in files]
+        if self.aggregates is not None:
+            for keep_file,(*__,train) in zip(keep,files):
+                if keep_file and train is not None:
+                    self.aggregates.add(train)
+        if all(keep):
+            return train_rows,station_rows,counters
+        as_text=isinstance(train_rows,str)
+        if as_text:
+            train_rows=train_rows.splitlines(True)
+            station_rows=station_rows.splitlines(True)
+        kept_train=[]
+        kept_station=[]
+        counters=list(counters)
+        train_idx=station_idx=0
+        for keep_file,(__,__,nr_train,nr_station,deltas,__) in zip(keep,files):
+            if keep_file:
+                kept_train+=train_rows[train_idx:train_idx+nr_train]
+                kept_station+=station_rows[station_idx:station_idx+nr_station]
+            else:
+                for idx,delta in enumerate(deltas):
+                    counters[idx]-=delta
+            train_idx+=nr_train
+            station_idx+=nr_station
+        if as_text:
+            return "".join(kept_train),"".join(kept_station),counters
+        return kept_train,kept_station,counters
+
+    def _iter_zip(self,filename,use_manifest=True):
         #print(filename)
         with ZipFile(filename) as zip_file:
             #print(zipfile.namelist())
             for fn in zip_file.namelist():
-                if os.path.basename(fn)!="":
-                    __,ext=os.path.splitext(fn)
-                    if ext==".zip":
-                        zfiledata = BytesIO(zip_file.read(fn))
-                        #with zip_file.open(f) as inner_zip:
-                        self._handle_zip(zfiledata)
-                    elif ext==".txt":
-                        with zip_file.open(fn) as inner_txt:
-                            self._handle_txt_file(inner_txt,fn)
-                    elif ext==".log":
-                        continue
-                    else:
-                        print("Cannot handle extension of '{}'!".format(fn))
-                        
-#    def 
+                yield from self._iter_member(zip_file,fn,use_manifest)
+
+    def _handle_member(self,zip_file,fn):
+        for name,txt_file in self._iter_member(zip_file,fn):
+            self._handle_txt_file(txt_file,name)
+
+    def _use_archive(self,filename):
+        if self.manifest is not None:
+            self.archive_manifest=self.manifest.setdefault(os.path.abspath(filename),{})
+            self.archive_previous=self.previous_manifest.get(os.path.abspath(filename),{})
+
+    def _handle_zip(self,filename):
+        self._use_archive(filename)
+        for name,txt_file in self._iter_zip(filename):
+            self._handle_txt_file(txt_file,name)
+
+    def iter_trains(self,filename):
+        #Yields (TrainRecord,[StationRecord]) for every usable train file in the archive
+        #(nested archives included) without writing anything. Files are read one at a time,
+        #so memory does not grow with the size of the archive. The manifest of earlier
+        #conversions is not used, all trains of the archive are yielded.
+        self._reset_counters()
+        self.seen_files={}
+        for name,txt_file in self._iter_zip(filename,use_manifest=False):
+            result=self._timed_parse(txt_file,name)
+            if result is not None:
+                yield result
                         
-    def convert_zip(self,filename,initial=False):
+    def _reset_counters(self):
         self.success_train=0
         self.number_train=0
         self.success_station=0
         self.number_station=0
+        self.skipped=0
+
+    def _counters(self):
+        return (self.success_train,self.number_train,self.success_station,self.number_station,
+            self.skipped)
+
+    def _add_archive_stats(self,filename,seconds):
+        self.stats.add_archive(filename,self.number_train,self.number_station,seconds)
+
+    def _print_summary(self,filename):
+        print("Converted '{}'. Success with {} out of {} trains ({}%) and {} out of {} stations ({}%)".format(
+            filename,self.success_train,self.number_train,100*self.success_train/max(self.number_train,1),
+            self.success_station,self.number_station,100*self.success_station/max(self.number_station,1)))
+        if self.manifest is not None:
+            print("Skipped {} members that are unchanged since the last conversion".format(self.skipped))
+
+    def _load_manifest(self,initial):
+        if self.manifest_path is None:
+            return
+        self.manifest={}
+        self.manifest_added=[]
+        if not initial and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                self.manifest=json.load(manifest_file)
+        self.previous_manifest={archive:dict(members) for archive,members in self.manifest.items()}
+
+    def _load_seen_files(self,initial):
+        #a new output starts without any train files, the manifest knows the earlier runs
+        if initial:
+            self.seen_files={}
+        if self.manifest:
+            for members in self.manifest.values():
+                for fn,key in members.items():
+                    if fn.endswith(".txt"):
+                        self.seen_files.setdefault(os.path.basename(fn),key[1])
+
+    def _load_aggregates(self,initial):
+        if self.aggregates_path is None:
+            return
+        self.aggregates=DelayAggregates()
+        if not initial and os.path.exists(self.aggregates_path):
+            self.aggregates=DelayAggregates.load(self.aggregates_path)
+
+    def _save_aggregates(self):
+        if self.aggregates_path is not None:
+            self.aggregates.save(self.aggregates_path)
+
+    def _save_manifest(self):
+        if self.manifest_path is None:
+            return
+        #write to a temporary file first, a crash must never leave a truncated manifest
+        with open(self.manifest_path+".tmp","w") as manifest_file:
+            json.dump(self.manifest,manifest_file)
+        os.replace(self.manifest_path+".tmp",self.manifest_path)
+
+    def _print_peak_memory(self):
+        if resource is None:
+            return
+        peak=max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        if sys.platform!="darwin":
+            peak*=1024 #linux reports kilobytes
+        print("Peak memory usage (RSS): {:.1f} MB".format(peak/(1024*1024)))
+
+    @contextmanager
+    def _open_writers(self,initial):
+        if self.output_format!="csv":
+            self.csv_station_writer=self._table_writer(self.csv_station,self.station_writer_fieldnames,
+                initial)
+            try:
+                self.csv_train_writer=self._table_writer(self.csv_train,self.train_writer_fieldnames,
+                    initial)
+                try:
+                    yield None,None
+                finally:
+                    self.csv_train_writer.close()
+            finally:
+                self.csv_station_writer.close()
+            return
         with open(self.csv_station,"w" if initial else "a") as csv_station:
-            self.csv_station_writer=csv.DictWriter(csv_station, self.station_writer_fieldnames)
+            self.csv_station_writer=self._csv_writer(csv_station,self.station_writer_fieldnames)
             if initial:
                 self.csv_station_writer.writeheader()
             with open(self.csv_train,"w" if initial else "a") as csv_train:
-                self.csv_train_writer=csv.DictWriter(csv_train, self.train_writer_fieldnames)
+                self.csv_train_writer=self._csv_writer(csv_train,self.train_writer_fieldnames)
                 if initial:
                     self.csv_train_writer.writeheader()
-                self._handle_zip(filename)
-        print("Converted '{}'. Success with {} out of {} trains ({}%) and {} out of {} stations ({}%)".format(
-            filename,self.success_train,self.number_train,100*self.success_train/self.number_train,
-            self.success_station,self.number_station,100*self.success_station/self.number_station))
+                try:
+                    yield csv_train,csv_station
+                finally:
+                    self.csv_train_writer.flush()
+                    self.csv_station_writer.flush()
+
+    def _table_writer(self,path,fieldnames,initial):
+        if self.output_format=="parquet":
+            return ParquetTableWriter(path,fieldnames,initial,self.row_group_size)
+        if self.output_format=="partitioned":
+            return PartitionedCsvWriter(path,fieldnames,initial,self.shards,self.buffer_size,
+                self.datetime_formatter)
+        return RecordStoreWriter(path,fieldnames,initial)
+
+    def _csv_writer(self,f,fieldnames):
+        return BufferedCsvWriter(f,fieldnames,self.buffer_size,self.datetime_formatter)
+
+    def convert_zip(self,filename,initial=False):
+        self._reset_counters()
+        self._load_manifest(initial)
+        self._load_seen_files(initial)
+        self._load_aggregates(initial)
+        start=time.perf_counter()
+        with self._open_writers(initial):
+            self._handle_zip(filename)
+        self._save_manifest()
+        self._save_aggregates()
+        self._record_cache_stats()
+        self._add_archive_stats(filename,time.perf_counter()-start)
+        self._print_summary(filename)
+        self._print_peak_memory()
         #print(self.delay_off)
+
+    def convert_pipelined(self,filename,initial=False,parsers=0,queue_size=64):
+        #runs convert_pipelined_async, see there
+        import asyncio
+        asyncio.run(self.convert_pipelined_async(filename,initial,parsers,queue_size))
+
+    async def convert_pipelined_async(self,filename,initial=False,parsers=0,queue_size=64):
+        #Same output as convert_zip, but inflating the archive members, parsing and writing
+        #overlap: a reader thread, parsers (worker processes, or one parser in the event loop
+        #with parsers=0) and the writer, which owns the output files, are connected by queues
+        #of queue_size. At most 2*queue_size members are between reader and writer at any time,
+        #so memory stays flat however far one stage is ahead. The time every stage spent busy,
+        #waiting for input (starved) and waiting for the next stage (blocked) is printed.
+        self._reset_counters()
+        self._load_manifest(initial)
+        self._load_seen_files(initial)
+        self._load_aggregates(initial)
+        start=time.perf_counter()
+        with self._open_writers(initial):
+            stalls=await self._run_pipeline(filename,parsers,queue_size)
+        self._save_manifest()
+        self._save_aggregates()
+        self._add_archive_stats(filename,time.perf_counter()-start)
+        self._print_summary(filename)
+        self._print_pipeline_summary(stalls)
+        self._print_peak_memory()
+
+    async def _run_pipeline(self,filename,parsers,queue_size):
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        loop=asyncio.get_running_loop()
+        nr_parsers=parsers or 1
+        read_queue=asyncio.Queue(queue_size)
+        parsed_queue=asyncio.Queue(queue_size)
+        #members that are read but not written yet, the writer may have to wait for an early
+        #member while the parsers go on, this keeps the reordering bounded
+        window=asyncio.Semaphore(2*queue_size)
+        stalls={stage:{"busy":0.0,"starved":0.0,"blocked":0.0} for stage in ["reader","parsers","writer"]}
+        #only the reader thread touches the counters of self until the pipeline is done,
+        #the parsers report theirs to the writer, which runs in the event loop
+        totals=[0,0,0,0]
+        stats=ConversionStats(self.stats.timing)
+
+        self._use_archive(filename)
+
+        async def read(read_pool):
+            members=self._iter_zip(filename)
+            seq=0
+            while True:
+                started=time.perf_counter()
+                await window.acquire()
+                #members are read in batches to save thread switches
+                count=1
+                while count<READ_BATCH_SIZE and not window.locked():
+                    await window.acquire()
+                    count+=1
+                acquired=time.perf_counter()
+                batch=await loop.run_in_executor(read_pool,_read_batch,members,count)
+                done=time.perf_counter()
+                for __ in range(count-len(batch)):
+                    window.release()
+                for item in batch:
+                    await read_queue.put((seq,)+item)
+                    seq+=1
+                stalls["reader"]["blocked"]+=acquired-started+time.perf_counter()-done
+                stalls["reader"]["busy"]+=done-acquired
+                if len(batch)<count:
+                    break
+            for __ in range(nr_parsers):
+                await read_queue.put(None)
+
+        async def parse(parse_pool,parse_writer):
+            finished=False
+            while not finished:
+                started=time.perf_counter()
+                batch=[await read_queue.get()]
+                #worker processes get whatever is waiting, up to READ_BATCH_SIZE members
+                while (parse_pool is not None and batch[-1] is not None and len(batch)<READ_BATCH_SIZE
+                        and not read_queue.empty()):
+                    batch+=[read_queue.get_nowait()]
+                got=time.perf_counter()
+                stalls["parsers"]["starved"]+=got-started
+                if batch[-1] is None:
+                    finished=True
+                    batch.pop()
+                members=[(name,data) for __,name,data in batch]
+                if parse_pool is None:
+                    parsed=[_parse_member(name,data,parse_writer) for name,data in members]
+                else:
+                    parsed=await loop.run_in_executor(parse_pool,_parse_members,members)
+                done=time.perf_counter()
+                for (seq,__,__),result in zip(batch,parsed):
+                    await parsed_queue.put((seq,result))
+                stalls["parsers"]["busy"]+=done-got
+                stalls["parsers"]["blocked"]+=time.perf_counter()-done
+            await parsed_queue.put(None)
+
+        async def write():
+            pending={}
+            next_seq=0
+            finished=0
+            while finished<nr_parsers:
+                started=time.perf_counter()
+                item=await parsed_queue.get()
+                stalls["writer"]["starved"]+=time.perf_counter()-started
+                if item is None:
+                    finished+=1
+                    continue
+                pending[item[0]]=item[1]
+                started=time.perf_counter()
+                while next_seq in pending:
+                    self._write_parsed(pending.pop(next_seq),totals,stats)
+                    window.release()
+                    next_seq+=1
+                stalls["writer"]["busy"]+=time.perf_counter()-started
+
+        parse_writer=None
+        if not parsers:
+            parse_writer=_new_worker_writer(*self._worker_args())
+        with ThreadPoolExecutor(1) as read_pool:
+            with (ProcessPoolExecutor(parsers,initializer=_init_worker,initargs=self._worker_args())
+                    if parsers else nullcontext()) as parse_pool:
+                await asyncio.gather(read(read_pool),write(),
+                    *[parse(parse_pool,parse_writer) for __ in range(nr_parsers)])
+        self.success_train+=totals[0]
+        self.number_train+=totals[1]
+        self.success_station+=totals[2]
+        self.number_station+=totals[3]
+        self.stats.merge(stats.as_dict())
+        for stage,times in stalls.items():
+            for kind,seconds in times.items():
+                self.stats.add_time("pipeline-{}-{}".format(stage,kind),seconds)
+        return stalls
+
+    def _write_parsed(self,parsed,totals,stats):
+        result,log,counters,parse_stats=parsed
+        print(log,end="")
+        for idx in range(4):
+            totals[idx]+=counters[idx]
+        stats.merge(parse_stats)
+        if result is not None:
+            train_data,all_station_data=result
+            for station_data in all_station_data:
+                self.csv_station_writer.writerow(station_data)
+            self.csv_train_writer.writerow(train_data)
+            if self.aggregates is not None:
+                self.aggregates.add(train_data)
+
+    def _print_pipeline_summary(self,stalls):
+        print("Pipeline: "+", ".join("{} busy {:.2f}s, starved {:.2f}s, blocked {:.2f}s".format(
+            stage,times["busy"],times["starved"],times["blocked"]) for stage,times in stalls.items()))
+
+    def _plan_tasks(self,filename,chunk_size):
+        #every nested archive becomes a task of its own, the loose files in between
+        #are grouped into chunks so the pool does not drown in tiny tasks
+        tasks=[]
+        chunk=[]
+        with ZipFile(filename) as zip_file:
+            for fn in zip_file.namelist():
+                if os.path.splitext(fn)[1]==".zip":
+                    if chunk:
+                        tasks+=[(filename,chunk)]
+                        chunk=[]
+                    tasks+=[(filename,[fn])]
+                else:
+                    chunk+=[fn]
+                    if len(chunk)>=chunk_size:
+                        tasks+=[(filename,chunk)]
+                        chunk=[]
+        if chunk:
+            tasks+=[(filename,chunk)]
+        return tasks
+
+    def _worker_args(self):
+        #everything a worker process needs to parse like this writer, see _new_worker_writer
+        return (self.csv_code_timezone,self.max_file_size,self.max_memory,self.manifest,
+            self.output_format,self.quiet,self.stats.timing,self.timezone_cache,self.timezones)
+
+    def convert_many(self,filenames,workers=None,initial=False,chunk_size=64):
+        #Same output as calling convert_zip for every file in order, but the members of all
+        #archives are parsed by a pool of worker processes. Results are collected in
+        #submission order, so the csv files (and the printed diagnostics) are deterministic.
+        #At most 2*workers tasks are submitted and not yet written, so results do not pile up
+        #when writing is slower than parsing (e.g. the rows of non-csv formats).
+        from concurrent.futures import ProcessPoolExecutor
+        tasks=[]
+        last_task=set()
+        for filename in filenames:
+            tasks+=self._plan_tasks(filename,chunk_size)
+            last_task.add(len(tasks)-1)
+        self._reset_counters()
+        self._load_manifest(initial)
+        self._load_seen_files(initial)
+        self._load_aggregates(initial)
+        start=time.perf_counter()
+        with self._open_writers(initial) as (csv_train,csv_station):
+            with ProcessPoolExecutor(workers,initializer=_init_worker,
+                    initargs=self._worker_args()) as executor:
+                results=_bounded_map(executor,_convert_members,tasks,2*(workers or os.cpu_count() or 1))
+                for idx,((filename,__),(train_rows,station_rows,log,counters,added,stats,files)) in enumerate(zip(tasks,results)):
+                    print(log,end="")
+                    self._use_archive(filename)
+                    train_rows,station_rows,counters=self._merge_files(files,train_rows,
+                        station_rows,counters)
+                    if self.output_format=="csv":
+                        csv_station.write(station_rows)
+                        csv_train.write(train_rows)
+                    else:
+                        for row in station_rows:
+                            self.csv_station_writer.writerow(row)
+                        for row in train_rows:
+                            self.csv_train_writer.writerow(row)
+                    self.success_train+=counters[0]
+                    self.number_train+=counters[1]
+                    self.success_station+=counters[2]
+                    self.number_station+=counters[3]
+                    self.skipped+=counters[4]
+                    if self.manifest is not None:
+                        self.archive_manifest.update(added)
+                    self.stats.merge(stats)
+                    if idx in last_task:
+                        #wall time since the previous archive was done, the pool works ahead
+                        now=time.perf_counter()
+                        self._add_archive_stats(filename,now-start)
+                        start=now
+                        self._print_summary(filename)
+                        self._reset_counters()
+        self._save_manifest()
+        self._save_aggregates()
+        self._print_peak_memory()
+
+
+def _bounded_map(executor,fn,tasks,window):
+    #executor.map with at most window tasks submitted and not yet consumed
+    pending=deque()
+    for task in tasks:
+        if len(pending)>=window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn,task))
+    while pending:
+        yield pending.popleft().result()
+
+def iter_trains(filename,csv_code_timezone="stations_timezone.csv"):
+    #shortcut for DatasetWriter.iter_trains when nothing is to be written
+    return DatasetWriter(None,None,csv_code_timezone).iter_trains(filename)
+
+
+_worker_writer=None
+
+def _new_worker_writer(csv_code_timezone,max_file_size,max_memory,manifest,output_format,quiet,timing,
+        timezone_cache,timezones):
+    dw=DatasetWriter(None,None,csv_code_timezone,max_memory,output_format=output_format,
+        quiet=quiet,timing=timing,timezone_cache=timezone_cache,deduplicate=False,
+        timezones=timezones,max_file_size=max_file_size)
+    #the entries of a worker are handed back in manifest_added
+    dw.previous_manifest=manifest
+    dw.manifest=None if manifest is None else {}
+    return dw
+
+def _init_worker(*args):
+    global _worker_writer
+    _worker_writer=_new_worker_writer(*args)
+
+def _convert_members(task):
+    filename,members=task
+    dw=_worker_writer
+    dw._reset_counters()
+    dw.manifest_added=[]
+    dw._use_archive(filename)
+    dw.stats=ConversionStats(dw.stats.timing)
+    dw.file_spans=[]
+    dw._comment_cache_counts=dw._scan_comment.cache_info()[:2]
+    log=StringIO()
+    if dw.output_format!="csv":
+        #rows are handed back as they are and written by the parent process
+        dw.csv_station_writer=_RowCollector()
+        dw.csv_train_writer=_RowCollector()
+        with redirect_stdout(log), ZipFile(filename) as zip_file:
+            for fn in members:
+                dw._handle_member(zip_file,fn)
+        dw._record_cache_stats()
+        return (dw.csv_train_writer.rows,dw.csv_station_writer.rows,log.getvalue(),dw._counters(),
+            dw.manifest_added,dw.stats.as_dict(),dw.file_spans)
+    with StringIO() as csv_station, StringIO() as csv_train:
+        dw.csv_station_writer=dw._csv_writer(csv_station,dw.station_writer_fieldnames)
+        dw.csv_train_writer=dw._csv_writer(csv_train,dw.train_writer_fieldnames)
+        with redirect_stdout(log), ZipFile(filename) as zip_file:
+            for fn in members:
+                dw._handle_member(zip_file,fn)
+        dw._record_cache_stats()
+        dw.csv_station_writer.flush()
+        dw.csv_train_writer.flush()
+        return (csv_train.getvalue(),csv_station.getvalue(),log.getvalue(),dw._counters(),
+            dw.manifest_added,dw.stats.as_dict(),dw.file_spans)
+
+def _read_batch(members,count):
+    #reader stage of the pipeline, the next count (name,data) of the members generator
+    batch=[]
+    for name,txt_file in members:
+        batch+=[(name,txt_file.read())]
+        if len(batch)==count:
+            break
+    return batch
+
+def _parse_member(name,data,dw=None):
+    #parser stage of the pipeline, in a worker process unless a writer is given. Returns the
+    #result of _parse_txt_file with the diagnostics, counters and statistics of the file.
+    capture=dw is None
+    if capture:
+        dw=_worker_writer
+    dw._reset_counters()
+    dw.stats=ConversionStats(dw.stats.timing)
+    log=StringIO()
+    with redirect_stdout(log) if capture else nullcontext():
+        result=dw._timed_parse(BytesIO(data),name)
+    dw._record_cache_stats()
+    return result,log.getvalue(),dw._counters(),dw.stats.as_dict()
+
+def _parse_members(members):
+    return [_parse_member(name,data) for name,data in members]
+
        
-if __name__ == '__main__':         
-    dw=DatasetWriter("trains.csv","stations.csv")
-    first=True
-    for i in range(2007,2018):
-        dw.convert_zip("/media/phil/DATA/trains/{}.zip".format(i),initial=first)
-        first=False
+def main(argv=None):
+    #python amtrak_dataset.py "/media/phil/DATA/trains/{year}.zip" --years 2007-2017
+    import argparse
+    parser=argparse.ArgumentParser(description="Converts zip archives of Amtrak status files "
+        "to train and station tables")
+    parser.add_argument("archives",nargs="+",help="zip archives, '{year}' in a name is replaced "
+        "by every year of --years")
+    parser.add_argument("--years",default="2007-2017",help="FIRST-LAST or YEAR (default %(default)s)")
+    parser.add_argument("--trains",default="trains.csv",help="train output (default %(default)s)")
+    parser.add_argument("--stations",default="stations.csv",help="station output (default %(default)s)")
+    parser.add_argument("--format",default="csv",choices=["csv","parquet","store","partitioned"])
+    parser.add_argument("--timezones",default="stations_timezone.csv",
+        help="csv of station code, name and timezone (default %(default)s)")
+    parser.add_argument("--timezone-cache",help="binary cache of the timezone index")
+    parser.add_argument("--mode",default="parallel",choices=["parallel","sequential","pipelined"],
+        help="convert_many, convert_zip or convert_pipelined (default %(default)s)")
+    parser.add_argument("--workers",type=int,default=os.cpu_count(),
+        help="worker processes of the parallel and pipelined modes (default %(default)s)")
+    parser.add_argument("--append",action="store_true",help="add to the output instead of "
+        "starting it again")
+    parser.add_argument("--manifest",help="json manifest for incremental conversions")
+    parser.add_argument("--aggregates",help="json file of the delay aggregates")
+    parser.add_argument("--keep-duplicates",action="store_true",help="convert train files "
+        "that were already converted from another archive")
+    parser.add_argument("--quiet",action="store_true",help="only count anomalies")
+    parser.add_argument("--timing",action="store_true",help="time the conversion stages")
+    parser.add_argument("--stats",help="write the conversion statistics to this json file")
+    parser.add_argument("--max-file-size",type=int,help="skip train files larger than this many "
+        "bytes (default no limit)")
+    args=parser.parse_args(argv)
+    first,__,last=args.years.partition("-")
+    years=range(int(first),int(last or first)+1)
+    filenames=[]
+    for archive in args.archives:
+        filenames+=[archive.format(year=year) for year in years] if "{year}" in archive else [archive]
+    dw=DatasetWriter(args.trains,args.stations,args.timezones,manifest=args.manifest,
+        output_format=args.format,quiet=args.quiet,timing=args.timing,
+        timezone_cache=args.timezone_cache,deduplicate=not args.keep_duplicates,
+        aggregates=args.aggregates,max_file_size=args.max_file_size)
+    if args.mode=="parallel":
+        dw.convert_many(filenames,workers=args.workers,initial=not args.append)
+    else:
+        for idx,filename in enumerate(filenames):
+            initial=idx==0 and not args.append
+            if args.mode=="sequential":
+                dw.convert_zip(filename,initial=initial)
+            else:
+                dw.convert_pipelined(filename,initial=initial,
+                    parsers=args.workers if args.workers>1 else 0)
+    if args.stats:
+        with open(args.stats,"w") as stats_file:
+            stats_file.write(dw.stats.to_json())
+
+if __name__ == '__main__':
+    main()
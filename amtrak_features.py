@@ -0,0 +1,189 @@
+#Model features of the trains csv written by DatasetWriter, computed with numpy on int64
+#epoch arrays instead of per-row apply lambdas:
+#   features=build_features("trains.csv")
+#   train_data=pandas.DataFrame(features)
+#The file is handled in byte ranges of whole lines. The field boundaries of a range are found
+#with numpy on its bytes and every field is read as a zero-padded character matrix, so no
+#python object is created per value. build_features parses the ranges in a pool of worker
+#processes, iter_feature_chunks one after the other with bounded memory.
+import os
+import csv
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+
+from amtrak_dataset import RecordStore
+
+CHUNK_BYTES=16*1024*1024
+#missing timestamps and durations, like in RecordStore
+NULL_TIMESTAMP=RecordStore.NULL_TIMESTAMP
+#the delay buckets of the notebook, lower bound included, upper bound excluded
+DELAY_BUCKETS=[("30min_delayed",30,60),("1h_delayed",60,180),("3h_delayed",180,360),
+    ("more_6h_delayed",360,None)]
+#"YYYY-MM-DD HH:MM:SS" and an optional "+HH:MM" utc offset, see DatetimeFormatter
+TIMESTAMP_WIDTH=25
+INTEGER_WIDTH=8
+
+def days_from_civil(year,month,day):
+    #days since 1970-01-01 of (proleptic gregorian) dates, element-wise
+    year=year-(month<=2)
+    era=year//400
+    year_of_era=year-era*400
+    day_of_year=(153*((month+9)%12)+2)//5+day-1
+    day_of_era=year_of_era*365+year_of_era//4-year_of_era//100+day_of_year
+    return era*146097+day_of_era-719468
+
+def parse_timestamps(chars):
+    #A character matrix of timestamps as written by DatasetWriter to (seconds since the
+    #epoch, local day since 1970-01-01, local year), NULL_TIMESTAMP/0/0 for empty values.
+    #Naive times are taken as UTC, like in ParquetTableWriter.
+    digits=chars.astype(numpy.int64)-ord("0")
+    number=lambda start,width:sum(digits[:,start+i]*10**(width-1-i) for i in range(width))
+    missing=chars[:,0]==0
+    #keeps the calendar arithmetic in range, the values are replaced below
+    year=numpy.where(missing,1970,number(0,4))
+    month=numpy.where(missing,1,number(5,2))
+    day=numpy.where(missing,1,number(8,2))
+    days=days_from_civil(year,month,day)
+    local=days*86400+number(11,2)*3600+number(14,2)*60+number(17,2)
+    sign=numpy.where(chars[:,19]==ord("-"),-1,numpy.where(chars[:,19]==ord("+"),1,0))
+    offset=sign*(number(20,2)*3600+number(23,2)*60)
+    epoch=numpy.where(missing,NULL_TIMESTAMP,local-offset)
+    return epoch,numpy.where(missing,0,days),numpy.where(missing,0,year)
+
+def parse_integers(chars):
+    #a character matrix of integers to float64, nan for empty values
+    value=numpy.zeros(len(chars),dtype=numpy.int64)
+    is_digit=(chars>=ord("0"))&(chars<=ord("9"))
+    for i in range(chars.shape[1]):
+        value=numpy.where(is_digit[:,i],value*10+chars[:,i].astype(numpy.int64)-ord("0"),value)
+    value=numpy.where(chars[:,0]==ord("-"),-value,value).astype(numpy.float64)
+    return numpy.where(chars[:,0]==0,numpy.nan,value)
+
+def features_of_fields(field):
+    #the features of a chunk, field(name,width) returns the (rows, width) zero-padded
+    #character matrix of a column, as wide as the widest value if width is None
+    departure=field("scheduled_departure",TIMESTAMP_WIDTH)
+    departure=numpy.where(departure[:,:1]!=0,departure,field("actual_departure",TIMESTAMP_WIDTH))
+    arrival=field("scheduled_arrival",TIMESTAMP_WIDTH)
+    arrival=numpy.where(arrival[:,:1]!=0,arrival,field("actual_arrival",TIMESTAMP_WIDTH))
+    dep_timestamp,days,year=parse_timestamps(departure)
+    arr_timestamp=parse_timestamps(arrival)[0]
+    has_departure=dep_timestamp!=NULL_TIMESTAMP
+    has_both=has_departure&(arr_timestamp!=NULL_TIMESTAMP)
+    leap=(year%4==0)&((year%100!=0)|(year%400==0))
+    day_of_year=days-days_from_civil(year,numpy.ones_like(year),numpy.ones_like(year))+1
+    delay=parse_integers(field("delay",INTEGER_WIDTH))
+    known=~numpy.isnan(delay)
+    known_delay=numpy.nan_to_num(delay)
+    train_id=field("train_id",None)
+    features={
+        "train_id":train_id.view("S{}".format(train_id.shape[1])).ravel().astype(str),
+        "nr_of_stations":parse_integers(field("nr_of_stations",INTEGER_WIDTH)).astype(numpy.int64),
+        "delay":delay,
+        "dep_timestamp":dep_timestamp,
+        "arr_timestamp":arr_timestamp,
+        "duration":numpy.where(has_both,arr_timestamp-dep_timestamp,NULL_TIMESTAMP),
+        #local weekday of the departure, monday is 0 (1970-01-01 was a thursday)
+        "weekday":numpy.where(has_departure,(days+3)%7,-1).astype(numpy.int8),
+        "season":numpy.where(has_departure,numpy.cos(2*numpy.pi*day_of_year/(365+leap)),numpy.nan),
+        "cancelled":~known,
+        "long_delay_or_cancelled":~known|(known_delay>=30),
+    }
+    for name,low,high in DELAY_BUCKETS:
+        bucket=known&(known_delay>=low)
+        if high is not None:
+            bucket&=known_delay<high
+        features[name]=bucket
+    return features
+
+def _byte_fields(data,fieldnames):
+    #field(name,width) of csv data without quoting, None if the data does not have exactly
+    #one value per fieldname on every line (the converter never quotes, other writers may)
+    chars=numpy.frombuffer(data,dtype=numpy.uint8)
+    if len(fieldnames)<2 or (chars==ord('"')).any():
+        return None
+    line_ends=numpy.flatnonzero(chars==ord("\n"))
+    if len(chars) and chars[-1]!=ord("\n"):
+        line_ends=numpy.append(line_ends,len(chars))
+    line_starts=numpy.concatenate([[0],line_ends[:-1]+1]).astype(numpy.int64)
+    #csv.writer ends lines with \r\n
+    line_ends=line_ends-((line_ends>line_starts)&(chars[numpy.maximum(line_ends-1,0)]==ord("\r")))
+    commas=numpy.flatnonzero(chars==ord(","))
+    if len(commas)!=len(line_starts)*(len(fieldnames)-1):
+        return None
+    commas=commas.reshape(len(line_starts),len(fieldnames)-1)
+    #the commas are sorted, so the first and last of every line bound the others
+    if (commas[:,0]<line_starts).any() or (commas[:,-1]>=line_ends).any():
+        return None
+    starts=numpy.column_stack([line_starts,commas+1])
+    ends=numpy.column_stack([commas,line_ends])
+    columns={name:i for i,name in enumerate(fieldnames)}
+    def field(name,width):
+        start=starts[:,columns[name]]
+        end=ends[:,columns[name]]
+        if width is None:
+            width=max(1,int((end-start).max(initial=0)))
+        #rows of a sliding window view are copied whole, the bytes after the value are zeroed
+        padded=numpy.concatenate([chars,numpy.zeros(width,dtype=numpy.uint8)])
+        matrix=numpy.lib.stride_tricks.sliding_window_view(padded,width)[start]
+        matrix[numpy.arange(width)>=(end-start)[:,None]]=0
+        return matrix
+    return field
+
+def _text_fields(lines,fieldnames):
+    #field(name,width) of csv lines parsed by the csv module
+    columns=dict(zip(fieldnames,zip(*csv.reader(lines))))
+    def field(name,width):
+        values=columns.get(name,())
+        if width is None:
+            width=max(1,max(map(len,values),default=1))
+        return numpy.array(values,dtype="S{}".format(width)).view(numpy.uint8).reshape(len(values),width)
+    return field
+
+def _features_of_range(task):
+    csv_train,fieldnames,start,end=task
+    with open(csv_train,"rb") as f:
+        f.seek(start)
+        data=f.read(end-start)
+    field=_byte_fields(data,fieldnames)
+    if field is None:
+        field=_text_fields(data.decode().splitlines(),fieldnames)
+    return features_of_fields(field)
+
+def _tasks(csv_train,chunk_bytes):
+    #byte ranges of whole lines after the header (the converter never writes quoted newlines)
+    size=os.path.getsize(csv_train)
+    with open(csv_train,newline="") as f:
+        fieldnames=next(csv.reader(f))
+    with open(csv_train,"rb") as f:
+        start=len(f.readline())
+        tasks=[]
+        while start<size:
+            end=size
+            if start+chunk_bytes<size:
+                f.seek(start+chunk_bytes)
+                end=min(f.tell()+len(f.readline()),size)
+            tasks+=[(csv_train,fieldnames,start,end)]
+            start=end
+    return tasks
+
+def concatenate(chunks):
+    #the features of chunks as one dict of arrays
+    chunks=list(chunks)
+    if not chunks:
+        return features_of_fields(_text_fields([],[]))
+    return {name:numpy.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+def iter_feature_chunks(csv_train,chunk_bytes=CHUNK_BYTES):
+    #the features of about chunk_bytes of csv_train at a time
+    for task in _tasks(csv_train,chunk_bytes):
+        yield _features_of_range(task)
+
+def build_features(csv_train,workers=None,chunk_bytes=CHUNK_BYTES):
+    #the features of all trains of csv_train as a dict of numpy arrays in file order, ranges
+    #of chunk_bytes are parsed by workers processes (all cores by default)
+    tasks=_tasks(csv_train,chunk_bytes)
+    if workers==1 or len(tasks)<=1:
+        return concatenate(map(_features_of_range,tasks))
+    with ProcessPoolExecutor(workers) as executor:
+        return concatenate(executor.map(_features_of_range,tasks))
@@ -0,0 +1,290 @@
+#Delay query service on top of the station csv written by DatasetWriter. The delays are kept
+#in memory by (train_id, station_code, weekday), sorted, so percentiles are an index lookup:
+#   python amtrak_service.py stations.csv --port 8080
+#   curl "localhost:8080/delay?train_id=90&station_code=NYP&weekday=0&percentiles=50,90"
+#The csv is followed like a log: rows that incremental conversions append are added to the
+#index while it serves, a csv that was written again from the start is loaded again.
+import os
+import csv
+import json
+import datetime
+from bisect import insort
+from array import array
+from heapq import merge
+
+from amtrak_dataset import DAY_FIELDS
+
+#(day, delay) pairs of the latest days kept per key
+HISTORY=10
+DEFAULT_PERCENTILES=(50,90,99)
+#bytes read per step while following the csv
+READ_SIZE=16*1024*1024
+
+class DelayIndex:
+    #Delays of the station rows by (train_id, station_code, weekday of the local date, see
+    #DAY_FIELDS). Rows without a delay are counted as missing.
+
+    def __init__(self,history=HISTORY):
+        self.history=history
+        self.delays={}
+        self.recent={}
+        self.missing={}
+        self.rows=0
+        self._weekdays={}
+
+    def _weekday(self,day):
+        weekday=self._weekdays.get(day)
+        if weekday is None:
+            weekday=self._weekdays[day]=datetime.date.fromisoformat(day).weekday()
+        return weekday
+
+    def add_row(self,row):
+        #a station row as read by csv.DictReader
+        day=next((row[name][:10] for name in DAY_FIELDS if row[name]),None)
+        if day is None:
+            return
+        key=(row["train_id"],row["station_code"],self._weekday(day))
+        self.rows+=1
+        if not row["delay"]:
+            self.missing[key]=self.missing.get(key,0)+1
+            return
+        delay=int(row["delay"])
+        delays=self.delays.get(key)
+        if delays is None:
+            self.recent[key]=[]
+            delays=self.delays[key]=array("i")
+        insort(delays,delay)
+        #kept sorted by day, rows of older days that come late drop out again
+        recent=self.recent[key]
+        insort(recent,(day,delay))
+        if len(recent)>self.history:
+            del recent[0]
+
+    def merge(self,other):
+        #adds the rows of another index, e.g. of rows appended to the csv
+        for key,delays in other.delays.items():
+            known=self.delays.get(key)
+            if known is None:
+                self.recent[key]=other.recent[key]
+                self.delays[key]=delays
+                continue
+            for delay in delays:
+                insort(known,delay)
+            self.recent[key]=sorted(self.recent[key]+other.recent[key])[-self.history:]
+        for key,count in other.missing.items():
+            self.missing[key]=self.missing.get(key,0)+count
+        self.rows+=other.rows
+
+    def keys(self,train_id,station_code,weekday=None):
+        weekdays=range(7) if weekday is None else [weekday]
+        return [(train_id,station_code,day) for day in weekdays]
+
+    def lookup(self,train_id,station_code,weekday=None,percentiles=DEFAULT_PERCENTILES,history=None):
+        #Nearest-rank percentiles, mean and the latest days of one train at one station, on one
+        #weekday (monday is 0) or on all of them. None if the index has no such row.
+        keys=self.keys(train_id,station_code,weekday)
+        found=[key for key in keys if key in self.delays]
+        missing=sum(self.missing.get(key,0) for key in keys)
+        if not found and not missing:
+            return None
+        delays=self.delays[found[0]] if len(found)==1 else list(merge(*[self.delays[key] for key in found]))
+        count=len(delays)
+        result={"train_id":train_id,"station_code":station_code,"weekday":weekday,
+            "count":count,"missing":missing,"mean":sum(delays)/count if count else None,
+            "percentiles":{str(q):delays[min(count-1,max(0,-(-q*count//100)-1))] if count else None
+                for q in percentiles}}
+        history=self.history if history is None else min(history,self.history)
+        recent=sorted(entry for key in found for entry in self.recent[key])[-history:] if history>0 else []
+        result["recent"]=[{"day":day,"delay":delay} for day,delay in recent]
+        return result
+
+class StationCsvFollower:
+    #Adds the rows of a station csv to a DelayIndex and, on every poll(), the rows appended
+    #since. Only complete lines are read, a missing csv is an empty index until it is written.
+    #The file is loaded again if it is shorter than what was read, or if the last line read
+    #is not where it was (written again from the start).
+    #read() never touches the index that is served: it builds a new index (reload) or one of
+    #the appended rows, which apply() swaps in or merges, so the two can run in different
+    #threads as long as only one read() runs at a time.
+
+    def __init__(self,path,index_factory=DelayIndex):
+        self.path=path
+        self.index_factory=index_factory
+        self.index=index_factory()
+        self.offset=0
+        self.last_line=b""
+        self.fieldnames=None
+        self.reloads=0
+
+    def _rewritten(self,f,size):
+        if size<self.offset:
+            return True
+        f.seek(self.offset-len(self.last_line))
+        return f.read(len(self.last_line))!=self.last_line
+
+    def read(self):
+        #(reload, index of the new rows, offset, last line, fieldnames), None if the file
+        #is missing
+        try:
+            size=os.path.getsize(self.path)
+        except FileNotFoundError:
+            return None
+        index=self.index_factory()
+        offset,last_line,fieldnames=self.offset,self.last_line,self.fieldnames
+        with open(self.path,"rb") as f:
+            reload=self._rewritten(f,size)
+            if reload:
+                offset,last_line,fieldnames=0,b"",None
+            f.seek(offset)
+            while offset<size:
+                data=f.read(min(READ_SIZE,size-offset))
+                end=data.rfind(b"\n")+1
+                if end==0:
+                    break
+                lines=data[:end].decode().splitlines()
+                if fieldnames is None:
+                    fieldnames=next(csv.reader(lines[:1]))
+                    lines=lines[1:]
+                for row in csv.DictReader(lines,fieldnames):
+                    index.add_row(row)
+                offset+=end
+                last_line=data[data.rfind(b"\n",0,end-1)+1:end]
+                f.seek(offset)
+        return reload,index,offset,last_line,fieldnames
+
+    def apply(self,update):
+        #returns the number of rows added
+        if update is None:
+            return 0
+        reload,index,self.offset,self.last_line,self.fieldnames=update
+        if reload:
+            self.index=index
+            self.reloads+=1
+        else:
+            self.index.merge(index)
+        return index.rows
+
+    def poll(self):
+        return self.apply(self.read())
+
+class DelayService:
+    #HTTP/1.1 (keep-alive) on TCP or a unix socket, GET only:
+    #   /delay?train_id=..&station_code=..[&weekday=0-6][&percentiles=50,90][&history=5]
+    #   /health
+    #Without weekday the expected delay for today's weekday is answered, weekday=all uses
+    #all days. Every reload_interval seconds the csv is polled for appended rows.
+
+    def __init__(self,csv_station,reload_interval=1.0):
+        self.follower=StationCsvFollower(csv_station)
+        self.follower.poll()
+        self.reload_interval=reload_interval
+        self.requests=0
+
+    def query(self,path):
+        #(status, json-able body) of a request path
+        from urllib.parse import urlsplit, parse_qs
+        url=urlsplit(path)
+        params={name:values[-1] for name,values in parse_qs(url.query).items()}
+        index=self.follower.index
+        if url.path=="/health":
+            return 200,{"rows":index.rows,"keys":len(index.delays),"offset":self.follower.offset,
+                "reloads":self.follower.reloads,"requests":self.requests}
+        if url.path!="/delay":
+            return 404,{"error":"unknown path '{}'".format(url.path)}
+        try:
+            weekday=params.get("weekday")
+            if weekday is None:
+                weekday=datetime.date.today().weekday()
+            elif weekday=="all":
+                weekday=None
+            else:
+                weekday=int(weekday)
+            percentiles=DEFAULT_PERCENTILES
+            if "percentiles" in params:
+                percentiles=[int(q) for q in params["percentiles"].split(",")]
+            history=int(params["history"]) if "history" in params else None
+            result=index.lookup(params["train_id"],params["station_code"],weekday,percentiles,history)
+        except (KeyError,ValueError) as error:
+            return 400,{"error":"bad query: {}".format(error)}
+        if result is None:
+            return 404,{"error":"no delays for this train and station"}
+        return 200,result
+
+    async def handle(self,reader,writer):
+        try:
+            while True:
+                request=await reader.readline()
+                if not request:
+                    break
+                headers={}
+                while True:
+                    line=await reader.readline()
+                    if line in (b"\r\n",b"\n",b""):
+                        break
+                    name,__,value=line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()]=value.strip()
+                parts=request.decode("latin-1").split()
+                self.requests+=1
+                if len(parts)!=3 or parts[0]!="GET":
+                    status,body=405,{"error":"only GET is supported"}
+                else:
+                    status,body=self.query(parts[1])
+                keep_alive=(len(parts)==3 and parts[2]=="HTTP/1.1" and
+                    headers.get("connection","").lower()!="close")
+                data=json.dumps(body).encode()
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\nConnection: %s\r\n\r\n"%(status,
+                    b"OK" if status==200 else b"Error",len(data),b"keep-alive" if keep_alive else b"close")+data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError,UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def follow(self):
+        import asyncio
+        loop=asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            #the csv is read and parsed in a thread, the result is swapped in or merged here in
+            #the event loop, between two requests
+            update=await loop.run_in_executor(None,self.follower.read)
+            self.follower.apply(update)
+
+    async def serve(self,host="127.0.0.1",port=8080,unix=None,ready=None):
+        import asyncio
+        if unix is not None:
+            server=await asyncio.start_unix_server(self.handle,unix)
+        else:
+            server=await asyncio.start_server(self.handle,host,port)
+        if ready is not None:
+            ready(server)
+        follower=asyncio.ensure_future(self.follow())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            follower.cancel()
+
+def main(argv=None):
+    import argparse
+    import asyncio
+    parser=argparse.ArgumentParser(description="Serves delay percentiles and history of the "
+        "station csv written by amtrak_dataset")
+    parser.add_argument("stations",help="station csv, followed while it is appended to")
+    parser.add_argument("--host",default="127.0.0.1")
+    parser.add_argument("--port",type=int,default=8080)
+    parser.add_argument("--unix",help="serve on this unix socket instead of TCP")
+    parser.add_argument("--reload-interval",type=float,default=1.0,help="seconds between polls "
+        "of the csv (default %(default)s)")
+    args=parser.parse_args(argv)
+    service=DelayService(args.stations,args.reload_interval)
+    print("{} rows, {} keys".format(service.follower.index.rows,len(service.follower.index.delays)))
+    #port 0 picks a free port, the address is printed once the server listens
+    ready=lambda server:print("serving on {}".format(server.sockets[0].getsockname()),flush=True)
+    asyncio.run(service.serve(args.host,args.port,args.unix,ready))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#Training data of the delay models, built from the trains csv in chunks instead of a full
+#DataFrame and DMatrix:
+#   vocabulary=Vocabulary.build("trains.csv",min_count=3000)
+#   vocabulary.save("vocabulary.json")
+#   matrix,label=build_csr("trains.csv",vocabulary,end=datetime(2017,1,1).timestamp())
+#   dtrain=external_memory_dmatrix("trains.csv",vocabulary,"cache/train")
+#train_id is one-hot encoded with a vocabulary that is computed once (from the csv or from the
+#aggregates of the conversion) and then applied to every chunk, so all chunks, and the data
+#predicted on later, have the same columns. Rows are the trains with a known delay whose
+#train_id is in the vocabulary, like the filtered train_data of the notebooks. Only the
+#non-missing values are stored, a chunk holds about chunk_bytes of the csv at a time.
+#scipy (CSR matrices) and xgboost (external memory) are imported when they are used.
+import os
+import json
+import numpy
+
+from amtrak_features import iter_feature_chunks, CHUNK_BYTES, NULL_TIMESTAMP
+
+#the numeric model inputs, followed by one column per train_id of the vocabulary
+NUMERIC_COLUMNS=["nr_of_stations","dep_timestamp","duration","weekday","season"]
+LABEL="delay"
+
+class Vocabulary:
+    #The train_ids with at least min_count trains, in sorted order, and their column.
+
+    def __init__(self,categories):
+        self.categories=sorted(categories)
+        self.columns={category:i for i,category in enumerate(self.categories)}
+
+    def __len__(self):
+        return len(self.categories)
+
+    @classmethod
+    def from_counts(cls,counts,min_count=1):
+        return cls(category for category,count in counts.items() if count>=min_count)
+
+    @classmethod
+    def build(cls,csv_train,min_count=1,chunk_bytes=CHUNK_BYTES):
+        #counts the trains with a known delay per train_id in one pass over the csv
+        counts={}
+        for chunk in iter_feature_chunks(csv_train,chunk_bytes):
+            values,chunk_counts=numpy.unique(chunk["train_id"][~chunk["cancelled"]],return_counts=True)
+            for value,count in zip(values.tolist(),chunk_counts.tolist()):
+                counts[value]=counts.get(value,0)+count
+        return cls.from_counts(counts,min_count)
+
+    @classmethod
+    def from_aggregates(cls,aggregates,min_count=1):
+        #from the DelayAggregates of the conversion, without reading the csv
+        return cls.from_counts({train_id:cell[1] for train_id,cell in
+            aggregates.cells["train_id"].items()},min_count)
+
+    def encode(self,values):
+        #the columns of an array of train_ids, -1 for the ones not in the vocabulary
+        if not self.categories:
+            return numpy.full(len(values),-1,dtype=numpy.int64)
+        categories=numpy.array(self.categories)
+        position=numpy.minimum(numpy.searchsorted(categories,values),len(categories)-1)
+        return numpy.where(categories[position]==values,position,-1)
+
+    def feature_names(self):
+        return NUMERIC_COLUMNS+["train_id={}".format(category) for category in self.categories]
+
+    def as_dict(self):
+        return {"version":1,"categories":self.categories}
+
+    @classmethod
+    def from_dict(cls,data):
+        return cls(data["categories"])
+
+    @classmethod
+    def load(cls,path):
+        with open(path) as vocabulary_file:
+            return cls.from_dict(json.load(vocabulary_file))
+
+    def save(self,path):
+        with open(path+".tmp","w") as vocabulary_file:
+            json.dump(self.as_dict(),vocabulary_file)
+        os.replace(path+".tmp",path)
+
+def select(features,vocabulary,start=None,end=None,delay_range=None):
+    #the rows of a feature chunk that are trained on: a known delay, a train_id of the
+    #vocabulary, a departure in [start, end) (epoch seconds) and a delay strictly inside
+    #delay_range=(low, high), the outlier cut of the notebooks
+    codes=vocabulary.encode(features["train_id"])
+    keep=(codes>=0)&~features["cancelled"]
+    departure=features["dep_timestamp"]
+    if start is not None:
+        keep&=(departure!=NULL_TIMESTAMP)&(departure>=start)
+    if end is not None:
+        keep&=(departure!=NULL_TIMESTAMP)&(departure<end)
+    if delay_range is not None:
+        with numpy.errstate(invalid="ignore"):
+            keep&=(features[LABEL]>delay_range[0])&(features[LABEL]<delay_range[1])
+    return keep,codes
+
+def csr_arrays(features,vocabulary,**filters):
+    #(data, indices, indptr, label) of the CSR matrix of a feature chunk, missing numeric
+    #values (no departure or arrival) are left out so the models see them as missing
+    keep,codes=select(features,vocabulary,**filters)
+    numeric=[]
+    for name in NUMERIC_COLUMNS:
+        values=features[name][keep].astype(numpy.float64)
+        if name in ("dep_timestamp","duration"):
+            values[features[name][keep]==NULL_TIMESTAMP]=numpy.nan
+        elif name=="weekday":
+            values[values<0]=numpy.nan
+        numeric+=[values]
+    values=numpy.column_stack(numeric+[numpy.ones(len(numeric[0]))])
+    columns=numpy.broadcast_to(numpy.arange(len(NUMERIC_COLUMNS)+1),values.shape).copy()
+    columns[:,-1]=len(NUMERIC_COLUMNS)+codes[keep]
+    present=~numpy.isnan(values)
+    indptr=numpy.concatenate([[0],numpy.cumsum(present.sum(axis=1))]).astype(numpy.int64)
+    return values[present],columns[present].astype(numpy.int32),indptr,features[LABEL][keep]
+
+def iter_csr_arrays(csv_train,vocabulary,chunk_bytes=CHUNK_BYTES,**filters):
+    for features in iter_feature_chunks(csv_train,chunk_bytes):
+        yield csr_arrays(features,vocabulary,**filters)
+
+def iter_csr_chunks(csv_train,vocabulary,chunk_bytes=CHUNK_BYTES,**filters):
+    #(scipy.sparse.csr_matrix, label) per chunk of the csv
+    import scipy.sparse
+    shape=len(NUMERIC_COLUMNS)+len(vocabulary)
+    for data,indices,indptr,label in iter_csr_arrays(csv_train,vocabulary,chunk_bytes,**filters):
+        yield scipy.sparse.csr_matrix((data,indices,indptr),shape=(len(indptr)-1,shape)),label
+
+def build_csr(csv_train,vocabulary,chunk_bytes=CHUNK_BYTES,**filters):
+    #the whole training data as one CSR matrix and its label, only the chunk being encoded
+    #is held besides the sparse arrays
+    import scipy.sparse
+    chunks=list(iter_csr_arrays(csv_train,vocabulary,chunk_bytes,**filters))
+    offsets=numpy.cumsum([0]+[len(data) for data,__,__,__ in chunks])
+    data=numpy.concatenate([numpy.zeros(0)]+[data for data,__,__,__ in chunks])
+    indices=numpy.concatenate([numpy.zeros(0,dtype=numpy.int32)]+[indices for __,indices,__,__ in chunks])
+    indptr=numpy.concatenate([[0]]+[indptr[1:]+offset for (__,__,indptr,__),offset in zip(chunks,offsets)])
+    label=numpy.concatenate([numpy.zeros(0)]+[label for __,__,__,label in chunks])
+    shape=(len(indptr)-1,len(NUMERIC_COLUMNS)+len(vocabulary))
+    return scipy.sparse.csr_matrix((data,indices,indptr.astype(numpy.int64)),shape=shape),label
+
+def data_iter(csv_train,vocabulary,cache_prefix,chunk_bytes=CHUNK_BYTES,**filters):
+    #an xgboost.DataIter over the chunks of the csv, xgboost keeps its pages in files
+    #starting with cache_prefix
+    import xgboost
+
+    class ChunkIter(xgboost.DataIter):
+
+        def __init__(self):
+            self.chunks=None
+            super().__init__(cache_prefix=cache_prefix)
+
+        def next(self,input_data):
+            if self.chunks is None:
+                self.chunks=iter_csr_chunks(csv_train,vocabulary,chunk_bytes,**filters)
+            chunk=next(self.chunks,None)
+            if chunk is None:
+                return False
+            matrix,label=chunk
+            input_data(data=matrix,label=label,feature_names=vocabulary.feature_names())
+            return True
+
+        def reset(self):
+            self.chunks=None
+
+    return ChunkIter()
+
+def external_memory_dmatrix(csv_train,vocabulary,cache_prefix,chunk_bytes=CHUNK_BYTES,**filters):
+    #an external memory DMatrix of the training data, see data_iter
+    import xgboost
+    return xgboost.DMatrix(data_iter(csv_train,vocabulary,cache_prefix,chunk_bytes,**filters),
+        missing=numpy.nan)
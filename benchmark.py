@@ -0,0 +1,353 @@
+import timeit
+import time
+import datetime
+import csv
+import io
+import os
+import sys
+import random
+import re
+import zipfile
+import argparse
+import tempfile
+import math
+import importlib.util
+from contextlib import redirect_stdout
+import pytz
+from amtrak_dataset import (DatasetWriter, TimeParser, BufferedCsvWriter, StationLineTokenizer,
+    ZoneOffsets, STATION_FIELDNAMES, STATION_COLUMNS, STATION_CODE_RE, V_LINE_EXPECTED)
+try:
+    import resource
+except ImportError:
+    resource=None
+
+#--- synthetic status files ---
+
+STATION_TIMEZONES=["EST","CST","MST","PST","MST/Arizona"]
+HEADER_LINES=["* +---------------- Station code",
+    "* |    +----------- Schedule Arrival Day  ",
+    "* |    |  +-------- Schedule Arrival time",
+    "* |    |  |     +----- Schedule Departure Day",
+    "* |    |  |     |  +-- Schedule Departure Time ",
+    "* |    |  |     |  |     +------------- Actual Arrival Time",
+    "* |    |  |     |  |     |     +------- Actual Departure Time",
+    "* |    |  |     |  |     |     |     +- Comments"]
+V_LINE="* V    V  V     V  V     V     V     V"
+
+def station_codes(count=60,seed=0):
+    rnd=random.Random(seed)
+    codes=set()
+    while len(codes)<count:
+        codes.add("".join(rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for __ in range(3)))
+    return sorted(codes)
+
+def write_timezone_csv(path,codes,seed=0):
+    #a few codes are left out on purpose, the converter has to cope with unknown stations
+    rnd=random.Random(seed)
+    with open(path,"w") as f:
+        writer=csv.writer(f)
+        writer.writerow(["code","timezone"])
+        for code in codes[:-len(codes)//10]:
+            writer.writerow([code,rnd.choice(STATION_TIMEZONES)])
+
+def format_time(minutes):
+    hour,minute=divmod(minutes%(24*60),60)
+    return "%d%02d%s"%(hour%12 or 12,minute,"A" if hour<12 else "P")
+
+def format_delay(kind,delay,rnd):
+    if delay==0:
+        return "%s:  On time."%kind
+    hours,minutes=divmod(abs(delay),60)
+    amount="%d minutes"%minutes
+    if hours:
+        amount="%d hour%s, %s"%(hours,"s" if hours>1 else "",amount)
+    return "%s%s  %s %s."%(kind,":" if rnd.random()<0.8 else "",amount,"late" if delay>0 else "early")
+
+def make_status_file(rnd,train_id,codes):
+    #One '<train_id>_<YYYYMMDD>.txt' file in the starred fixed-width format. Some files get
+    #the oddities of the real data: no V-line, 'CD' and comment lines between the stations,
+    #a second copy of the whole file or a repeating block.
+    lines=["* Train %s"%train_id,"* Service disruption, see notes."]
+    lines+=HEADER_LINES
+    if rnd.random()>0.05:
+        lines+=[V_LINE]
+    stops=rnd.sample(codes,rnd.randint(2,min(20,len(codes))))
+    minutes=rnd.randint(0,24*60-1)
+    delay=rnd.randint(-10,30)
+    for nr,code in enumerate(stops):
+        first=nr==0
+        last=nr==len(stops)-1
+        if rnd.random()<0.03:
+            lines+=["CD"]
+        if rnd.random()<0.02:
+            lines+=["* Bus connection at this station."]
+        departure=minutes+(0 if first or last else rnd.randint(1,10))
+        delay=max(-30,delay+rnd.randint(-5,15))
+        if first:
+            comment=format_delay("Departed",delay,rnd)
+        elif last:
+            comment=format_delay("Arrived",delay,rnd)
+        else:
+            comment=format_delay("Arrived",delay,rnd)+"  |  "+format_delay("Departed",delay,rnd)
+        lines+=["* %-4s %-2s %-5s %-2s %-5s %-5s %-5s %s"%(code,
+            "*" if first else 1+minutes//(24*60),"*" if first else format_time(minutes),
+            "*" if last else 1+departure//(24*60),"*" if last else format_time(departure),
+            "*" if first else format_time(minutes+delay),"*" if last else format_time(departure+delay),
+            comment)]
+        minutes=departure+rnd.randint(20,200)
+    text="\n".join(lines)+"\n"
+    anomaly=rnd.random()
+    if anomaly<0.02:
+        text=text+text
+    elif anomaly<0.04:
+        text=text+"\n".join(lines[:4])+"\n"
+    return text
+
+def build_archive(path,years=(2016,),trains_per_month=100,nr_of_trains=50,seed=0,codes=None):
+    #yearly archive with one nested zip per month, like the original downloads
+    rnd=random.Random(seed)
+    codes=codes or station_codes(seed=seed)
+    train_ids=[str(rnd.randint(1,2000)) for __ in range(nr_of_trains)]
+    with zipfile.ZipFile(path,"w",zipfile.ZIP_DEFLATED) as outer:
+        for year in years:
+            for month in range(1,13):
+                inner_data=io.BytesIO()
+                with zipfile.ZipFile(inner_data,"w",zipfile.ZIP_DEFLATED) as inner:
+                    names=set()
+                    while len(names)<min(trains_per_month,nr_of_trains*28):
+                        names.add("%d%02d/%s_%d%02d%02d.txt"%(year,month,rnd.choice(train_ids),
+                            year,month,rnd.randint(1,28)))
+                    for name in sorted(names):
+                        inner.writestr(name,make_status_file(rnd,name.split("/")[1].split("_")[0],codes))
+                    inner.writestr("%d%02d/status.log"%(year,month),"")
+                outer.writestr("%d/%d%02d.zip"%(year,year,month),inner_data.getvalue())
+    return codes
+
+#--- benchmarks ---
+
+def peak_rss_mb():
+    if resource is None:
+        return float("nan")
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024 if sys.platform!="darwin" else peak/(1024*1024)
+
+def bench_conversion(archive,csv_code_timezone):
+    dw=DatasetWriter(os.devnull,os.devnull,csv_code_timezone)
+    with redirect_stdout(io.StringIO()):
+        start=time.perf_counter()
+        dw.convert_zip(archive,initial=True)
+        total=time.perf_counter()-start
+    files=dw.number_train
+    rows=dw.success_station
+    print("conversion: {} files, {} station rows in {:.2f}s: {:.0f} files/s, {:.0f} station rows/s, "
+        "peak RSS {:.1f} MB".format(files,rows,total,files/total,rows/total,peak_rss_mb()))
+
+    #Per-stage breakdown. Every stage is timed on its own, on the output of the previous
+    #one, so the numbers do not include any instrumentation overhead in the converter.
+    stages=[]
+    #the files were all seen by the conversion
+    dw.deduplicate=False
+    start=time.perf_counter()
+    blobs=[(name,txt_file.read()) for name,txt_file in dw._iter_zip(archive)]
+    stages+=[("unzip",time.perf_counter()-start)]
+
+    start=time.perf_counter()
+    texts=[(name,blob.decode().strip().split("\n")) for name,blob in blobs]
+    stages+=[("decode",time.perf_counter()-start)]
+
+    tokenizer=StationLineTokenizer.from_v_line(V_LINE_EXPECTED)
+    start=time.perf_counter()
+    tokenized=[(name,tokenizer.split_block(lines)) for name,lines in texts]
+    stages+=[("tokenize",time.perf_counter()-start)]
+
+    parser=TimeParser()
+    time_fields=[STATION_COLUMNS[name] for name in ["scheduled_arrival_time","scheduled_departure_time",
+        "actual_arrival_time","actual_departure_time"]]
+    work=[]
+    for name,rows in tokenized:
+        date=os.path.splitext(os.path.basename(name))[0].split("_")[1]
+        start_date=datetime.datetime(int(date[:4]),int(date[4:6]),int(date[6:8]))
+        for __,fields in rows:
+            code=fields[STATION_COLUMNS["station_code"]]
+            if len(code)==3 and STATION_CODE_RE.match(code):
+                tz=dw.code_to_timezone.get(code)
+                work+=[(start_date,fields[i],tz) for i in time_fields if len(fields[i])>1]
+    start=time.perf_counter()
+    for start_date,time_str,tz in work:
+        parser.parse(start_date,time_str,1,tz)
+    stages+=[("time parse",time.perf_counter()-start)]
+
+    with redirect_stdout(io.StringIO()):
+        parsed=[dw._parse_txt_file(io.BytesIO(blob),name) for name,blob in blobs]
+    parsed=[result for result in parsed if result is not None]
+    with open(os.devnull,"w") as devnull:
+        station_writer=BufferedCsvWriter(devnull,dw.station_writer_fieldnames)
+        train_writer=BufferedCsvWriter(devnull,dw.train_writer_fieldnames)
+        start=time.perf_counter()
+        for train,stations in parsed:
+            for station in stations:
+                station_writer.writerow(station)
+            train_writer.writerow(train)
+        station_writer.flush()
+        train_writer.flush()
+        stages+=[("write",time.perf_counter()-start)]
+
+    stages+=[("other (parse logic)",max(0,total-sum(t for __,t in stages)))]
+    for stage,seconds in stages:
+        print("  {:<20} {:7.3f}s {:5.1f}%".format(stage,seconds,100*seconds/total))
+
+def bench_time_parsing(number=20000):
+    timezone=pytz.timezone("America/New_York")
+    start_date=datetime.datetime(2016,5,12)
+    times=["1100A","1245P","104P","1159P","1200A","1230A","913P","13X5P"]
+    parser=TimeParser()
+    def run_baseline():
+        for time_str in times:
+            strptime_parse(start_date,time_str,2,timezone)
+    def run_parser():
+        for time_str in times:
+            parser.parse(start_date,time_str,2,timezone)
+    calls=number*len(times)
+    baseline=timeit.timeit(run_baseline,number=number)
+    fast=timeit.timeit(run_parser,number=number)
+    print("time parsing: strptime+localize {:.2f} us/call, TimeParser {:.2f} us/call ({:.1f}x)".format(
+        1e6*baseline/calls,1e6*fast/calls,baseline/fast))
+
+def bench_localization(number=20):
+    #every 37 minutes of 2016, so the DST transition days are part of it
+    name="America/New_York"
+    timezone=pytz.timezone(name)
+    zone=ZoneOffsets.from_pytz(name,datetime.date(2016,1,1).toordinal(),
+        datetime.date(2016,12,31).toordinal())
+    parser=TimeParser()
+    naives=[datetime.datetime(2016,1,1)+datetime.timedelta(minutes=37*i) for i in range(366*24*60//37)]
+    calls=number*len(naives)
+    results=[]
+    for name,localize in [("pytz localize",timezone.localize),
+            ("TimeParser day cache",lambda naive:parser.localize(timezone,naive)),
+            ("ZoneOffsets",zone.localize)]:
+        results+=[(name,timeit.timeit(lambda:[localize(naive) for naive in naives],number=number))]
+    print("localization: "+", ".join("{} {:.2f} us/call".format(name,1e6*seconds/calls)
+        for name,seconds in results))
+
+def bench_comment_parsing(number=20000):
+    dw=DatasetWriter(None,None,os.devnull)
+    comments=["Departed:  On time.","Arrived:  5 minutes late.","Departed  41 minutes late.",
+        "Arrived:  2 hours, 15 minutes late.  |  Departed:  2 hours, 9 minutes late.",
+        "Arrived:  3 minutes late.            |  Departed:  On time.","Arrived:  6 minutes early."]
+    def run_baseline():
+        for comment in comments:
+            regex_parse_comment(comment)
+    def run_parser():
+        for comment in comments:
+            dw._parse_comment(comment)
+    calls=number*len(comments)
+    baseline=timeit.timeit(run_baseline,number=number)
+    fast=timeit.timeit(run_parser,number=number)
+    print("comment parsing: re.match loop {:.2f} us/call, cached scanner {:.2f} us/call ({:.1f}x)".format(
+        1e6*baseline/calls,1e6*fast/calls,baseline/fast))
+
+def regex_parse_comment(comment):
+    #the way DatasetWriter._parse_comment used to work, kept as the baseline
+    ret=[]
+    while len(comment)>0:
+        m=re.match(r"[^A-Za-z]*(Arrived|Departed):? ([^|]*?)([oO]n time|late|early)(.*)$",comment)
+        if m is None:
+            break
+        if m.group(3)=="on time":
+            ret+=[(m.group(1),0)]
+        else:
+            time_m=re.match(r"\D*((\d+) [hH]our)?\D*((\d+) [mM]in)?\D*$",m.group(2))
+            if time_m is not None:
+                sign=1 if m.group(3)=="late" else -1
+                ret+=[(m.group(1),sign*(int(time_m.group(2) or 0)*60+int(time_m.group(4) or 0)))]
+        comment=m.group(4)
+    return ret
+
+def strptime_parse(start_date,time_str,day_offset,timezone):
+    #the way DatasetWriter._parse_time used to work, kept as the baseline
+    try:
+        time1=datetime.datetime.strptime((time_str+"M").rjust(6,"0"),"%I%M%p")
+        diff=time1-datetime.datetime(1900,1,1)
+        return timezone.localize(start_date+diff+datetime.timedelta(days=day_offset-1))
+    except ValueError:
+        return None
+
+def bench_csv_writing(number=20000):
+    timezone=pytz.timezone("America/New_York")
+    fieldnames=STATION_FIELDNAMES
+    rows=[]
+    for i in range(number):
+        scheduled=timezone.localize(datetime.datetime(2016,5,1+i%28,i%24,i%60))
+        actual=scheduled+datetime.timedelta(minutes=i%17)
+        rows+=[{"train_id":"90","station_code":"NYP","station_nr":i%20,"nr_of_stations":20,
+            "scheduled_arrival":scheduled,"actual_arrival":actual,"scheduled_departure":scheduled,
+            "actual_departure":actual,"arrival_delay":i%17,"departure_delay":i%17,"delay":i%17}]
+    def run(writer_class):
+        f=io.StringIO()
+        writer=writer_class(f,fieldnames)
+        for row in rows:
+            writer.writerow(row)
+        if hasattr(writer,"flush"):
+            writer.flush()
+        return f.getvalue()
+    assert run(csv.DictWriter)==run(BufferedCsvWriter)
+    baseline=timeit.timeit(lambda:run(csv.DictWriter),number=3)/3
+    fast=timeit.timeit(lambda:run(BufferedCsvWriter),number=3)/3
+    print("csv writing: DictWriter {:.0f} rows/s, BufferedCsvWriter {:.0f} rows/s ({:.1f}x)".format(
+        number/baseline,number/fast,baseline/fast))
+
+def rowwise_features(csv_train):
+    #the per-row computation of the notebooks, as baseline
+    features=[]
+    with open(csv_train) as f:
+        for row in csv.DictReader(f):
+            departure=row["scheduled_departure"] or row["actual_departure"]
+            departure=datetime.datetime.fromisoformat(departure) if departure else None
+            features+=[(departure.timestamp() if departure else None,
+                departure.weekday() if departure else None,
+                math.cos(2*math.pi*departure.timetuple().tm_yday/(365+int(departure.year%4==0)))
+                    if departure else None)]
+    return features
+
+def bench_features(archive,csv_code_timezone,tmp):
+    if importlib.util.find_spec("numpy") is None:
+        print("features: numpy is not installed")
+        return
+    from amtrak_features import build_features
+    csv_train=os.path.join(tmp,"trains.csv")
+    with redirect_stdout(io.StringIO()):
+        DatasetWriter(csv_train,os.devnull,csv_code_timezone).convert_zip(archive,initial=True)
+    start=time.perf_counter()
+    rows=len(rowwise_features(csv_train))
+    baseline=time.perf_counter()-start
+    start=time.perf_counter()
+    build_features(csv_train,workers=1)
+    vectorized=time.perf_counter()-start
+    start=time.perf_counter()
+    build_features(csv_train,chunk_bytes=256*1024)
+    parallel=time.perf_counter()-start
+    print("features: per row {:.0f} rows/s, numpy {:.0f} rows/s ({:.1f}x), numpy on all cores "
+        "{:.0f} rows/s".format(rows/baseline,rows/vectorized,baseline/vectorized,rows/parallel))
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description="Benchmarks of the status file converter "
+        "on a synthetic archive")
+    parser.add_argument("--years",type=int,default=1,help="number of years in the archive")
+    parser.add_argument("--trains-per-month",type=int,default=500)
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--archive",help="keep the generated archive (and stations_timezone.csv) "
+        "at this path instead of a temporary directory")
+    args=parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        archive=args.archive or os.path.join(tmp,"synthetic.zip")
+        csv_code_timezone=os.path.join(os.path.dirname(os.path.abspath(archive)),"stations_timezone.csv")
+        codes=build_archive(archive,years=range(2016,2016+args.years),
+            trains_per_month=args.trains_per_month,seed=args.seed)
+        write_timezone_csv(csv_code_timezone,codes,args.seed)
+        bench_conversion(archive,csv_code_timezone)
+        bench_features(archive,csv_code_timezone,tmp)
+    bench_time_parsing()
+    bench_localization()
+    bench_comment_parsing()
+    bench_csv_writing()
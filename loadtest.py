@@ -0,0 +1,105 @@
+#Load test of amtrak_service: concurrent keep-alive clients query random (train_id, station_code,
+#weekday) keys of a station csv and the latency percentiles are reported.
+#   python loadtest.py --stations stations.csv --requests 20000 --clients 16
+#Without --url the service is started on the station csv in a separate process, without
+#--stations a synthetic archive (see benchmark.py) is converted first.
+import os
+import io
+import sys
+import csv
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+def sample_keys(csv_station,count=1000,seed=0):
+    #(train_id, station_code) pairs of the csv
+    with open(csv_station,newline="") as f:
+        keys=sorted({(row["train_id"],row["station_code"]) for row in csv.DictReader(f)})
+    return random.Random(seed).sample(keys,min(count,len(keys)))
+
+def synthetic_stations(tmp,years=1,trains_per_month=500,seed=0):
+    from benchmark import build_archive, write_timezone_csv
+    from amtrak_dataset import DatasetWriter
+    archive=os.path.join(tmp,"synthetic.zip")
+    csv_code_timezone=os.path.join(tmp,"stations_timezone.csv")
+    codes=build_archive(archive,years=range(2016,2016+years),trains_per_month=trains_per_month,seed=seed)
+    write_timezone_csv(csv_code_timezone,codes,seed)
+    csv_station=os.path.join(tmp,"stations.csv")
+    with redirect_stdout(io.StringIO()):
+        DatasetWriter(os.path.join(tmp,"trains.csv"),csv_station,csv_code_timezone).convert_zip(archive,initial=True)
+    return csv_station
+
+def start_service(csv_station):
+    #(process, host, port) of a service on a free port
+    service=subprocess.Popen([sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "amtrak_service.py"),csv_station,"--port","0"],stdout=subprocess.PIPE,text=True)
+    for line in service.stdout:
+        if line.startswith("serving on "):
+            host,port=line[len("serving on "):].strip("()\n").split(", ")
+            return service,host.strip("'"),int(port)
+    raise RuntimeError("the service did not start")
+
+async def client(host,port,paths,latencies):
+    reader,writer=await asyncio.open_connection(host,port)
+    try:
+        for path in paths:
+            start=time.perf_counter()
+            writer.write("GET {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(path,host).encode())
+            status=await reader.readline()
+            length=0
+            while True:
+                line=await reader.readline()
+                if line in (b"\r\n",b""):
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length=int(line.split(b":")[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter()-start)
+            if b" 200 " not in status:
+                raise RuntimeError("{} answered {}".format(path,status.decode().strip()))
+    finally:
+        writer.close()
+
+async def run(host,port,keys,requests,clients,seed=0):
+    rnd=random.Random(seed)
+    paths=["/delay?train_id={}&station_code={}&weekday=all".format(*rnd.choice(keys))
+        for __ in range(requests)]
+    latencies=[]
+    start=time.perf_counter()
+    await asyncio.gather(*[client(host,port,paths[i::clients],latencies) for i in range(clients)])
+    return latencies,time.perf_counter()-start
+
+def report(latencies,total):
+    latencies=sorted(latencies)
+    percentile=lambda q:latencies[min(len(latencies)-1,max(0,-(-q*len(latencies)//100)-1))]*1000
+    print("{} requests in {:.2f}s: {:.0f} requests/s, p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms".format(
+        len(latencies),total,len(latencies)/total,percentile(50),percentile(99),latencies[-1]*1000))
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description="Load test of the delay query service")
+    parser.add_argument("--stations",help="station csv to sample the queried keys from (and to "
+        "serve without --url), a synthetic one by default")
+    parser.add_argument("--url",help="host:port of a running service")
+    parser.add_argument("--requests",type=int,default=20000)
+    parser.add_argument("--clients",type=int,default=16,help="concurrent connections")
+    parser.add_argument("--seed",type=int,default=0)
+    args=parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_station=args.stations or synthetic_stations(tmp,seed=args.seed)
+        keys=sample_keys(csv_station,seed=args.seed)
+        service=None
+        if args.url:
+            host,port=args.url.rsplit(":",1)
+            port=int(port)
+        else:
+            service,host,port=start_service(csv_station)
+        try:
+            report(*asyncio.run(run(host,port,keys,args.requests,args.clients,args.seed)))
+        finally:
+            if service is not None:
+                service.terminate()
+                service.wait()
@@ -1,10 +1,51 @@
 import unittest
-from amtrak_dataset import DatasetWriter
+from amtrak_dataset import (DatasetWriter, StationLineTokenizer, TimeParser, BufferedCsvWriter,
+    TimezoneIndex, RecordStore, RecordStoreWriter, DelayAggregates, read_partitioned,
+    read_partitioned_frame, StationRecord, TrainRecord, V_LINE_EXPECTED, iter_trains)
+from amtrak_service import DelayService
 from contextlib import redirect_stdout
 import io
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta, date
 from pytz import timezone
+import os
+import tempfile
+import zipfile
+import importlib.util
+import json
+import asyncio
+import math
+import pstats
+import subprocess
+import sys
+import time
+import random
+
+SAMPLE_TRAIN="""* Ethan Allen Express
+* +---------------- Station code
+* |    +----------- Schedule Arrival Day  
+* |    |  +-------- Schedule Arrival time
+* |    |  |     +----- Schedule Departure Day
+* |    |  |     |  +-- Schedule Departure Time 
+* |    |  |     |  |     +------------- Actual Arrival Time
+* |    |  |     |  |     |     +------- Actual Departure Time
+* |    |  |     |  |     |     |     +- Comments
+* V    V  V     V  V     V     V     V
+* ALB  *  *     1  1100A *     1107A Departed:  7 minutes late.
+* HUD  *  *     1  1125A *     1130A Departed:  5 minutes late.
+* RHI  *  *     1  1146A *     1151A Departed:  5 minutes late.
+* NYP  1  135P  *  *     131P  *     Arrived:  4 minutes early."""
+
+def make_archive(path,files):
+    #builds a yearly archive the way the originals are nested: one inner zip per month
+    with zipfile.ZipFile(path,"w") as outer:
+        inner_data=io.BytesIO()
+        with zipfile.ZipFile(inner_data,"w") as inner:
+            for fn,text in files[:len(files)//2]:
+                inner.writestr(fn,text)
+        outer.writestr("2010/201005.zip",inner_data.getvalue())
+        for fn,text in files[len(files)//2:]:
+            outer.writestr(fn,text)
 
 class TestParsing(unittest.TestCase):
 
@@ -17,6 +58,20 @@ class TestParsing(unittest.TestCase):
         self.assertEqual(dw._parse_comment("Arrived:  2 hours, 22 minutes late."),[("Arrived",2*60+22)])
         self.assertEqual(dw._parse_comment("Arrived  32 minutes late.  Estimated departure:  1 hour and 35 minutes late."),[("Arrived",32)])
         self.assertEqual(dw._parse_comment("Departed:  52 Minutes late."),[("Departed",52)])
+
+    def test_comment_cache(self):
+        dw=DatasetWriter("/dev/null","/dev/null",quiet=True)
+        for i in range(3):
+            result=dw._parse_comment("Arrived:  3 minutes late.  |  Departed:  On time.")
+            self.assertEqual(result,[("Arrived",3),("Departed",0)])
+            result.append(None) #callers get their own list
+            #diagnostics are repeated for every occurrence, cached or not
+            self.assertEqual(dw._parse_comment("Arrived:  3 4 late.  |  Departed:  On time."),
+                [("Departed",0)])
+        dw._record_cache_stats()
+        self.assertEqual(dw.stats.caches,{"comment":[4,2]})
+        self.assertEqual(dw.stats.hit_rate("comment"),4/6)
+        self.assertEqual(dw.stats.anomalies,{"unparsable-comment":3})
         
     def test_missing_v_line(self):
         dw=DatasetWriter("/dev/null","/dev/null")
@@ -51,6 +106,124 @@ class TestParsing(unittest.TestCase):
         #print(s)
         self.assertIn("'V-line'",s)
         self.assertNotIn("Traceback",s)
+        self.assertEqual(dw.stats.anomalies,{"missing-v-line":1})
+        
+    def test_tokenizer(self):
+        tokenizer=StationLineTokenizer.from_v_line(V_LINE_EXPECTED)
+        self.assertIs(tokenizer,StationLineTokenizer.from_v_line(V_LINE_EXPECTED))
+        self.assertEqual(tokenizer.split("* NYP  1  135P  *  *     131P  *     Arrived:  4 minutes early."),
+            ["*","NYP","1","135P","*","*","131P","*","Arrived:  4 minutes early."])
+        self.assertEqual(tokenizer.split("* ALB"),["*","ALB","","","","","","",""])
+        rows=tokenizer.split_block(["* ALB  *  *     1  1100A *     1107A Departed:  7 minutes late.","CD "])
+        self.assertEqual(len(rows),1)
+        self.assertEqual(rows[0][1][5],"1100A")
+        self.assertEqual(StationLineTokenizer.from_v_line("V V").split("* ALB"),["*","ALB"])
+        
+    def test_time_parser(self):
+        parser=TimeParser()
+        def strptime_minutes(time_str):
+            try:
+                time1=datetime.strptime((time_str+"M").rjust(6,"0"),"%I%M%p")
+                return time1.hour*60+time1.minute
+            except ValueError:
+                return None
+        for time_str in ["1100A","104P","0104P","1200A","1259P","1P","13X5P","1360A","104p","*","","10000A"]:
+            self.assertEqual(parser.minutes(time_str),strptime_minutes(time_str),time_str)
+        for time_str,minutes in TimeParser._minutes.items():
+            self.assertEqual(minutes,strptime_minutes(time_str),time_str)
+        self.assertEqual(parser.parse(datetime(2012,5,12),"1245A",2),datetime(2012,5,13,0,45))
+        self.assertIsNone(parser.parse(datetime(2012,5,12),"13X5P",1,timezone("America/Phoenix")))
+        
+    def test_time_parser_dst(self):
+        parser=TimeParser()
+        for tz_name in ["America/New_York","America/Phoenix"]:
+            tz=timezone(tz_name)
+            for day in [datetime(2016,3,13),datetime(2016,11,6),datetime(2016,11,7)]:
+                for minutes in range(0,24*60,10):
+                    naive=day+timedelta(minutes=minutes)
+                    self.assertEqual(str(parser.localize(tz,naive)),str(tz.localize(naive)))
+        self.assertEqual(str(parser.parse(datetime(2016,3,13),"230A",1,timezone("America/New_York"))),
+            "2016-03-13 02:30:00-05:00")
+        self.assertEqual(str(parser.parse(datetime(2016,11,6),"130A",1,timezone("America/New_York"))),
+            "2016-11-06 01:30:00-05:00")
+        
+    def test_timezone_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_code_timezone=os.path.join(tmp,"stations_timezone.csv")
+            with open(csv_code_timezone,"w") as f:
+                f.write("code,name,timezone\nNYP,New York,EST\nFLG,Flagstaff,MST/Arizona\n"
+                    "XXX,Nowhere,???\n")
+            cache=os.path.join(tmp,"timezones.bin")
+            index=TimezoneIndex.cached(csv_code_timezone,cache)
+            self.assertTrue(os.path.exists(cache))
+            self.assertNotIn("XXX",index)
+            loaded=TimezoneIndex.cached(csv_code_timezone,cache)
+            self.assertEqual(loaded.source,index.source)
+            for code,tz_name in [("NYP","America/New_York"),("FLG","America/Phoenix")]:
+                tz=timezone(tz_name)
+                for day in [datetime(2007,3,11),datetime(2007,11,4),datetime(2016,3,13),
+                        datetime(2016,11,6),datetime(2016,11,7),datetime(2006,4,2)]:
+                    for minutes in range(0,24*60,10):
+                        naive=day+timedelta(minutes=minutes)
+                        self.assertEqual(str(index.get(code).localize(naive)),str(tz.localize(naive)))
+                        self.assertEqual(str(loaded.get(code).localize(naive)),str(tz.localize(naive)))
+            nyp=loaded.get("NYP")
+            #spring forward: the non-existent 2:30 is standard time, 3:00 is daylight time
+            self.assertEqual(str(nyp.localize(datetime(2016,3,13,1,59))),"2016-03-13 01:59:00-05:00")
+            self.assertEqual(str(nyp.localize(datetime(2016,3,13,2,30))),"2016-03-13 02:30:00-05:00")
+            self.assertEqual(str(nyp.localize(datetime(2016,3,13,3,0))),"2016-03-13 03:00:00-04:00")
+            #fall back: the repeated hour is standard time
+            self.assertEqual(str(nyp.localize(datetime(2016,11,6,0,59))),"2016-11-06 00:59:00-04:00")
+            self.assertEqual(str(nyp.localize(datetime(2016,11,6,1,30))),"2016-11-06 01:30:00-05:00")
+            #a changed csv file invalidates the cache
+            with open(csv_code_timezone,"a") as f:
+                f.write("CHI,Chicago,CST\n")
+            self.assertIn("CHI",TimezoneIndex.cached(csv_code_timezone,cache))
+            self.assertIn("CHI",TimezoneIndex.load(cache))
+
+    def test_buffered_csv_writer(self):
+        tz=timezone("America/New_York")
+        fieldnames=["train_id","scheduled_arrival","actual_arrival","delay"]
+        rows=[{"train_id":"90","scheduled_arrival":tz.localize(datetime(2016,11,6,1,30)),
+                "actual_arrival":tz.localize(datetime(2016,11,6,1,30),is_dst=True),"delay":None},
+            {"train_id":"9,1","scheduled_arrival":datetime(2016,3,13,2,30),
+                "actual_arrival":tz.localize(datetime(2016,3,13,3,5,30)),"delay":-3},
+            {"train_id":"92","delay":12}]
+        expected=io.StringIO()
+        writer=csv.DictWriter(expected,fieldnames)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+        result=io.StringIO()
+        writer=BufferedCsvWriter(result,fieldnames,buffer_size=2)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+        writer.flush()
+        self.assertEqual(expected.getvalue(),result.getvalue())
+        
+    def test_records(self):
+        dw=DatasetWriter("/dev/null","/dev/null")
+        class Collector(list):
+            writerow=list.append
+        dw.csv_station_writer=Collector()
+        dw.csv_train_writer=Collector()
+        dw._handle_txt_file(io.BytesIO(SAMPLE_TRAIN.encode()),"290_20100517.txt")
+        stations=dw.csv_station_writer
+        self.assertEqual([type(s) for s in stations],[StationRecord]*4)
+        self.assertEqual([s.station_code for s in stations],["ALB","HUD","RHI","NYP"])
+        self.assertEqual(stations[0].departure_delay,7)
+        self.assertEqual(stations[-1].nr_of_stations,4)
+        train=dw.csv_train_writer[0]
+        self.assertIsInstance(train,TrainRecord)
+        self.assertEqual((train.origin_station_code,train.destination_station_code,train.delay),("ALB","NYP",-4))
+        self.assertFalse(hasattr(train,"__dict__"))
+        #records still work with csv.DictWriter
+        f=io.StringIO()
+        csv.DictWriter(f,dw.train_writer_fieldnames).writerow(train)
+        self.assertEqual(f.getvalue().split(",")[:3],["290","4","ALB"])
+        self.assertEqual(train.as_dict()["destination_station_code"],"NYP")
+        self.assertEqual(StationRecord("90",delay=3),StationRecord("90",delay=3))
         
     def handle_file(self,path,initial=True):
         dw=DatasetWriter("/dev/null","/dev/null")
@@ -159,5 +332,581 @@ class TestParsing(unittest.TestCase):
         #self.assertEqual(st,"")
 
 
+class TestConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.files=[("2010/{}_201005{:02d}.txt".format(train_id,day),SAMPLE_TRAIN)
+            for train_id in ["290","291"] for day in range(10,20)]
+        self.archive=os.path.join(self.tmp.name,"2010.zip")
+        make_archive(self.archive,self.files)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def convert(self,name,convert,**kwargs):
+        dw=DatasetWriter(os.path.join(self.tmp.name,name+"_trains.csv"),
+            os.path.join(self.tmp.name,name+"_stations.csv"),**kwargs)
+        f=io.StringIO()
+        with redirect_stdout(f):
+            convert(dw)
+        with open(dw.csv_train) as csv_train, open(dw.csv_station) as csv_station:
+            return csv_train.read(),csv_station.read(),f.getvalue()
+
+    def test_convert_many(self):
+        expected=self.convert("seq",lambda dw:[dw.convert_zip(self.archive,initial=True),
+            dw.convert_zip(self.archive)],deduplicate=False)
+        result=self.convert("par",lambda dw:dw.convert_many([self.archive,self.archive],
+            workers=2,initial=True,chunk_size=3),deduplicate=False)
+        self.assertEqual(expected[:2],result[:2])
+        summary=lambda log:[line for line in log.split("\n") if line.startswith("Converted")]
+        self.assertEqual(summary(expected[2]),summary(result[2]))
+        self.assertIn("Success with 20 out of 20 trains",result[2])
+        self.assertEqual(result[0].count("NYP"),40)
+
+    def test_bounded_map(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from amtrak_dataset import _bounded_map
+        submitted=[]
+        with ThreadPoolExecutor(2) as executor:
+            submit=executor.submit
+            executor.submit=lambda *args:submitted.append(1) or submit(*args)
+            results=[]
+            for result in _bounded_map(executor,lambda x:x*x,range(20),4):
+                #the consumed results and at most 4 more
+                self.assertLessEqual(len(submitted),len(results)+4)
+                results+=[result]
+        self.assertEqual(results,[x*x for x in range(20)])
+
+    def test_duplicates(self):
+        #the next year's archive overlaps, one file of the overlap was changed
+        overlap=os.path.join(self.tmp.name,"2011.zip")
+        changed=SAMPLE_TRAIN.replace("Arrived:  4 minutes early.","Arrived:  5 minutes early.")
+        make_archive(overlap,[("2010/291_20100519.txt",changed)]+self.files[10:]+
+            [("2011/290_20110101.txt",SAMPLE_TRAIN)])
+        expected=self.convert("seq",lambda dw:[dw.convert_zip(self.archive,initial=True),
+            dw.convert_zip(overlap)])
+        self.assertIn("Success with 1 out of 1 trains",expected[2])
+        self.assertEqual(expected[0].count("\n291,"),10)
+        self.assertEqual(expected[2].count("already converted from another archive"),10)
+        self.assertEqual(expected[2].count("differs from an already converted file"),1)
+        result=self.convert("par",lambda dw:dw.convert_many([self.archive,overlap],workers=2,
+            initial=True,chunk_size=3))
+        self.assertEqual(expected[:2],result[:2])
+        summary=lambda log:[line for line in log.split("\n") if line.startswith("Converted")]
+        self.assertEqual(summary(expected[2]),summary(result[2]))
+
+    def test_duplicates_manifest(self):
+        #the manifest is kept per archive, the conflicting file of the overlap stays a
+        #duplicate in every incremental run
+        overlap=os.path.join(self.tmp.name,"2011.zip")
+        changed=SAMPLE_TRAIN.replace("Arrived:  4 minutes early.","Arrived:  5 minutes early.")
+        make_archive(overlap,[("2010/291_20100519.txt",changed)]+self.files[10:])
+        expected=self.convert("seq",lambda dw:[dw.convert_zip(self.archive,initial=True),
+            dw.convert_zip(overlap)])
+        self.assertEqual(expected[0].count("\n291,"),10)
+        for name,convert in [("zip",lambda dw,initial:[dw.convert_zip(self.archive,initial=initial),
+                dw.convert_zip(overlap)]),
+                ("many",lambda dw,initial:dw.convert_many([self.archive,overlap],workers=2,
+                initial=initial,chunk_size=3))]:
+            manifest=os.path.join(self.tmp.name,name+"_manifest.json")
+            aggregates=os.path.join(self.tmp.name,name+"_aggregates.json")
+            for initial in [True,False,False]:
+                result=self.convert(name,lambda dw:convert(dw,initial),manifest=manifest,
+                    aggregates=aggregates)
+                self.assertEqual(expected[:2],result[:2],name)
+                self.assertEqual(DelayAggregates.load(aggregates).count("train_id"),{"290":10,"291":10})
+            self.assertNotIn("changed since last conversion",result[2])
+        #a member that changed in its own archive is reported and skipped, the rows converted
+        #first stay
+        changed=SAMPLE_TRAIN.replace("Arrived:  4 minutes early.","Arrived:  3 minutes early.")
+        make_archive(overlap,[("2010/291_20100519.txt",changed)]+self.files[10:19])
+        aggregates=os.path.join(self.tmp.name,"zip_aggregates.json")
+        result=self.convert("zip",lambda dw:[dw.convert_zip(self.archive),dw.convert_zip(overlap)],
+            manifest=os.path.join(self.tmp.name,"zip_manifest.json"),aggregates=aggregates)
+        self.assertEqual(result[2].count("changed since last conversion, the converted version "
+            "stays, skipping\n2010/291_20100519.txt"),1)
+        self.assertEqual(result[0].count("\n291,"),10)
+        self.assertEqual(result[0],expected[0])
+        self.assertEqual(DelayAggregates.load(aggregates).count("train_id"),{"290":10,"291":10})
+
+    def test_repeating_block(self):
+        dw=DatasetWriter(None,None)
+        text=SAMPLE_TRAIN+"\n"+"* Service disruption.\n"*5000+SAMPLE_TRAIN
+        f=io.StringIO()
+        with redirect_stdout(f):
+            train,stations=dw._parse_txt_file(io.BytesIO(text.encode()),"290_20100517.txt")
+        self.assertIn("repeating at line 5014",f.getvalue())
+        self.assertEqual(dw.stats.anomalies,{"repeating-block":1})
+        self.assertEqual(len(stations),4)
+
+    def test_cold_start(self):
+        #A short job, the command line converting one small archive with a timezone cache,
+        #in a fresh interpreter. It takes about 0.1s, the budget leaves room for slow machines.
+        #pytz, asyncio and the process pools are not needed for it and must not be loaded.
+        budget=1.0
+        path=lambda name:os.path.join(self.tmp.name,name)
+        with open(path("timezones.csv"),"w") as f:
+            f.write("code,name,timezone\n"+"".join("{0},{0},EST\n".format(code)
+                for code in ["ALB","HUD","RHI","NYP"]))
+        make_archive(self.archive,self.files[:2])
+        TimezoneIndex.cached(path("timezones.csv"),path("timezones.bin"))
+        code=("import sys,time\nstart=time.perf_counter()\nimport amtrak_dataset\n"
+            "amtrak_dataset.main(sys.argv[1:])\nprint(time.perf_counter()-start)\n"
+            "print(sorted(name for name in ['pytz','asyncio','multiprocessing','concurrent.futures']"
+            " if name in sys.modules))")
+        env=dict(os.environ,PYTHONPATH=os.path.dirname(importlib.util.find_spec("amtrak_dataset").origin))
+        start=time.perf_counter()
+        result=subprocess.run([sys.executable,"-c",code,self.archive,"--trains",path("trains.csv"),
+            "--stations",path("stations.csv"),"--timezones",path("timezones.csv"),"--timezone-cache",
+            path("timezones.bin"),"--mode","sequential"],capture_output=True,text=True,env=env,
+            cwd=self.tmp.name)
+        elapsed=time.perf_counter()-start
+        self.assertEqual(result.returncode,0,result.stderr)
+        self.assertEqual(result.stdout.split("\n")[-2],"[]")
+        self.assertLess(elapsed,budget)
+        with open(path("trains.csv")) as f:
+            self.assertEqual(len(f.readlines()),3)
+
+    def test_prebuilt_timezones(self):
+        #nothing is read from the (missing) csv when the mapping is given
+        tz=timezone("America/New_York")
+        dw=DatasetWriter(None,None,"missing.csv",timezones={"ALB":tz,"NYP":tz})
+        train,stations=dw._parse_txt_file(io.BytesIO(SAMPLE_TRAIN.encode()),"290_20100517.txt")
+        self.assertEqual(stations[0].scheduled_departure,tz.localize(datetime(2010,5,17,11)))
+        self.assertEqual(train.scheduled_arrival,tz.localize(datetime(2010,5,17,13,35)))
+        with self.assertRaises(FileNotFoundError):
+            DatasetWriter(None,None,"missing.csv").iter_trains(self.archive).__next__()
+
+    def test_text_variants(self):
+        #surrounding whitespace (str.strip's), non-ASCII names and doubled files give the same records
+        dw=DatasetWriter(None,None,quiet=True)
+        parse=lambda text:dw._parse_txt_file(io.BytesIO(text.encode()),"290_20100517.txt")
+        train,stations=parse("\n "+SAMPLE_TRAIN+"\n\n")
+        for text in [SAMPLE_TRAIN.replace("Ethan","\u00c9than"),"\x1c"+SAMPLE_TRAIN+"\x1f",
+                (SAMPLE_TRAIN+"\n")*2]:
+            other_train,other_stations=parse(text)
+            self.assertEqual(train,other_train)
+            self.assertEqual(stations,other_stations)
+        self.assertEqual(dw.stats.anomalies,{"double-file":1})
+
+    def test_convert_pipelined(self):
+        make_archive(self.archive,self.files+[("2010/292_20100520.txt",SAMPLE_TRAIN*2)])
+        expected=self.convert("seq",lambda dw:dw.convert_zip(self.archive,initial=True))
+        summary=lambda log:[line for line in log.split("\n") if line.startswith(("Converted","double"))]
+        for parsers in [0,2]:
+            def convert(dw):
+                dw.convert_pipelined(self.archive,initial=True,parsers=parsers,queue_size=2)
+                self.stats=dw.stats
+            result=self.convert("pipe",convert)
+            self.assertEqual(expected[:2],result[:2])
+            self.assertEqual(summary(expected[2]),summary(result[2]))
+            self.assertIn("Pipeline: reader busy",result[2])
+            self.assertEqual(self.stats.anomalies,{"double-file":1})
+            self.assertIn("pipeline-writer-starved",self.stats.timers)
+
+    def test_memory_ceiling(self):
+        expected=self.convert("default",lambda dw:dw.convert_zip(self.archive,initial=True))
+        #the inner archive does not fit and has to be spilled to disk
+        result=self.convert("spilled",lambda dw:dw.convert_zip(self.archive,initial=True),
+            max_memory=2048)
+        self.assertEqual(expected[:2],result[:2])
+        self.assertIn("Peak memory usage",result[2])
+        #train files are not limited by max_memory, only by max_file_size
+        result=self.convert("small",lambda dw:dw.convert_zip(self.archive,initial=True),
+            max_memory=100)
+        self.assertEqual(expected[:2],result[:2])
+        self.assertNotIn("file too large",result[2])
+        for name,convert in [("skipped",lambda dw:dw.convert_zip(self.archive,initial=True)),
+                ("skipped_many",lambda dw:dw.convert_many([self.archive],workers=2,initial=True))]:
+            result=self.convert(name,convert,max_file_size=100)
+            self.assertEqual(result[2].count("file too large"),20)
+            self.assertNotIn("NYP",result[0])
+
+    def test_iter_trains(self):
+        trains=iter_trains(self.archive)
+        train,stations=next(trains)
+        self.assertIsInstance(train,TrainRecord)
+        self.assertEqual(train.train_id,"290")
+        self.assertEqual([s.station_code for s in stations],["ALB","HUD","RHI","NYP"])
+        rest=list(trains)
+        self.assertEqual(len(rest),19)
+        csv_train,csv_station,__=self.convert("csv",lambda dw:dw.convert_zip(self.archive,initial=True))
+        rows=list(csv.DictReader(io.StringIO(csv_train)))
+        self.assertEqual([row["train_id"] for row in rows],[train.train_id]+[t.train_id for t,__ in rest])
+        self.assertEqual(rows[-1]["scheduled_arrival"],str(rest[-1][0].scheduled_arrival))
+        #the manifest of earlier conversions does not hide trains and the counters start over
+        path=lambda name:os.path.join(self.tmp.name,name)
+        dw=DatasetWriter(path("manifest_trains.csv"),path("manifest_stations.csv"),
+            manifest=path("iter_manifest.json"))
+        with redirect_stdout(io.StringIO()):
+            dw.convert_zip(self.archive,initial=True)
+            dw.convert_zip(self.archive)
+            self.assertEqual(len(list(dw.iter_trains(self.archive))),20)
+            self.assertEqual(len(list(dw.iter_trains(self.archive))),20)
+        self.assertEqual((dw.success_train,dw.number_train,dw.skipped),(20,20,0))
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"),"pyarrow is not installed")
+    def test_parquet_output(self):
+        import pyarrow.parquet
+        csv_train,csv_station,__=self.convert("csv",lambda dw:dw.convert_zip(self.archive,initial=True))
+        path=lambda name:os.path.join(self.tmp.name,name)
+        for run in range(2):
+            dw=DatasetWriter(path("trains"),path("stations"),output_format="parquet",row_group_size=7)
+            with redirect_stdout(io.StringIO()):
+                dw.convert_zip(self.archive,initial=run==0)
+        stations=pyarrow.parquet.read_table(path("stations"))
+        self.assertEqual(len(os.listdir(path("stations"))),2)
+        self.assertEqual(stations.num_rows,2*(len(csv_station.split("\n"))-2))
+        self.assertEqual(str(stations.schema.field("delay").type),"int16")
+        self.assertTrue(str(stations.schema.field("station_code").type).startswith("dictionary"))
+        rows=list(csv.DictReader(io.StringIO(csv_station)))
+        first=stations.slice(0,1).to_pylist()[0]
+        self.assertEqual(first["station_code"],rows[0]["station_code"])
+        self.assertEqual(first["delay"],int(rows[0]["delay"]))
+        self.assertEqual(first["scheduled_departure"],
+            datetime.fromisoformat(rows[0]["scheduled_departure"]))
+        trains=pyarrow.parquet.read_table(path("trains"))
+        self.assertEqual(trains.num_rows,40)
+
+    def test_record_store(self):
+        csv_train,csv_station,__=self.convert("csv",lambda dw:dw.convert_zip(self.archive,initial=True))
+        path=lambda name:os.path.join(self.tmp.name,name)
+        for run in range(2):
+            dw=DatasetWriter(path("trains"),path("stations"),output_format="store")
+            with redirect_stdout(io.StringIO()):
+                dw.convert_zip(self.archive,initial=run==0)
+        rows=list(csv.DictReader(io.StringIO(csv_station)))
+        with RecordStore(path("stations")) as stations:
+            self.assertEqual(len(stations),2*len(rows))
+            first=stations[0]
+            self.assertEqual(first["station_code"],rows[0]["station_code"])
+            self.assertEqual(first["delay"],int(rows[0]["delay"]))
+            self.assertIsNone(first["scheduled_arrival"])
+            self.assertEqual(first["scheduled_departure"],
+                datetime.fromisoformat(rows[0]["scheduled_departure"]))
+            self.assertTrue(first["localized"])
+            selected=stations.select(train_id="290",start=date(2010,5,12),end=date(2010,5,14))
+            self.assertIsInstance(selected,memoryview)
+            self.assertEqual(len(selected),2*2*4)
+            days={stations[position]["scheduled_departure"] or stations[position]["scheduled_arrival"]
+                for position in selected}
+            self.assertEqual({day.date() for day in days},{date(2010,5,12),date(2010,5,13)})
+            self.assertEqual(len(stations.select(train_id="290",station_code="NYP")),20)
+            self.assertEqual(len(stations.select(train_id="999")),0)
+            self.assertEqual(len(stations.select(start=date(2010,5,19))),2*2*4)
+            self.assertEqual(stations.counts("train_id"),{"290":80,"291":80})
+            del selected
+        with RecordStore(path("trains")) as trains:
+            self.assertEqual(len(trains),40)
+            self.assertEqual(trains.counts("destination_station_code"),{"NYP":40})
+
+    def test_record_store_append(self):
+        #indexes merged with appended records (new strings, unknown values, earlier days) are
+        #the same as built from scratch
+        fieldnames=["train_id","station_code","scheduled_departure"]
+        rnd=random.Random(0)
+        row=lambda:{"train_id":rnd.choice([None,"290","291",str(rnd.randint(0,99))]),
+            "station_code":rnd.choice([None,"ALB","NYP"]),"scheduled_departure":rnd.choice([None,
+            datetime(2010,1,1)+timedelta(days=rnd.randint(0,100))])}
+        path=lambda name:os.path.join(self.tmp.name,name)
+        files=lambda name:{fn:open(os.path.join(path(name),fn),"rb").read() for fn in os.listdir(path(name))}
+        rows=[]
+        for run,count in enumerate([200,0,1,50,300]):
+            new_rows=[row() for __ in range(count)]
+            rows+=new_rows
+            for name,initial,written in [("appended",run==0,new_rows),("rebuilt",True,rows)]:
+                writer=RecordStoreWriter(path(name),fieldnames,initial)
+                for values in written:
+                    writer.writerow(values)
+                writer.close()
+            self.assertEqual(files("appended"),files("rebuilt"))
+        with RecordStore(path("appended")) as store:
+            self.assertEqual(len(store),551)
+            self.assertEqual(len(store.select(train_id="290")),sum(r["train_id"]=="290" for r in rows))
+
+    def test_partitioned(self):
+        make_archive(self.archive,self.files+[("2010/290_20100601.txt",SAMPLE_TRAIN)])
+        csv_train,csv_station,__=self.convert("csv",lambda dw:dw.convert_zip(self.archive,initial=True))
+        stations=os.path.join(self.tmp.name,"stations")
+        for run in range(2):
+            dw=DatasetWriter(os.path.join(self.tmp.name,"trains"),stations,output_format="partitioned",
+                shards=2,buffer_size=7)
+            with redirect_stdout(io.StringIO()):
+                dw.convert_many([self.archive],workers=2,initial=True)
+        with open(os.path.join(stations,"_partitions.json")) as f:
+            metadata=json.load(f)
+        self.assertEqual(sorted({os.path.dirname(name) for name in metadata["files"]}),
+            ["year=2010/month=05","year=2010/month=06"])
+        june=[info for name,info in metadata["files"].items() if "month=06" in name]
+        rows=list(csv.DictReader(io.StringIO(csv_station)))
+        self.assertEqual(june[0]["rows"],4)
+        departures=[datetime.fromisoformat(row["scheduled_departure"]).timestamp() for row in rows
+            if row["scheduled_departure"].startswith("2010-06")]
+        self.assertEqual(june[0]["min_timestamp"],int(min(departures)))
+        key=lambda row:(row["train_id"],row["scheduled_departure"],row["station_code"])
+        self.assertIsInstance(read_partitioned(stations),list)
+        self.assertEqual(sorted(read_partitioned(stations),key=key),sorted(rows,key=key))
+        selected=read_partitioned(stations,start=date(2010,5,19),end=date(2010,6,2),
+            train_ids=["290"],workers=1)
+        self.assertEqual(len(selected),2*4)
+        self.assertEqual({row["train_id"] for row in selected},{"290"})
+        self.assertEqual(len(read_partitioned(stations,start=date(2010,6,1))),4)
+        self.assertEqual(len(read_partitioned(os.path.join(self.tmp.name,"trains"))),21)
+        if importlib.util.find_spec("pandas"):
+            frame=read_partitioned_frame(stations,start=date(2010,5,19),end=date(2010,6,2),
+                train_ids=["290"],workers=1)
+            #delay columns with missing values are read as floats
+            self.assertEqual(sorted(map(key,frame.fillna("").to_dict("records"))),
+                sorted(map(key,selected)))
+            self.assertEqual(len(read_partitioned_frame(stations,start=date(2011,1,1))),0)
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"),"numpy is not installed")
+    def test_features(self):
+        from amtrak_features import build_features, iter_feature_chunks, concatenate
+        late=SAMPLE_TRAIN.replace("Arrived:  4 minutes early.","Arrived:  1 hours, 4 minutes late.")
+        make_archive(self.archive,self.files+[("2010/292_20100520.txt",late),
+            ("2010/293_20100521.txt",SAMPLE_TRAIN.replace("131P","*"))])
+        csv_train,__,__=self.convert("csv",lambda dw:dw.convert_zip(self.archive,initial=True))
+        filename=os.path.join(self.tmp.name,"trains.csv")
+        with open(filename,"w") as f:
+            f.write(csv_train)
+        features=build_features(filename,workers=2,chunk_bytes=500)
+        chunked=concatenate(iter_feature_chunks(filename,chunk_bytes=300))
+        for name,values in features.items():
+            self.assertEqual(list(chunked[name].astype(str)),list(values.astype(str)),name)
+        rows=list(csv.DictReader(io.StringIO(csv_train)))
+        self.assertEqual(len(features["train_id"]),len(rows))
+        for i,row in enumerate(rows):
+            departure=datetime.fromisoformat(row["scheduled_departure"])
+            arrival=datetime.fromisoformat(row["scheduled_arrival"])
+            self.assertEqual(features["dep_timestamp"][i],departure.timestamp())
+            self.assertEqual(features["duration"][i],(arrival-departure).total_seconds())
+            self.assertEqual(features["weekday"][i],departure.weekday())
+            self.assertAlmostEqual(features["season"][i],
+                math.cos(2*math.pi*departure.timetuple().tm_yday/365))
+            self.assertEqual(features["train_id"][i],row["train_id"])
+        i=[row["train_id"] for row in rows].index("292")
+        self.assertEqual(features["delay"][i],64)
+        self.assertTrue(features["1h_delayed"][i])
+        self.assertTrue(features["long_delay_or_cancelled"][i])
+        i=[row["train_id"] for row in rows].index("293")
+        self.assertTrue(features["cancelled"][i])
+        self.assertFalse(features["30min_delayed"][i])
+        self.assertEqual(sum(features["cancelled"]),1)
+
+    def training_csv(self,aggregates=None):
+        late=SAMPLE_TRAIN.replace("Arrived:  4 minutes early.","Arrived:  1 hours, 4 minutes late.")
+        make_archive(self.archive,self.files+[("2010/292_20100520.txt",late),
+            ("2010/293_20100521.txt",SAMPLE_TRAIN.replace("131P","*"))])
+        self.convert("train",lambda dw:dw.convert_zip(self.archive,initial=True),aggregates=aggregates)
+        return os.path.join(self.tmp.name,"train_trains.csv")
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"),"numpy is not installed")
+    def test_training_arrays(self):
+        import numpy
+        from amtrak_training import Vocabulary, iter_csr_arrays, NUMERIC_COLUMNS
+        aggregates=os.path.join(self.tmp.name,"aggregates.json")
+        filename=self.training_csv(aggregates)
+        #the cancelled 293 has no delay, 292 is below min_count
+        vocabulary=Vocabulary.build(filename,min_count=2,chunk_bytes=300)
+        self.assertEqual(vocabulary.categories,["290","291"])
+        self.assertEqual(Vocabulary.from_aggregates(DelayAggregates.load(aggregates),2).categories,
+            vocabulary.categories)
+        path=os.path.join(self.tmp.name,"vocabulary.json")
+        Vocabulary.build(filename).save(path)
+        vocabulary_all=Vocabulary.load(path)
+        self.assertEqual(vocabulary_all.categories,["290","291","292"])
+        self.assertEqual(list(vocabulary_all.encode(numpy.array(["291","293","0"]))),[1,-1,-1])
+        chunks=list(iter_csr_arrays(filename,vocabulary_all,chunk_bytes=300))
+        self.assertGreater(len(chunks),1)
+        data=numpy.concatenate([chunk[0] for chunk in chunks])
+        indices=numpy.concatenate([chunk[1] for chunk in chunks])
+        label=numpy.concatenate([chunk[3] for chunk in chunks])
+        self.assertEqual(len(label),21)
+        self.assertEqual(sorted(set(label)),[-4,64])
+        for __,__,indptr,__ in chunks:
+            self.assertTrue((numpy.diff(indptr)==len(NUMERIC_COLUMNS)+1).all())
+        #every row has its train_id column set
+        train_ids=indices[indices>=len(NUMERIC_COLUMNS)]-len(NUMERIC_COLUMNS)
+        self.assertEqual(numpy.bincount(train_ids).tolist(),[10,10,1])
+        self.assertTrue((data[indices>=len(NUMERIC_COLUMNS)]==1).all())
+        #the outlier cut and the departure range
+        kept=lambda **filters:sum(len(chunk[3]) for chunk in iter_csr_arrays(filename,vocabulary_all,**filters))
+        self.assertEqual(kept(delay_range=(-10,60)),20)
+        self.assertEqual(kept(end=datetime(2010,5,15).timestamp()),10)
+
+    @unittest.skipUnless(importlib.util.find_spec("scipy"),"scipy is not installed")
+    def test_training_csr(self):
+        import scipy.sparse
+        from amtrak_training import Vocabulary, build_csr, iter_csr_chunks
+        filename=self.training_csv()
+        vocabulary=Vocabulary.build(filename)
+        matrix,label=build_csr(filename,vocabulary,chunk_bytes=300)
+        chunks=list(iter_csr_chunks(filename,vocabulary))
+        self.assertEqual(len(chunks),1)
+        self.assertEqual((matrix!=chunks[0][0]).nnz,0)
+        self.assertEqual(list(label),list(chunks[0][1]))
+        self.assertEqual(matrix.shape,(21,8))
+
+    @unittest.skipUnless(importlib.util.find_spec("xgboost"),"xgboost is not installed")
+    def test_training_external_memory(self):
+        from amtrak_training import Vocabulary, external_memory_dmatrix
+        filename=self.training_csv()
+        vocabulary=Vocabulary.build(filename)
+        dtrain=external_memory_dmatrix(filename,vocabulary,os.path.join(self.tmp.name,"cache"),
+            chunk_bytes=300)
+        self.assertEqual((dtrain.num_row(),dtrain.num_col()),(21,8))
+        self.assertEqual(dtrain.feature_names,vocabulary.feature_names())
+
+    def test_aggregates(self):
+        aggregates=os.path.join(self.tmp.name,"aggregates.json")
+        manifest=os.path.join(self.tmp.name,"manifest.json")
+        self.convert("agg",lambda dw:dw.convert_many([self.archive],workers=2,initial=True),
+            aggregates=aggregates,manifest=manifest)
+        first=DelayAggregates.load(aggregates)
+        self.assertEqual(first.count("train_id"),{"290":10,"291":10})
+        self.assertEqual(first.mean("destination_station_code"),{"NYP":-4})
+        self.assertEqual(first.std("year"),{2010:0.0})
+        #2010-05-10 is a monday
+        self.assertEqual(first.count("weekday"),{0:4,1:4,2:4,3:2,4:2,5:2,6:2})
+        self.assertEqual(first.bucket_rates("train_id")["290"]["long_delay_or_cancelled"],0)
+        late=SAMPLE_TRAIN.replace("Arrived:  4 minutes early.","Arrived:  2 hours, 4 minutes late.")
+        make_archive(self.archive,self.files+[("2010/292_20100520.txt",late)])
+        self.convert("agg",lambda dw:dw.convert_zip(self.archive),aggregates=aggregates,
+            manifest=manifest)
+        second=DelayAggregates.load(aggregates)
+        self.assertEqual(second.count("train_id"),{"290":10,"291":10,"292":1})
+        self.assertEqual(second.bucket_rates("train_id")["292"]["1h"],1)
+        self.assertEqual(second.count("year"),{2010:21})
+        merged=DelayAggregates()
+        merged.merge(first)
+        merged.merge(first)
+        self.assertEqual(merged.count("train_id"),{"290":20,"291":20})
+        self.assertEqual(merged.mean("train_id"),first.mean("train_id"))
+
+    def test_incremental(self):
+        manifest=os.path.join(self.tmp.name,"manifest.json")
+        full=self.convert("full",lambda dw:dw.convert_zip(self.archive,initial=True))
+        first=self.convert("inc",lambda dw:dw.convert_zip(self.archive,initial=True),manifest=manifest)
+        self.assertEqual(full[:2],first[:2])
+        #the next night's archive has two more trains, everything else must be skipped
+        make_archive(self.archive,self.files+[("2010/292_20100520.txt",SAMPLE_TRAIN),
+            ("2010/293_20100520.txt",SAMPLE_TRAIN)])
+        second=self.convert("inc",lambda dw:dw.convert_zip(self.archive),manifest=manifest)
+        self.assertIn("Success with 2 out of 2 trains",second[2])
+        self.assertEqual(second[0].count("\n"),full[0].count("\n")+2)
+        self.assertEqual(second[0].count("\n290,"),10)
+        self.assertEqual(second[0].count("\n293,"),1)
+        third=self.convert("inc",lambda dw:dw.convert_many([self.archive],workers=2),
+            manifest=manifest)
+        self.assertEqual(second[:2],third[:2])
+        self.assertIn("Success with 0 out of 0 trains",third[2])
+
+    def test_delay_service(self):
+        manifest=os.path.join(self.tmp.name,"manifest.json")
+        self.convert("svc",lambda dw:dw.convert_zip(self.archive,initial=True),manifest=manifest)
+        service=DelayService(os.path.join(self.tmp.name,"svc_stations.csv"),reload_interval=0.01)
+        #2010-05-10 was a monday, every weekday has the same delays
+        status,result=service.query("/delay?train_id=290&station_code=ALB&weekday=0&percentiles=50,99&history=1")
+        self.assertEqual(status,200)
+        self.assertEqual((result["count"],result["percentiles"]),(2,{"50":7,"99":7}))
+        self.assertEqual(result["recent"],[{"day":"2010-05-17","delay":7}])
+        self.assertEqual(service.query("/delay?train_id=290&station_code=ALB&weekday=all")[1]["count"],10)
+        self.assertEqual(service.query("/delay?train_id=292&station_code=ALB&weekday=all")[0],404)
+        self.assertEqual(service.query("/delay?train_id=290")[0],400)
+        #appended rows are added, a csv written from the start is loaded again
+        make_archive(self.archive,self.files+[("2010/292_20100520.txt",SAMPLE_TRAIN)])
+        self.convert("svc",lambda dw:dw.convert_zip(self.archive),manifest=manifest)
+        async def request(path):
+            ready=asyncio.get_running_loop().create_future()
+            server=asyncio.ensure_future(service.serve(port=0,ready=ready.set_result))
+            port=(await ready).sockets[0].getsockname()[1]
+            await asyncio.sleep(0.1)
+            reader,writer=await asyncio.open_connection("127.0.0.1",port)
+            responses=[]
+            for __ in range(2):
+                writer.write("GET {} HTTP/1.1\r\n\r\n".format(path).encode())
+                head=(await reader.readuntil(b"\r\n\r\n")).decode()
+                length=int(head.split("Content-Length: ")[1].split("\r\n")[0])
+                responses+=[(head.split()[1],json.loads(await reader.readexactly(length)))]
+            writer.close()
+            await writer.wait_closed()
+            await asyncio.sleep(0.01)
+            server.cancel()
+            return responses
+        responses=asyncio.run(request("/delay?train_id=292&station_code=NYP&weekday=3"))
+        self.assertEqual(responses[0],responses[1])
+        self.assertEqual(responses[0][0],"200")
+        self.assertEqual(responses[0][1]["recent"],[{"day":"2010-05-20","delay":-4}])
+        self.assertEqual(service.follower.reloads,0)
+        make_archive(self.archive,self.files[:5])
+        self.convert("svc",lambda dw:dw.convert_zip(self.archive,initial=True))
+        #the served index is complete until the new one is swapped in
+        served=service.query("/delay?train_id=291&station_code=NYP&weekday=all")
+        update=service.follower.read()
+        self.assertEqual(service.query("/delay?train_id=291&station_code=NYP&weekday=all"),served)
+        self.assertEqual(service.follower.apply(update),20)
+        self.assertEqual(service.query("/delay?train_id=291&station_code=NYP&weekday=all")[0],404)
+        self.assertEqual(service.follower.reloads,1)
+        self.assertEqual(service.query("/health")[1]["rows"],20)
+        #a csv that is not written yet is served as empty until it is
+        service=DelayService(os.path.join(self.tmp.name,"later_stations.csv"))
+        self.assertEqual(service.query("/health"),(200,{"rows":0,"keys":0,"offset":0,"reloads":0,
+            "requests":0}))
+        self.assertEqual(service.query("/delay?train_id=291&station_code=NYP")[0],404)
+        self.convert("later",lambda dw:dw.convert_zip(self.archive,initial=True))
+        self.assertEqual(service.follower.poll(),20)
+        self.assertEqual(service.query("/delay?train_id=290&station_code=NYP&weekday=all")[0],200)
+
+    def test_stats(self):
+        make_archive(self.archive,self.files+[("2010/292_20100520.txt",SAMPLE_TRAIN*2)])
+        loud=self.convert("loud",lambda dw:dw.convert_zip(self.archive,initial=True))
+        self.assertIn("double-file",loud[2])
+        def convert(dw):
+            dw.convert_many([self.archive],workers=2,initial=True)
+            self.stats=dw.stats
+        quiet=self.convert("quiet",convert,quiet=True,timing=True)
+        self.assertEqual(loud[:2],quiet[:2])
+        self.assertNotIn("double-file",quiet[2])
+        self.assertIn("Converted",quiet[2])
+        self.assertEqual(self.stats.anomalies,{"double-file":1})
+        self.assertEqual(set(self.stats.timers),{"read","parse","write"})
+        self.assertEqual([(a["archive"],a["files"]) for a in self.stats.archives],[(self.archive,21)])
+        self.assertEqual(json.loads(self.stats.to_json())["anomalies"],{"double-file":1})
+        self.assertIn('amtrak_converter_anomalies_total{kind="double-file"} 1',
+            self.stats.to_prometheus())
+
+    def test_profiler(self):
+        def convert(dw):
+            dw.convert_zip(self.archive,initial=True)
+            self.profiler=dw.profiler
+        self.convert("prof",convert,profiler=True)
+        #the profiler only ran around the train files
+        names={func[2] for func in pstats.Stats(self.profiler).stats}
+        self.assertIn("_parse_txt_file",names)
+        self.assertNotIn("_handle_zip",names)
+
+
+class TestBenchmarkData(unittest.TestCase):
+
+    def test_synthetic_archive(self):
+        import benchmark
+        with tempfile.TemporaryDirectory() as tmp:
+            archive=os.path.join(tmp,"2016.zip")
+            csv_code_timezone=os.path.join(tmp,"stations_timezone.csv")
+            codes=benchmark.build_archive(archive,trains_per_month=5,seed=3)
+            benchmark.write_timezone_csv(csv_code_timezone,codes)
+            dw=DatasetWriter(None,None,csv_code_timezone)
+            with redirect_stdout(io.StringIO()) as log:
+                trains=list(dw.iter_trains(archive))
+        self.assertEqual(len(trains),60)
+        self.assertEqual(dw.number_train,60)
+        self.assertNotIn("Traceback",log.getvalue())
+        for train,stations in trains:
+            self.assertEqual(train.nr_of_stations,len(stations))
+            self.assertTrue(all(s.station_code in codes for s in stations))
+
+
 if __name__ == '__main__':
     unittest.main()